@@ -14,3 +14,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 os.environ.setdefault('DJANGO_CONFIGURATION', 'Dev')
 
 application = get_asgi_application()
+
+from rpg_app.jobs import start_workers_on_first_request  # noqa: E402
+from rpg_app.utils import generators  # noqa: E402
+
+generators.warm_up_if_configured()
+start_workers_on_first_request()
@@ -0,0 +1,78 @@
+"""
+Database settings selected from the environment.
+
+DATABASE_ENGINE picks the backend:
+
+- ``sqlite`` (default): ``DATABASE_NAME`` (a path, default db.sqlite3) opened
+  through backend.sqlite_wal, which sets busy_timeout and relaxed synchronous
+  mode on connect and begins transactions with ``DATABASE_TRANSACTION_MODE``
+  (default IMMEDIATE). ``DATABASE_JOURNAL_MODE`` overrides the profile's
+  journal mode: WAL in Prod, SQLite's default rollback journal in Dev, which
+  leaves the checked-in db.sqlite3 as it is.
+- ``postgres``: ``DATABASE_NAME``, ``DATABASE_USER``, ``DATABASE_PASSWORD``,
+  ``DATABASE_HOST`` and ``DATABASE_PORT``.
+
+``DATABASE_CONN_MAX_AGE`` keeps connections open between requests. Setting
+``DATABASE_REPLICA_NAME`` (SQLite) or ``DATABASE_REPLICA_HOST`` (PostgreSQL)
+adds a ``replica`` alias used by backend.routers.ReplicaRouter.
+"""
+import os
+
+
+def _sqlite(name, conn_max_age, journal_mode):
+    pragmas = {
+        'busy_timeout': int(os.environ.get('DATABASE_BUSY_TIMEOUT', 5000)),
+        'synchronous': os.environ.get('DATABASE_SYNCHRONOUS', 'NORMAL'),
+    }
+    journal_mode = os.environ.get('DATABASE_JOURNAL_MODE', journal_mode)
+    if journal_mode:
+        pragmas['journal_mode'] = journal_mode
+    return {
+        'ENGINE': 'backend.sqlite_wal',
+        'NAME': name,
+        'CONN_MAX_AGE': conn_max_age,
+        'OPTIONS': {
+            # Seconds the Python driver waits on a locked database
+            'timeout': int(os.environ.get('DATABASE_BUSY_TIMEOUT', 5000)) / 1000,
+            # Take the write lock when a transaction begins, where busy_timeout
+            # applies, rather than failing its first write after a read
+            'transaction_mode': os.environ.get('DATABASE_TRANSACTION_MODE', 'IMMEDIATE'),
+            'PRAGMAS': pragmas,
+        },
+    }
+
+
+def _postgres(host, conn_max_age):
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('DATABASE_NAME', 'yourgame'),
+        'USER': os.environ.get('DATABASE_USER', ''),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': host,
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        'CONN_MAX_AGE': conn_max_age,
+        'CONN_HEALTH_CHECKS': True,
+    }
+
+
+def database_config(base_dir, conn_max_age=0, journal_mode=None):
+    engine = os.environ.get('DATABASE_ENGINE', 'sqlite')
+    conn_max_age = int(os.environ.get('DATABASE_CONN_MAX_AGE', conn_max_age))
+
+    if engine == 'postgres':
+        databases = {'default': _postgres(os.environ.get('DATABASE_HOST', ''), conn_max_age)}
+        replica_host = os.environ.get('DATABASE_REPLICA_HOST')
+        if replica_host:
+            databases['replica'] = _postgres(replica_host, conn_max_age)
+    elif engine == 'sqlite':
+        name = os.environ.get('DATABASE_NAME', base_dir / 'db.sqlite3')
+        databases = {'default': _sqlite(name, conn_max_age, journal_mode)}
+        replica_name = os.environ.get('DATABASE_REPLICA_NAME')
+        if replica_name:
+            databases['replica'] = _sqlite(replica_name, conn_max_age, journal_mode)
+    else:
+        raise ValueError(f"Unknown DATABASE_ENGINE {engine!r}, expected 'sqlite' or 'postgres'")
+
+    if 'replica' in databases:
+        databases['replica']['TEST'] = {'MIRROR': 'default'}
+    return databases
@@ -0,0 +1,48 @@
+import contextvars
+import functools
+
+from django.conf import settings
+
+_use_replica = contextvars.ContextVar('use_replica', default=False)
+
+
+def read_from_replica(view):
+    """
+    Sends the reads of a view to the ``replica`` database, when configured.
+
+    A lagging replica breaks read-your-writes, so only endpoints where
+    slightly stale results are acceptable (search, job listings) opt in, never
+    the ones clients poll right after a write. Their responses are not put in
+    the per-user response cache (see ``using_replica``).
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _use_replica.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _use_replica.reset(token)
+
+    return wrapper
+
+
+def using_replica():
+    """Whether reads currently go to the replica."""
+    return _use_replica.get() and 'replica' in settings.DATABASES
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if using_replica():
+            return 'replica'
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -10,10 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
+from datetime import timedelta
 from pathlib import Path
 from configurations import Configuration
 from dotenv import load_dotenv
 
+from .database import database_config
+
 load_dotenv()
 
 class Dev(Configuration):
@@ -48,6 +51,7 @@ class Dev(Configuration):
     ]
 
     MIDDLEWARE = [
+        'servercheck.middleware.RequestMetricsMiddleware',
         'corsheaders.middleware.CorsMiddleware',
         'django.middleware.security.SecurityMiddleware',
         'django.contrib.sessions.middleware.SessionMiddleware',
@@ -58,21 +62,181 @@ class Dev(Configuration):
         'django.middleware.clickjacking.XFrameOptionsMiddleware',
     ]
 
+    # Request instrumentation (servercheck.middleware). Requests taking
+    # SLOW_REQUEST_SECONDS or running SLOW_REQUEST_QUERIES queries are counted
+    # as slow; SLOW_REQUEST_SAMPLE_RATE of them are logged to
+    # servercheck.slow_requests with their slowest SQL statements.
+
+    REQUEST_METRICS = {
+        'SERVER_TIMING': True,
+        'SLOW_REQUEST_SECONDS': float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0)),
+        'SLOW_REQUEST_QUERIES': int(os.environ.get('SLOW_REQUEST_QUERIES', 50)),
+        'SLOW_REQUEST_SAMPLE_RATE': float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 1.0)),
+        'SLOW_REQUEST_QUERIES_LOGGED': 5,
+    }
+
     CORS_ORIGIN_ALLOW_ALL = True
     CSRF_TRUSTED_ORIGINS = ["http://localhost:5173"]
 
+    # API clients authenticate with a JWT access token from /api/auth/token/
+    # (refreshed at /api/auth/token/refresh/) rather than HTTP Basic, which
+    # ran a full password hash on every request; the browser app keeps using
+    # its session. Users named by tokens are cached in the AUTH_USER_CACHE
+    # ALIAS cache for TTL seconds.
     REST_FRAMEWORK = {
         'DEFAULT_AUTHENTICATION_CLASSES': [
+            'rpg_app.authentication.CachedJWTAuthentication',
             'rest_framework.authentication.SessionAuthentication',
-            'rest_framework.authentication.BasicAuthentication',
         ],
         'DEFAULT_PERMISSION_CLASSES': [
             'rest_framework.permissions.IsAuthenticated',
         ],
     }
 
+    SIMPLE_JWT = {
+        'ACCESS_TOKEN_LIFETIME': timedelta(minutes=int(os.environ.get('JWT_ACCESS_MINUTES', 15))),
+        'REFRESH_TOKEN_LIFETIME': timedelta(days=int(os.environ.get('JWT_REFRESH_DAYS', 7))),
+        'UPDATE_LAST_LOGIN': False,
+    }
+
+    # Sessions (for /api/auth/login/ and the admin) and users named by them
+    # or by tokens are cached in the per-process AUTH_USER_CACHE. SESSION_STORE
+    # picks the session engine: cached_db (reads from SESSION_CACHE_ALIAS,
+    # writes through to the database), db, cache, or signed_cookies (no
+    # server-side state, so logging out cannot revoke a copied cookie).
+    # `manage.py purge_sessions` deletes expired database sessions in batches.
+
+    AUTHENTICATION_BACKENDS = ['rpg_app.authentication.CachedModelBackend']
+
+    AUTH_USER_CACHE = {
+        'ALIAS': 'default',
+        'TTL': 60,
+    }
+
+    SESSION_ENGINE = 'django.contrib.sessions.backends.' + os.environ.get('SESSION_STORE', 'cached_db')
+    SESSION_CACHE_ALIAS = 'sessions'
+
     CORS_ALLOW_CREDENTIALS = True
 
+    # Text generation
+    # BACKEND picks how MODEL is run, see rpg_app/backends.py: transformers,
+    # transformers-int8, onnx, onnx-int8 (exported to ONNX_DIR on first
+    # load), openai (any OpenAI-compatible completions API) or stub.
+    # The model is loaded lazily on first use; set GENERATOR_WARMUP=1 to load
+    # it in the background as soon as the WSGI/ASGI application starts.
+    # Concurrent requests are grouped into batches of up to MAX_BATCH_SIZE
+    # prompts, waiting at most MAX_BATCH_WAIT seconds for a batch to fill.
+
+    TEXT_GENERATION = {
+        'MODEL': os.environ.get('GENERATOR_MODEL', 'distilgpt2'),
+        'BACKEND': os.environ.get('GENERATOR_BACKEND', 'transformers'),
+        'ONNX_DIR': Path(os.environ.get('GENERATOR_ONNX_DIR', BASE_DIR / '.cache' / 'onnx')),
+        'OPENAI': {
+            'BASE_URL': os.environ.get('GENERATOR_OPENAI_BASE_URL', 'https://api.openai.com/v1'),
+            'API_KEY': os.environ.get('GENERATOR_OPENAI_API_KEY', os.environ.get('OPENAI_API_KEY', '')),
+            # Remote model name; defaults to MODEL
+            'MODEL': os.environ.get('GENERATOR_OPENAI_MODEL', ''),
+            'TIMEOUT': float(os.environ.get('GENERATOR_OPENAI_TIMEOUT', 60)),
+            'MAX_RETRIES': 2,
+            'MAX_CONNECTIONS': int(os.environ.get('GENERATOR_OPENAI_MAX_CONNECTIONS', 20)),
+        },
+        'WARMUP': os.environ.get('GENERATOR_WARMUP', '0') == '1',
+        'BATCHING': os.environ.get('GENERATOR_BATCHING', '1') == '1',
+        'MAX_BATCH_SIZE': int(os.environ.get('GENERATOR_MAX_BATCH_SIZE', 8)),
+        'MAX_BATCH_WAIT': float(os.environ.get('GENERATOR_MAX_BATCH_WAIT', 0.02)),
+        # Seconds a streaming response waits for the next token before giving up
+        'STREAM_TIMEOUT': 60,
+        # Generated openings are cached by a hash of the normalized prompt and
+        # generation parameters: an in-process LRU in front of the ALIAS cache.
+        'CACHE': {
+            'ENABLED': os.environ.get('GENERATION_CACHE', '1') == '1',
+            'MAX_ENTRIES': 512,
+            'TTL': 7 * 24 * 60 * 60,
+            'ALIAS': 'generation',
+        },
+        # The transformers backends keep the past key values of up to
+        # MAX_PREFIXES constant template prefixes (the opening prompt's
+        # instructions) and the token ids of up to MAX_FRAGMENTS constant
+        # template parts, so a request only prefills its own fields.
+        'PREFIX_CACHE': {
+            'ENABLED': os.environ.get('GENERATOR_PREFIX_CACHE', '1') == '1',
+            'MAX_PREFIXES': 8,
+            'MAX_FRAGMENTS': 1024,
+        },
+        # Continuation prompts (POST /api/chatlogs/<id>/continue/) are built
+        # within MAX_PROMPT_TOKENS: story metadata, a rolling summary and the
+        # newest messages that fit. Older messages are folded into the
+        # summary, up to SUMMARY_CHUNKS model calls per turn.
+        'CONTEXT': {
+            'MAX_PROMPT_TOKENS': int(os.environ.get('GENERATOR_MAX_PROMPT_TOKENS', 768)),
+            'MAX_NEW_TOKENS': int(os.environ.get('GENERATOR_MAX_NEW_TOKENS', 120)),
+            'METADATA_TOKENS': 200,
+            'SUMMARY_TOKENS': 150,
+            'SUMMARY_CHUNKS': 2,
+            'MAX_RECENT_MESSAGES': 200,
+        },
+    }
+
+    # Queued story openings (POST /api/create/?async=1) are stored in the
+    # GenerationJob table and picked up by IN_PROCESS_WORKERS threads of the
+    # web process, or by `manage.py run_generation_jobs` when that is 0.
+
+    GENERATION_JOBS = {
+        'IN_PROCESS_WORKERS': int(os.environ.get('GENERATION_JOBS_IN_PROCESS_WORKERS', 1)),
+        'MAX_ATTEMPTS': 3,
+        'RETRY_BACKOFF': 5,
+        'STALE_AFTER': 300,
+        'POLL_INTERVAL': 1.0,
+    }
+
+    # Admission control for generation in request threads (story openings,
+    # chat continuations, streams), see rpg_app/admission.py. Per process, at
+    # most MAX_CONCURRENT requests generate at once and MAX_QUEUE more wait
+    # up to QUEUE_TIMEOUT seconds for a slot; others get 503 with
+    # Retry-After. Keep MAX_CONCURRENT + MAX_QUEUE below APP_SERVER['THREADS']
+    # so the other endpoints always have a thread. Each user may also start
+    # RATE generations per minute, in bursts of up to BURST (429 beyond),
+    # counted in the CACHE_ALIAS cache; a RATE of 0 lifts the quota. A batch
+    # queueing more than BURST openings is refused with 400.
+
+    GENERATION_LIMITS = {
+        'MAX_CONCURRENT': int(os.environ.get('GENERATION_MAX_CONCURRENT', 2)),
+        'MAX_QUEUE': int(os.environ.get('GENERATION_MAX_QUEUE', 1)),
+        'QUEUE_TIMEOUT': float(os.environ.get('GENERATION_QUEUE_TIMEOUT', 10)),
+        'RATE': float(os.environ.get('GENERATION_RATE_PER_MINUTE', 10)),
+        'BURST': int(os.environ.get('GENERATION_BURST', 5)),
+        'CACHE_ALIAS': 'quotas',
+    }
+
+    # Cold storage of idle chat logs, see rpg_app/archive.py. `manage.py
+    # compact_chat_logs` moves the messages of chat logs in stories idle for
+    # IDLE_DAYS into one blob per log, compressed with zlib at LEVEL (0-9).
+    # They are decompressed when read and turned back into rows on the next
+    # write.
+
+    CHAT_ARCHIVE = {
+        'IDLE_DAYS': int(os.environ.get('CHAT_ARCHIVE_IDLE_DAYS', 90)),
+        'LEVEL': int(os.environ.get('CHAT_ARCHIVE_LEVEL', 6)),
+    }
+
+    # `manage.py serve` runs the site under gunicorn. The app and the
+    # generation model are loaded in the master process before workers are
+    # forked; workers are replaced after MAX_REQUESTS (+ up to
+    # MAX_REQUESTS_JITTER) requests. INTERFACE is 'wsgi' (threaded sync
+    # workers) or 'asgi' (uvicorn workers).
+
+    APP_SERVER = {
+        'BIND': os.environ.get('APP_SERVER_BIND', '0.0.0.0:8000'),
+        'INTERFACE': os.environ.get('APP_SERVER_INTERFACE', 'wsgi'),
+        'WORKERS': int(os.environ.get('WEB_CONCURRENCY', min(os.cpu_count() or 1, 4))),
+        'THREADS': int(os.environ.get('APP_SERVER_THREADS', 4)),
+        'MAX_REQUESTS': int(os.environ.get('APP_SERVER_MAX_REQUESTS', 1000)),
+        'MAX_REQUESTS_JITTER': int(os.environ.get('APP_SERVER_MAX_REQUESTS_JITTER', 100)),
+        'TIMEOUT': int(os.environ.get('APP_SERVER_TIMEOUT', 120)),
+        'GRACEFUL_TIMEOUT': int(os.environ.get('APP_SERVER_GRACEFUL_TIMEOUT', 30)),
+        'PRELOAD_MODEL': os.environ.get('APP_SERVER_PRELOAD_MODEL', '1') == '1',
+    }
+
     ROOT_URLCONF = 'backend.urls'
 
     TEMPLATES = [
@@ -95,12 +259,50 @@ class Dev(Configuration):
 
     # Database
     # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
+    # See backend/database.py for the DATABASE_* environment variables.
+
+    DATABASES = database_config(BASE_DIR)
 
-    DATABASES = {
+    DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+
+    # Cache
+    # https://docs.djangoproject.com/en/5.0/topics/cache/
+
+    CACHES = {
         'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'db.sqlite3',
-        }
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'generation': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('GENERATION_CACHE_DIR', BASE_DIR / '.cache' / 'generation'),
+            'TIMEOUT': 7 * 24 * 60 * 60,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        # Per-user API responses and their data versions. Must be shared by
+        # all worker processes, hence file based rather than local memory.
+        'responses': {
+            'BACKEND': os.environ.get('RESPONSE_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+            'LOCATION': os.environ.get('RESPONSE_CACHE_LOCATION', BASE_DIR / '.cache' / 'responses'),
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        },
+        # Sessions in front of the database (SESSION_STORE=cached_db). Shared
+        # by all worker processes, so a logout is seen by every one of them.
+        'sessions': {
+            'BACKEND': os.environ.get('SESSION_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+            'LOCATION': os.environ.get('SESSION_CACHE_LOCATION', BASE_DIR / '.cache' / 'sessions'),
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        },
+        # Per-user generation quotas, shared by all worker processes.
+        'quotas': {
+            'BACKEND': os.environ.get('QUOTA_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+            'LOCATION': os.environ.get('QUOTA_CACHE_LOCATION', BASE_DIR / '.cache' / 'quotas'),
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        },
+    }
+
+    RESPONSE_CACHE = {
+        'ALIAS': 'responses',
+        'TIMEOUT': 300,
     }
 
     # Password validation
@@ -145,4 +347,16 @@ class Dev(Configuration):
 
 class Prod(Dev):
     DEBUG = False
-    SECRET_KEY = os.environ['SECRET_KEY']
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+
+    @classmethod
+    def setup(cls):
+        # Checked here rather than at import so the Dev configuration keeps
+        # working without the variable.
+        super().setup()
+        if not cls.SECRET_KEY:
+            raise ValueError("The SECRET_KEY environment variable must be set in production.")
+
+    # Keep connections open between requests; PostgreSQL connections are
+    # health-checked before reuse. SQLite runs in WAL mode.
+    DATABASES = database_config(Dev.BASE_DIR, conn_max_age=60, journal_mode='WAL')
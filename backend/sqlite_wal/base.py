@@ -0,0 +1,53 @@
+"""
+SQLite backend that tunes every new connection for concurrent web traffic.
+
+Accepts a ``PRAGMAS`` dict in the database OPTIONS, applied on connect, e.g.
+``{'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000}``.
+WAL lets readers proceed while a writer holds the lock, and busy_timeout
+makes writers wait for the lock instead of failing with "database is locked".
+WAL is opt-in: it is recorded in the database file itself and leaves -wal and
+-shm files next to it.
+
+busy_timeout does not cover a transaction that reads and then writes: if
+another connection wrote in between, SQLite fails the upgrade to a write
+lock at once. The ``transaction_mode`` OPTION ('DEFERRED', 'IMMEDIATE' or
+'EXCLUSIVE'), backported from Django 5.1, makes atomic blocks begin with
+``BEGIN IMMEDIATE`` so they wait for the write lock up front instead.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+}
+
+TRANSACTION_MODES = {'DEFERRED', 'EXCLUSIVE', 'IMMEDIATE'}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('PRAGMAS', None)
+        transaction_mode = params.pop('transaction_mode', None)
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"transaction_mode must be one of {', '.join(sorted(TRANSACTION_MODES))}, not {transaction_mode!r}"
+            )
+        self.transaction_mode = transaction_mode.upper() if transaction_mode else None
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        pragmas = {**DEFAULT_PRAGMAS, **self.settings_dict['OPTIONS'].get('PRAGMAS', {})}
+        for name, value in pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if getattr(self, 'transaction_mode', None) is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
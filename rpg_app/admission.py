@@ -0,0 +1,239 @@
+"""
+Admission control for text generation in request threads.
+
+Generation is CPU bound and slow, so the request threads running it are
+capped per process: ``admission.slot()`` lets GENERATION_LIMITS
+['MAX_CONCURRENT'] requests generate at once and up to ['MAX_QUEUE'] more
+wait for a slot. Anything beyond that, or a wait longer than
+['QUEUE_TIMEOUT'], fails fast with 503 and a Retry-After estimate instead of
+tying up the threads that serve every other endpoint.
+
+``GenerationRateThrottle`` adds a per-user token bucket on top, kept in the
+GENERATION_LIMITS['CACHE_ALIAS'] cache so it is shared by all workers, and
+answers 429 with Retry-After once a user's quota is spent. Views take their
+slot with ``generation_slot(request)``, which refunds the quota of a request
+turned away with 503.
+"""
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.throttling import BaseThrottle
+
+from servercheck.metrics import Histogram
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _config():
+    return settings.GENERATION_LIMITS
+
+
+class GenerationOverloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Text generation is at capacity, please retry later.'
+    default_code = 'generation_overloaded'
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        # DRF's exception handler turns ``wait`` into a Retry-After header
+        self.wait = wait
+
+
+class AdmissionController:
+    """A counting semaphore with a bounded, timed wait queue and metrics."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'queue_timeout': 0, 'rate_limited': 0}
+        self.queue_wait = Histogram(WAIT_BUCKETS)
+        # Moving average of how long a slot is held, for Retry-After
+        self._average_seconds = None
+
+    @staticmethod
+    def max_concurrent():
+        return max(1, _config()['MAX_CONCURRENT'])
+
+    def retry_after(self):
+        """Seconds until the requests ahead of a new one are likely done."""
+        average = self._average_seconds or 1.0
+        return max(1, math.ceil(average * (self.waiting + 1) / self.max_concurrent()))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        raise GenerationOverloaded(self.retry_after())
+
+    def acquire(self, timeout=None):
+        """Takes a slot, waiting at most ``timeout`` (default QUEUE_TIMEOUT) seconds. Returns the admission time."""
+        config = _config()
+        limit = self.max_concurrent()
+        started = time.perf_counter()
+        deadline = started + (config['QUEUE_TIMEOUT'] if timeout is None else timeout)
+        with self._condition:
+            if self.running >= limit and self.waiting >= config['MAX_QUEUE']:
+                self._reject('queue_full')
+            self.waiting += 1
+            try:
+                while self.running >= limit:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        self._reject('queue_timeout')
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+        admitted_at = time.perf_counter()
+        self.queue_wait.observe(admitted_at - started)
+        return admitted_at
+
+    async def aacquire(self, timeout=None):
+        """
+        acquire() for async callers, waiting in a worker thread. A caller
+        cancelled meanwhile, e.g. by a client disconnect, cannot stop that
+        thread, so the slot it goes on to take is released instead of leaked.
+        """
+        acquiring = asyncio.ensure_future(sync_to_async(self.acquire, thread_sensitive=False)(timeout))
+        try:
+            return await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, acquiring):
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self.release(acquiring.result())
+
+    def release(self, admitted_at):
+        held = time.perf_counter() - admitted_at
+        with self._condition:
+            self.running -= 1
+            average = self._average_seconds
+            self._average_seconds = held if average is None else 0.8 * average + 0.2 * held
+            self._condition.notify()
+
+    def count_rate_limited(self):
+        with self._condition:
+            self.rejected['rate_limited'] += 1
+
+    @contextmanager
+    def slot(self, timeout=None):
+        admitted_at = self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release(admitted_at)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_concurrent': self.max_concurrent(),
+                'max_queue': _config()['MAX_QUEUE'],
+                'running': self.running,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'queue_wait': self.queue_wait.snapshot(),
+            }
+
+
+admission = AdmissionController()
+
+_bucket_lock = threading.Lock()
+
+
+def take_tokens(ident, cost=1, now=None):
+    """
+    Takes ``cost`` tokens from ``ident``'s bucket, which refills at RATE per
+    minute up to BURST. Returns ``(allowed, retry_after_seconds)``; a cost
+    above BURST never fits, callers reject it up front. The
+    read-modify-write is only atomic within a process; concurrent workers can
+    overshoot a quota by a request or two.
+    """
+    config = _config()
+    rate = config['RATE'] / 60
+    capacity = config['BURST']
+    now = time.time() if now is None else now
+    cache = caches[config['CACHE_ALIAS']]
+    key = f'rpg:generation-quota:{ident}'
+    with _bucket_lock:
+        tokens, updated = cache.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+        if tokens < cost:
+            return False, math.ceil((cost - tokens) / rate)
+        # Once refilled the bucket is no different from a missing one
+        cache.set(key, (min(capacity, tokens - cost), now), math.ceil(capacity / rate) + 1)
+    return True, 0
+
+
+def refund_tokens(ident, cost=1, now=None):
+    """Puts back ``cost`` tokens taken for a request that then generated nothing."""
+    take_tokens(ident, -cost, now)
+
+
+class GenerationRateThrottle(BaseThrottle):
+    """
+    Per-user generation quota. Views may define ``generation_cost(request)``
+    to charge more than one generation per request, or none. A request
+    costing more than BURST could never be admitted and is rejected with 400.
+    """
+
+    def allow_request(self, request, view):
+        self._wait = None
+        config = _config()
+        if not config['RATE']:
+            return True
+        cost = view.generation_cost(request) if hasattr(view, 'generation_cost') else 1
+        if not cost:
+            return True
+        if cost > config['BURST']:
+            raise ValidationError({
+                'detail': f"At most {config['BURST']} generations can be requested at once, not {cost}.",
+            })
+        user = request.user
+        ident = f'user:{user.pk}' if user and user.is_authenticated else f'ip:{self.get_ident(request)}'
+        allowed, self._wait = take_tokens(ident, cost)
+        if not allowed:
+            admission.count_rate_limited()
+        else:
+            request._generation_charge = (ident, cost)
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+    @staticmethod
+    def refund(request):
+        """Gives back what this throttle charged ``request``, at most once."""
+        charge = getattr(request, '_generation_charge', None)
+        if charge is not None:
+            request._generation_charge = None
+            refund_tokens(*charge)
+
+
+@contextmanager
+def generation_slot(request, timeout=None):
+    """
+    ``admission.slot()`` for a request charged by GenerationRateThrottle. A
+    request turned away with 503 is refunded, so a retry after Retry-After is
+    not then refused with 429 for the generation that never ran.
+    """
+    try:
+        admitted_at = admission.acquire(timeout)
+    except GenerationOverloaded:
+        GenerationRateThrottle.refund(request)
+        raise
+    try:
+        yield
+    finally:
+        admission.release(admitted_at)
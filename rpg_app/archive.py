@@ -0,0 +1,162 @@
+"""
+Cold storage for chat logs nobody has touched in a while.
+
+``compact_idle`` moves the messages of chat logs whose story has been idle
+for CHAT_ARCHIVE['IDLE_DAYS'] into a ChatLogArchive: one zlib-compressed
+blob per log, in a side table so chat log listings never read it. Their
+ChatMessage rows, most of the database, are deleted.
+
+Reads stay transparent: ``ChatLog.stored_messages()``, and through it the
+serializers, decompress an archive only when the log's messages are
+rendered; ``attach_archives`` loads those of a page of logs in one query.
+Writing to an archived log (appending, editing, continuing the story)
+first ``restore``s its rows under their original ids. Search documents of
+archived messages stay indexed, without their link to the message row.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ChatLog, ChatLogArchive, ChatMessage, SearchDocument
+
+
+def _config():
+    return settings.CHAT_ARCHIVE
+
+
+def idle_chat_logs(idle_days=None):
+    """Unarchived chat logs created, and in stories last active, more than ``idle_days`` ago."""
+    cutoff = timezone.now() - timedelta(days=_config()['IDLE_DAYS'] if idle_days is None else idle_days)
+    return ChatLog.objects.filter(archived=False, timestamp__lt=cutoff, story__last_activity_at__lt=cutoff)
+
+
+def compact(chat_log_id, version):
+    """
+    Moves a chat log's messages into a new ChatLogArchive, unless the log
+    changed since ``version``. Returns the archive, or None.
+    """
+    with transaction.atomic():
+        # Flagging the log first takes the write lock, so no message can be
+        # appended between reading the rows and deleting them
+        if not ChatLog.objects.filter(pk=chat_log_id, version=version, archived=False).update(archived=True):
+            return None
+        rows = list(
+            ChatMessage.objects.filter(chat_log_id=chat_log_id).order_by('sequence')
+            .values_list(*ChatLogArchive.FIELDS)
+        )
+        data, raw_size = ChatLogArchive.pack(rows, _config()['LEVEL'])
+        archive = ChatLogArchive.objects.create(
+            chat_log_id=chat_log_id, message_count=len(rows), raw_size=raw_size, data=data,
+        )
+        SearchDocument.objects.filter(chat_log_id=chat_log_id, kind=SearchDocument.MESSAGE).update(message=None)
+        # The ORM would load every message to send post_delete signals, and
+        # nothing a client sees changes
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {ChatMessage._meta.db_table} WHERE chat_log_id = %s', [chat_log_id])
+    return archive
+
+
+def compact_idle(idle_days=None, batch_size=100, pause=0.0):
+    """
+    Archives every idle chat log, one transaction per log, sleeping
+    ``pause`` seconds between batches of ``batch_size`` to let other writers
+    in. Returns totals of the logs, messages and bytes archived.
+    """
+    totals = {'chat_logs': 0, 'messages': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    candidates = idle_chat_logs(idle_days).order_by('pk').values_list('pk', 'version')
+    last_id = 0
+    while True:
+        batch = list(candidates.filter(pk__gt=last_id)[:batch_size])
+        if not batch:
+            return totals
+        last_id = batch[-1][0]
+        for chat_log_id, version in batch:
+            archive = compact(chat_log_id, version)
+            if archive is not None:
+                totals['chat_logs'] += 1
+                totals['messages'] += archive.message_count
+                totals['raw_bytes'] += archive.raw_size
+                totals['stored_bytes'] += len(archive.data)
+        if len(batch) < batch_size:
+            return totals
+        time.sleep(pause)
+
+
+def restore(chat_log_id):
+    """Moves an archived chat log's messages back into ChatMessage rows; does nothing for other logs."""
+    with transaction.atomic():
+        archive = ChatLogArchive.objects.filter(chat_log_id=chat_log_id).first()
+        if archive is None:
+            return
+        ChatMessage.objects.bulk_create(archive.messages(), batch_size=1000)
+        SearchDocument.objects.filter(
+            chat_log_id=chat_log_id, kind=SearchDocument.MESSAGE, message=None,
+        ).update(message=F('object_id'))
+        archive.delete()
+        ChatLog.objects.filter(pk=chat_log_id).update(archived=False)
+
+
+def thaw(chat_log):
+    """Restores ``chat_log`` before its messages are read for a write."""
+    if chat_log.archived:
+        restore(chat_log.pk)
+        chat_log.archived = False
+
+
+def attach_archives(chat_logs):
+    """Loads the archives of the archived ``chat_logs`` in one query, before their messages are rendered."""
+    pending = {
+        chat_log.pk: chat_log for chat_log in chat_logs
+        if chat_log.archived and not ChatLog.archive.is_cached(chat_log)
+    }
+    if pending:
+        for archive in ChatLogArchive.objects.filter(chat_log_id__in=pending):
+            ChatLog.archive.related.set_cached_value(pending[archive.chat_log_id], archive)
+
+
+def _sqlite_sizes(cursor, tables):
+    cursor.execute('PRAGMA page_size')
+    page_size = cursor.fetchone()[0]
+    cursor.execute('PRAGMA page_count')
+    page_count = cursor.fetchone()[0]
+    cursor.execute('PRAGMA freelist_count')
+    sizes = {'database': (page_count - cursor.fetchone()[0]) * page_size}
+    for name, table in tables.items():
+        try:
+            # dbstat is optional in SQLite builds
+            cursor.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = %s)",
+                [table],
+            )
+            sizes[name] = cursor.fetchone()[0] or 0
+        except DatabaseError:
+            sizes[name] = None
+    return sizes
+
+
+def _postgresql_sizes(cursor, tables):
+    cursor.execute('SELECT pg_database_size(current_database())')
+    sizes = {'database': cursor.fetchone()[0]}
+    for name, table in tables.items():
+        cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        sizes[name] = cursor.fetchone()[0]
+    return sizes
+
+
+def storage_report():
+    """
+    Bytes in use by the database, by chat message rows with their indexes
+    (what listings with messages read) and by archives; None where the
+    database cannot tell.
+    """
+    tables = {'messages': ChatMessage._meta.db_table, 'archives': ChatLogArchive._meta.db_table}
+    sizes = {'sqlite': _sqlite_sizes, 'postgresql': _postgresql_sizes}.get(connection.vendor)
+    if sizes is None:
+        return dict.fromkeys(['database', *tables])
+    with connection.cursor() as cursor:
+        return sizes(cursor, tables)
@@ -0,0 +1,74 @@
+"""
+JWT authentication and session user lookups through a user cache.
+
+API clients exchange their username and password for an access/refresh
+token pair once (POST /api/auth/token/), then send ``Authorization: Bearer
+<access>``. Checking an access token is an HMAC over a few hundred bytes
+instead of a PBKDF2 password hash.
+
+The user named by a token, or by a session (``CachedModelBackend``), is kept
+in the AUTH_USER_CACHE for TTL seconds, so most authenticated requests need
+no ``auth_user`` query at all. Saving or deleting a user drops its cached
+copy in the process that made the change; other processes see it within TTL.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+def _cache():
+    return caches[settings.AUTH_USER_CACHE['ALIAS']]
+
+
+def user_cache_key(user_id):
+    return f'rpg:auth-user:{user_id}'
+
+
+def forget_user(user_id):
+    _cache().delete(user_cache_key(user_id))
+
+
+def remember_user(user):
+    _cache().set(user_cache_key(user.pk), user, settings.AUTH_USER_CACHE['TTL'])
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose ``get_user``, run by AuthenticationMiddleware for every session request, is cached."""
+
+    def get_user(self, user_id):
+        user = _cache().get(user_cache_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                remember_user(user)
+            return user
+        return user if self.user_can_authenticate(user) else None
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """simplejwt's JWTAuthentication, with the user looked up through the cache."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        user = _cache().get(user_cache_key(user_id))
+        if user is None:
+            # Looks the user up and runs simplejwt's active and revocation checks
+            user = super().get_user(validated_token)
+            remember_user(user)
+            return user
+
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        if api_settings.CHECK_REVOKE_TOKEN and (
+            validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password)
+        ):
+            raise AuthenticationFailed("The user's password has been changed.", code='password_changed')
+        return user
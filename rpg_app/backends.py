@@ -0,0 +1,323 @@
+"""
+Text-generation backends.
+
+Every backend is called like a transformers text-generation pipeline,
+``backend(prompt_or_prompts, **options)``, and returns the same shape
+(``[{'generated_text': prompt + completion}]`` per prompt), so the registry,
+the batching service and the callers do not depend on which one is in use.
+Backends also count the tokens they generate and report tokens per second.
+
+TEXT_GENERATION['BACKEND'] selects one:
+
+``transformers``       the HF pipeline in fp32 (the default)
+``transformers-int8``  the HF pipeline with torch dynamic int8 quantization
+``onnx``               an ONNX Runtime export of the model on the CPU
+``onnx-int8``          the same export, dynamically quantized to int8
+``openai``             a remote OpenAI-compatible completions API
+``stub``               a deterministic echo, for tests and benchmarks
+
+The transformers backends also reuse the past key values of constant
+template prefixes (see ``prefix_cache``) when TEXT_GENERATION['PREFIX_CACHE']
+is enabled.
+
+transformers, torch, optimum and onnxruntime are imported when a backend
+that needs them is loaded, never at import time.
+"""
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from .prefix_cache import FragmentTokenizer, PrefixKVCache, TemplatedPrompt
+
+_WORDS = re.compile(r"\w+|[^\w\s]")
+
+
+def stub_generator(prompts, **options):
+    """Deterministic stand-in for the transformers pipeline."""
+    if isinstance(prompts, str):
+        return [{'generated_text': f"{prompts} Once upon a time."}]
+    return [stub_generator(prompt) for prompt in prompts]
+
+
+class GenerationBackend:
+    """Base class: meters calls to ``generate`` and exposes the pipeline calling convention."""
+
+    name = None
+    tokenizer = None
+
+    def __init__(self, model):
+        self.model_name = model
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._prompts = 0
+        self._tokens = 0
+        self._seconds = 0.0
+
+    def __call__(self, prompts, **options):
+        single = isinstance(prompts, str)
+        batch = [prompts] if single else list(prompts)
+        started = time.perf_counter()
+        results, generated_tokens = self.generate(batch, **options)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._calls += 1
+            self._prompts += len(batch)
+            self._tokens += generated_tokens
+            self._seconds += elapsed
+        return results[0] if single else results
+
+    def generate(self, prompts, **options):
+        """Returns one list of sequences per prompt and the number of tokens generated."""
+        raise NotImplementedError
+
+    def count_tokens(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return len(_WORDS.findall(text))
+
+    def count_generated(self, prompts, results):
+        return sum(
+            self.count_tokens(sequence['generated_text'][len(prompt):])
+            for prompt, sequences in zip(prompts, results)
+            for sequence in sequences
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.name,
+                'calls': self._calls,
+                'prompts': self._prompts,
+                'generated_tokens': self._tokens,
+                'generation_seconds': self._seconds,
+                'tokens_per_second': self._tokens / self._seconds if self._seconds else 0.0,
+            }
+
+
+class StubBackend(GenerationBackend):
+    name = 'stub'
+
+    def generate(self, prompts, **options):
+        results = stub_generator(prompts)
+        return results, self.count_generated(prompts, results)
+
+
+class PipelineBackend(GenerationBackend):
+    """
+    A transformers text-generation pipeline; extra options such as
+    ``streamer`` are passed through.
+
+    With ``enable_prefix_cache()``, a single templated prompt is generated
+    with ``model.generate`` from the cached past key values of its constant
+    prefix instead, so only the variable suffix is prefilled. Batches keep
+    going through the pipeline: left padding would sit in front of the
+    shared prefix and shift its positions.
+    """
+
+    name = 'transformers'
+
+    # Options the pipeline consumes itself rather than passing to model.generate
+    PIPELINE_OPTIONS = {
+        'batch_size', 'clean_up_tokenization_spaces', 'handle_long_generation', 'prefix', 'return_full_text',
+        'return_tensors', 'return_text', 'truncation',
+    }
+
+    def __init__(self, model, pipeline, max_fragments=1024):
+        super().__init__(model)
+        self.pipeline = pipeline
+        self.tokenizer = pipeline.tokenizer
+        # GPT-2 style models ship without a pad token; batched generation needs
+        # one, and decoder-only models must be padded on the left.
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token_id = pipeline.model.config.eos_token_id
+        self.tokenizer.padding_side = 'left'
+        self.fragments = FragmentTokenizer(self.tokenizer, max_fragments)
+        self.prefix_cache = None
+
+    @property
+    def model(self):
+        return self.pipeline.model
+
+    def enable_prefix_cache(self, max_prefixes=8):
+        self.prefix_cache = PrefixKVCache(self.model, self.fragments, max_prefixes)
+
+    def reuses_prefix(self, prompts, options):
+        return (
+            self.prefix_cache is not None and len(prompts) == 1 and isinstance(prompts[0], TemplatedPrompt)
+            and bool(prompts[0].prefix) and options.get('num_return_sequences', 1) == 1
+        )
+
+    def generate(self, prompts, **options):
+        if self.reuses_prefix(prompts, options):
+            result = self.generate_from_prefix(prompts[0], options)
+            if result is not None:
+                return [result[0]], result[1]
+        results = self.pipeline(prompts, **options)
+        return results, self.count_generated(prompts, results)
+
+    def generate_from_prefix(self, prompt, options):
+        """
+        Generates ``prompt`` starting from its prefix's cached past key values.
+        Returns ``(sequences, generated_tokens)``, or None when the prompt's
+        ids do not start with the prefix's (the caller falls back to the pipeline).
+        """
+        import torch
+
+        ids = self.fragments.encode(prompt)
+        prefix_ids, past = self.prefix_cache.session(prompt.prefix)
+        if len(ids) <= len(prefix_ids) or tuple(ids[:len(prefix_ids)]) != prefix_ids:
+            return None
+
+        input_ids = torch.tensor([ids])
+        generate_options = {name: value for name, value in options.items() if name not in self.PIPELINE_OPTIONS}
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=past,
+                pad_token_id=self.tokenizer.pad_token_id, **generate_options,
+            )
+        generated = output[0, len(ids):]
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        return [{'generated_text': prompt + text}], len(generated)
+
+    def stats(self):
+        stats = {**super().stats(), **self.fragments.stats()}
+        if self.prefix_cache is not None:
+            stats.update(self.prefix_cache.stats())
+        return stats
+
+
+class OpenAIBackend(GenerationBackend):
+    """
+    A remote OpenAI-compatible completions endpoint (OpenAI, vLLM, llama.cpp
+    server, ...). One client, and with it one pool of keep-alive HTTP
+    connections, is shared by every thread of the process. A batch of
+    prompts is sent as a single request.
+    """
+
+    name = 'openai'
+
+    def __init__(self, model, client, remote_model):
+        super().__init__(model)
+        self.client = client
+        self.remote_model = remote_model
+
+    def generate(self, prompts, **options):
+        max_tokens = options.get('max_new_tokens') or options.get('max_length') or 200
+        count = options.get('num_return_sequences', 1)
+        response = self.client.completions.create(
+            model=self.remote_model, prompt=prompts, max_tokens=max_tokens, n=count,
+            temperature=options.get('temperature', 1.0),
+        )
+        results = [[] for _ in prompts]
+        for choice in sorted(response.choices, key=lambda choice: choice.index):
+            prompt_index = choice.index // count
+            results[prompt_index].append({'generated_text': prompts[prompt_index] + choice.text})
+        usage = getattr(response, 'usage', None)
+        tokens = usage.completion_tokens if usage is not None else self.count_generated(prompts, results)
+        return results, tokens
+
+
+def _config():
+    return settings.TEXT_GENERATION
+
+
+def _load_transformers(model, quantize=False):
+    from transformers import pipeline
+
+    prefix_config = _config()['PREFIX_CACHE']
+    generator = pipeline('text-generation', model=model)
+    backend = PipelineBackend(model, generator, prefix_config['MAX_FRAGMENTS'])
+    if quantize:
+        import torch
+
+        # Dynamic quantization covers nn.Linear layers; GPT-2 style models
+        # keep their attention and MLP in Conv1D, so there it mainly shrinks
+        # the LM head, which is the largest matmul of each decoding step.
+        generator.model = torch.quantization.quantize_dynamic(generator.model, {torch.nn.Linear}, dtype=torch.qint8)
+        backend.name = 'transformers-int8'
+    if prefix_config['ENABLED']:
+        backend.enable_prefix_cache(prefix_config['MAX_PREFIXES'])
+    return backend
+
+
+def _load_onnx(model, quantize=False):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError as exc:
+        raise ImportError(
+            "The onnx and onnx-int8 backends need optimum and onnxruntime (see requirements.txt): "
+            "pip install 'optimum[onnxruntime]'"
+        ) from exc
+    from transformers import AutoTokenizer, pipeline
+
+    export_dir = _config()['ONNX_DIR'] / model.replace('/', '--')
+    if not (export_dir / 'model.onnx').exists():
+        ORTModelForCausalLM.from_pretrained(model, export=True).save_pretrained(export_dir)
+        AutoTokenizer.from_pretrained(model).save_pretrained(export_dir)
+
+    model_dir, file_name = export_dir, 'model.onnx'
+    if quantize:
+        model_dir, file_name = export_dir / 'int8', 'model_quantized.onnx'
+        if not (model_dir / file_name).exists():
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name='model.onnx')
+            config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=model_dir, quantization_config=config)
+            AutoTokenizer.from_pretrained(export_dir).save_pretrained(model_dir)
+
+    ort_model = ORTModelForCausalLM.from_pretrained(model_dir, file_name=file_name, provider='CPUExecutionProvider')
+    generator = pipeline('text-generation', model=ort_model, tokenizer=AutoTokenizer.from_pretrained(model_dir))
+    backend = PipelineBackend(model, generator)
+    backend.name = 'onnx-int8' if quantize else 'onnx'
+    return backend
+
+
+_openai_clients = {}
+_openai_lock = threading.Lock()
+
+
+def openai_client():
+    """The process-wide client for the configured endpoint, created on first use."""
+    config = _config()['OPENAI']
+    key = (config['BASE_URL'], config['API_KEY'])
+    with _openai_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            import httpx
+            import openai
+
+            client = _openai_clients[key] = openai.OpenAI(
+                base_url=config['BASE_URL'], api_key=config['API_KEY'] or 'unused',
+                timeout=config['TIMEOUT'], max_retries=config['MAX_RETRIES'],
+                http_client=httpx.Client(limits=httpx.Limits(
+                    max_connections=config['MAX_CONNECTIONS'],
+                    max_keepalive_connections=config['MAX_CONNECTIONS'],
+                )),
+            )
+    return client
+
+
+def _load_openai(model):
+    return OpenAIBackend(model, openai_client(), _config()['OPENAI']['MODEL'] or model)
+
+
+LOADERS = {
+    'transformers': lambda model: _load_transformers(model),
+    'transformers-int8': lambda model: _load_transformers(model, quantize=True),
+    'onnx': lambda model: _load_onnx(model),
+    'onnx-int8': lambda model: _load_onnx(model, quantize=True),
+    'openai': _load_openai,
+    'stub': StubBackend,
+}
+
+
+def load_backend(model, backend=None):
+    """Loads ``model`` with the ``backend`` named in settings (or the one given)."""
+    backend = backend or _config()['BACKEND']
+    try:
+        loader = LOADERS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown text-generation backend {backend!r}; choose one of {', '.join(LOADERS)}.")
+    return loader(model)
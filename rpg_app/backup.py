@@ -0,0 +1,307 @@
+"""
+Streaming NDJSON export and import of a user's stories.
+
+An export is one JSON object per line: a ``header``, then the stories in
+chunks of STORY_CHUNK, each chunk followed by its plots, characters,
+settings, chat logs and chat messages. Rows are read with ``values_list``
+iterators and written out as they are read, so memory stays flat however
+long the chat histories are; ``encode`` joins the lines into larger chunks
+and can gzip them on the fly. Django consumes a synchronous iterator in
+full before an ASGI server sends any of it, so there the chunks are handed
+over through ``aiter_chunks``.
+
+``import_stories`` reads an export back for a user with one ``bulk_create``
+per model every ``batch_size`` lines. Besides the current batch it only
+keeps the mapping from exported to new story and chat log ids.
+"""
+import datetime
+import gzip
+import io
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Character, ChatLog, ChatLogArchive, ChatMessage, Plot, Setting, Story, unique_slug
+from .response_cache import bump_user_version
+from .search import index_new_stories
+
+FORMAT = 'rpg-stories'
+VERSION = 1
+STORY_CHUNK = 100
+ROW_CHUNK = 2000
+BATCH_SIZE = 1000
+BUFFER_BYTES = 64 * 1024
+
+# Exported fields per record type, in the order of the export
+FIELDS = {
+    'story': (
+        'id', 'title', 'description', 'last_activity_at', 'summary', 'summary_chat_log_id', 'summary_sequence',
+    ),
+    'plot': ('story_id', 'summary'),
+    'character': ('story_id', 'description'),
+    'setting': ('story_id', 'description'),
+    'chat_log': ('id', 'story_id', 'title', 'timestamp', 'last_sequence', 'version'),
+    'message': ('chat_log_id', 'sequence', 'key', 'sender', 'contents', 'timestamp'),
+}
+PART_MODELS = {'plot': Plot, 'character': Character, 'setting': Setting}
+
+
+class ImportFormatError(ValueError):
+    """The stream is not an export this version can read."""
+
+
+class _Encoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder cuts times to milliseconds; a backup keeps them exact
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def _dumps(record):
+    return json.dumps(record, cls=_Encoder, ensure_ascii=False) + '\n'
+
+
+def _lines(kind, queryset):
+    fields = FIELDS[kind]
+    for row in queryset.values_list(*fields).iterator(chunk_size=ROW_CHUNK):
+        yield _dumps({'type': kind, **dict(zip(fields, row))})
+
+
+def export_lines(user):
+    """Yields the NDJSON lines of ``user``'s export."""
+    yield _dumps({
+        'type': 'header', 'format': FORMAT, 'version': VERSION, 'user': user.get_username(),
+        'exported_at': timezone.now(),
+    })
+    stories = Story.objects.filter(user=user).order_by('pk').values_list(*FIELDS['story'])
+    last_id = 0
+    while True:
+        chunk = list(stories.filter(pk__gt=last_id)[:STORY_CHUNK])
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        story_ids = [row[0] for row in chunk]
+
+        for row in chunk:
+            yield _dumps({'type': 'story', **dict(zip(FIELDS['story'], row))})
+        for kind, model in PART_MODELS.items():
+            yield from _lines(kind, model.objects.filter(story_id__in=story_ids).order_by('pk'))
+        yield from _lines('chat_log', ChatLog.objects.filter(story_id__in=story_ids).order_by('pk'))
+        yield from _lines(
+            'message', ChatMessage.objects.filter(chat_log__story_id__in=story_ids).order_by('chat_log_id', 'sequence'),
+        )
+        # Archived chat logs keep their messages in one blob each, read one at a time
+        archives = ChatLogArchive.objects.filter(chat_log__story_id__in=story_ids).order_by('pk')
+        for archive in archives.iterator(chunk_size=1):
+            for message in archive.messages():
+                yield _dumps({'type': 'message', **{field: getattr(message, field) for field in FIELDS['message']}})
+
+
+def encode(lines, compress=False):
+    """Joins ``lines`` into byte chunks of about BUFFER_BYTES, gzipped if ``compress``."""
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer, size = [], 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= BUFFER_BYTES:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+async def aiter_chunks(chunks):
+    """
+    Yields the chunks of a synchronous iterator such as ``encode(...)`` to an
+    ASGI server as they are produced. Every step runs on the request's sync
+    thread, where the iterator's database cursor lives.
+    """
+    next_chunk = sync_to_async(next)
+    chunks = iter(chunks)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Releases the cursor when the client goes away mid-download
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
+
+
+def read_lines(stream):
+    """Text lines of the binary ``stream`` of an export, gzipped or not."""
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def _datetime(value):
+    return parse_datetime(value) if value else timezone.now()
+
+
+def _create(model, objects):
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects)
+    else:
+        for instance in objects:
+            instance.save()
+
+
+class _Importer:
+    def __init__(self, user, batch_size):
+        self.user = user
+        self.batch_size = batch_size
+        self.story_ids = {}
+        self.chat_log_ids = {}
+        # (new story id, exported chat log id) of stories with a summary
+        self.summaries = []
+        self.counts = dict.fromkeys(FIELDS, 0)
+        self._pending = {kind: [] for kind in FIELDS}
+        self._size = 0
+
+    def add(self, number, record):
+        kind = record.get('type')
+        if kind not in FIELDS:
+            raise ImportFormatError(f"Line {number}: unknown record type {kind!r}.")
+        try:
+            if kind in PART_MODELS:
+                entry = self._part(kind, record)
+            else:
+                entry = getattr(self, f'_{kind}')(record)
+        except (KeyError, TypeError) as exc:
+            raise ImportFormatError(f"Line {number}: malformed {kind} record ({exc!r}).") from exc
+        self._pending[kind].append(entry)
+        self._size += 1
+        if self._size >= self.batch_size:
+            self.flush()
+
+    def _story(self, record):
+        return record['id'], record.get('summary_chat_log_id'), Story(
+            user=self.user, title=record['title'], description=record.get('description', ''),
+            slug=unique_slug(record['title']), last_activity_at=_datetime(record.get('last_activity_at')),
+            summary=record.get('summary', ''), summary_sequence=record.get('summary_sequence', 0),
+        )
+
+    @staticmethod
+    def _part(kind, record):
+        field = FIELDS[kind][1]
+        return record['story_id'], PART_MODELS[kind](**{field: record[field]})
+
+    def _chat_log(self, record):
+        return record['id'], record['story_id'], ChatLog(
+            title=record['title'], timestamp=_datetime(record.get('timestamp')),
+            last_sequence=record.get('last_sequence', 0), version=record.get('version', 0),
+        )
+
+    def _message(self, record):
+        return record['chat_log_id'], ChatMessage(
+            sequence=record['sequence'], key=record.get('key'), sender=record.get('sender', ''),
+            contents=record.get('contents', ''), timestamp=_datetime(record.get('timestamp')),
+        )
+
+    @staticmethod
+    def _resolve(ids, exported_id, kind):
+        try:
+            return ids[exported_id]
+        except KeyError:
+            raise ImportFormatError(f"A record refers to {kind} {exported_id}, which is not earlier in the export.")
+
+    def flush(self):
+        """Writes the pending records, parents first."""
+        pending, self._pending, self._size = self._pending, {kind: [] for kind in FIELDS}, 0
+
+        stories = [story for _, _, story in pending['story']]
+        _create(Story, stories)
+        for exported_id, summary_chat_log_id, story in pending['story']:
+            self.story_ids[exported_id] = story.pk
+            if summary_chat_log_id is not None:
+                self.summaries.append((story.pk, summary_chat_log_id))
+
+        for kind, model in PART_MODELS.items():
+            parts = []
+            for story_id, part in pending[kind]:
+                part.story_id = self._resolve(self.story_ids, story_id, 'story')
+                parts.append(part)
+            model.objects.bulk_create(parts)
+
+        chat_logs = []
+        for _, story_id, chat_log in pending['chat_log']:
+            chat_log.story_id = self._resolve(self.story_ids, story_id, 'story')
+            chat_logs.append(chat_log)
+        timestamps = [chat_log.timestamp for chat_log in chat_logs]
+        _create(ChatLog, chat_logs)
+        for (exported_id, _, chat_log), timestamp in zip(pending['chat_log'], timestamps):
+            self.chat_log_ids[exported_id] = chat_log.pk
+            # auto_now_add overwrote the exported time on insert
+            chat_log.timestamp = timestamp
+        if chat_logs:
+            ChatLog.objects.bulk_update(chat_logs, ['timestamp'])
+
+        messages = []
+        for chat_log_id, message in pending['message']:
+            message.chat_log_id = self._resolve(self.chat_log_ids, chat_log_id, 'chat log')
+            messages.append(message)
+        ChatMessage.objects.bulk_create(messages)
+
+        for kind, records in pending.items():
+            self.counts[kind] += len(records)
+
+    def finish(self):
+        updated = [
+            Story(pk=story_id, summary_chat_log_id=self.chat_log_ids.get(chat_log_id))
+            for story_id, chat_log_id in self.summaries
+        ]
+        Story.objects.bulk_update(updated, ['summary_chat_log_id'], batch_size=self.batch_size)
+        # bulk_create sends no post_save signals; indexing the finished stories
+        # in SQL is much faster than a document object per row
+        story_ids = list(self.story_ids.values())
+        for start in range(0, len(story_ids), STORY_CHUNK):
+            index_new_stories(story_ids[start:start + STORY_CHUNK])
+        bump_user_version(self.user.pk)
+
+
+@transaction.atomic
+def import_stories(user, lines, batch_size=BATCH_SIZE):
+    """
+    Creates the stories of the export ``lines`` (str or bytes) for ``user``
+    and returns the number of records imported per type. Nothing is
+    imported if any line is invalid.
+    """
+    importer = _Importer(user, batch_size)
+    header = None
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            raise ImportFormatError(f"Line {number} is not JSON: {exc}") from exc
+        if header is None:
+            header = record
+            if header.get('type') != 'header' or header.get('format') != FORMAT:
+                raise ImportFormatError("Not a story export: the first line must be its header.")
+            if header.get('version', 0) > VERSION:
+                raise ImportFormatError(f"Export version {header['version']} is newer than this server reads.")
+            continue
+        importer.add(number, record)
+    if header is None:
+        raise ImportFormatError("The export is empty.")
+    importer.flush()
+    importer.finish()
+    return importer.counts
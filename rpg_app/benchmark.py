@@ -0,0 +1,306 @@
+"""
+API benchmark harness.
+
+Seeds a dataset, replays every rpg_app route against it with the test client,
+and reports latency percentiles and query counts per scenario. The generator
+is replaced by a deterministic stub so only the web stack is measured. See
+``manage.py benchmark``.
+
+``auth_overhead`` times the authentication schemes on their own; see
+``manage.py benchmark_auth``.
+"""
+import base64
+import json
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+from django.utils import timezone
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import search
+from .authentication import CachedJWTAuthentication
+from .backends import stub_generator
+from .models import Character, ChatLog, ChatMessage, Plot, Setting, Story
+from .response_cache import bump_user_version
+from .utils import generators
+
+# Dataset sizes. The benchmarked user owns ``stories`` stories with
+# ``chat_logs`` logs of ``messages`` messages each; ``users`` other users own
+# ``background_stories`` small stories apiece so tables are not trivially small.
+PROFILES = {
+    'smoke': {
+        'users': 20, 'background_stories': 2, 'stories': 10, 'chat_logs': 3, 'messages': 40, 'iterations': 5,
+    },
+    'full': {
+        'users': 2000, 'background_stories': 3, 'stories': 100, 'chat_logs': 5, 'messages': 400, 'iterations': 20,
+    },
+}
+
+LOCMEM_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'benchmark-{alias}'}
+    for alias in settings.CACHES
+}
+
+
+@contextmanager
+def test_database():
+    """Runs the body against a throwaway test database."""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def _story_rows(user, count, prefix):
+    return [
+        Story(
+            title=f'{prefix} {index}', slug=f'{prefix.lower()}-{user.pk}-{index}',
+            description='A benchmark story', user=user,
+        )
+        for index in range(count)
+    ]
+
+
+def seed(profile):
+    """Creates the dataset for ``profile`` and returns the benchmarked user."""
+    password = make_password(None)
+    User.objects.bulk_create(
+        User(username=f'bench-{index}', email=f'bench-{index}@example.com', password=password)
+        for index in range(profile['users'] + 1)
+    )
+    users = list(User.objects.filter(username__startswith='bench-').order_by('pk'))
+    user, others = users[0], users[1:]
+
+    stories = _story_rows(user, profile['stories'], 'Story')
+    for other in others:
+        stories += _story_rows(other, profile['background_stories'], 'Background')
+    Story.objects.bulk_create(stories, batch_size=1000)
+    stories = list(Story.objects.filter(user__in=users).order_by('pk'))
+
+    Character.objects.bulk_create(
+        (Character(story=story, description=f'Character of {story.title}') for story in stories), batch_size=1000,
+    )
+    Setting.objects.bulk_create(
+        (Setting(story=story, description=f'Setting of {story.title}') for story in stories), batch_size=1000,
+    )
+    Plot.objects.bulk_create(
+        (Plot(story=story, summary=f'Plot of {story.title}') for story in stories), batch_size=1000,
+    )
+
+    own_stories = [story for story in stories if story.user_id == user.pk]
+    ChatLog.objects.bulk_create(
+        (
+            ChatLog(story=story, title=f'{story.title} log {index}', last_sequence=profile['messages'])
+            for story in own_stories for index in range(profile['chat_logs'])
+        ),
+        batch_size=1000,
+    )
+    now = timezone.now()
+    for chat_log in ChatLog.objects.filter(story__user=user).iterator(chunk_size=500):
+        ChatMessage.objects.bulk_create(
+            (
+                ChatMessage(
+                    chat_log=chat_log, sequence=sequence, key=str(sequence),
+                    sender='ai' if sequence % 2 else 'user', contents=f'Message {sequence} ' * 20, timestamp=now,
+                )
+                for sequence in range(1, profile['messages'] + 1)
+            ),
+            batch_size=1000,
+        )
+    # Bulk inserts skip the signals that index single saves
+    search.rebuild_index()
+    return user
+
+
+def _story_spec(index):
+    return {
+        'title': f'Benchmark {index}', 'plot': ['A quest'], 'characters': ['A hero'], 'setting': ['A castle'],
+    }
+
+
+def scenarios(user):
+    """
+    (name, method, url, body factory, cold) for every route. Cold GETs bump
+    the user's data version first, so they miss the response cache and
+    measure the full request.
+    """
+    story = Story.objects.filter(user=user).order_by('pk').first()
+    chat_log = ChatLog.objects.filter(story=story).order_by('pk').first()
+    return [
+        ('stories-list', 'get', '/api/stories/', None, True),
+        ('stories-list-cached', 'get', '/api/stories/', None, False),
+        ('stories-list-sparse', 'get', '/api/stories/?fields=id,title', None, True),
+        ('story-detail', 'get', f'/api/stories/{story.pk}/', None, True),
+        ('story-chat-logs', 'get', f'/api/stories/{story.pk}/chat_logs/', None, True),
+        ('chatlogs-list', 'get', '/api/chatlogs/', None, True),
+        ('chatlogs-list-summary', 'get', '/api/chatlogs/?messages=0', None, True),
+        ('chatlog-detail', 'get', f'/api/chatlogs/{chat_log.pk}/', None, True),
+        ('chatlog-messages', 'get', f'/api/chatlogs/{chat_log.pk}/messages/?after=0&limit=50', None, True),
+        ('characters-list', 'get', '/api/characters/', None, True),
+        ('jobs-list', 'get', '/api/jobs/', None, True),
+        ('search', 'get', '/api/search/?q=message+1', None, True),
+        ('search-story', 'get', f'/api/search/?q=setting&story={story.pk}', None, True),
+        ('chatlog-patch', 'patch', f'/api/chatlogs/{chat_log.pk}/', lambda index: {'message_data': {
+            '1': {'sender': 'user', 'contents': f'Edited {index}'},
+            f'bench-{index}': {'sender': 'user', 'contents': f'Appended {index}'},
+        }}, True),
+        ('chatlog-delta', 'patch', f'/api/chatlogs/{chat_log.pk}/', lambda index: {
+            'version': ChatLog.objects.values_list('version', flat=True).get(pk=chat_log.pk),
+            'append': [{'sender': 'user', 'contents': f'Delta {index}'}],
+            'edit': [{'sequence': 2, 'contents': f'Edited {index}'}],
+        }, True),
+        ('chatlog-append', 'post', f'/api/chatlogs/{chat_log.pk}/messages/', lambda index: {
+            'sender': 'user', 'contents': f'Appended {index}',
+        }, True),
+        ('chatlog-continue', 'post', f'/api/chatlogs/{chat_log.pk}/continue/', lambda index: {
+            'sender': 'user', 'contents': f'Player turn {index}',
+        }, True),
+        ('create', 'post', '/api/create/?cache=0', _story_spec, True),
+        ('create-batch', 'post', '/api/create/batch/', lambda index: {
+            'stories': [_story_spec(f'{index}-{offset}') for offset in range(10)],
+        }, True),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(client, user, method, url, body, cold, iterations):
+    latencies, query_counts = [], []
+    for index in range(iterations):
+        if cold:
+            bump_user_version(user.pk)
+        data = body(index) if body else None
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data, format='json')
+            latencies.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method.upper()} {url} returned {response.status_code}: {response.content[:200]!r}')
+        query_counts.append(len(queries.captured_queries))
+    return {
+        'queries': max(query_counts),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.9) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+    }
+
+
+def run(profile_name, iterations=None):
+    """Seeds the ``profile_name`` dataset and benchmarks every scenario against it."""
+    profile = PROFILES[profile_name]
+    iterations = iterations or profile['iterations']
+    text_generation = {
+        **settings.TEXT_GENERATION, 'BATCHING': False,
+        'CACHE': {**settings.TEXT_GENERATION['CACHE'], 'ENABLED': False},
+    }
+    generation_jobs = {**settings.GENERATION_JOBS, 'IN_PROCESS_WORKERS': 0}
+    generation_limits = {**settings.GENERATION_LIMITS, 'RATE': 0}
+    request_metrics = {**settings.REQUEST_METRICS, 'SLOW_REQUEST_SAMPLE_RATE': 0}
+    with override_settings(
+        CACHES=LOCMEM_CACHES, TEXT_GENERATION=text_generation, GENERATION_JOBS=generation_jobs,
+        REQUEST_METRICS=request_metrics, GENERATION_LIMITS=generation_limits,
+    ):
+        user = seed(profile)
+        generators.set(generators.default_model(), stub_generator)
+        try:
+            client = APIClient()
+            client.force_authenticate(user)
+            results = {
+                name: measure(client, user, method, url, body, cold, iterations)
+                for name, method, url, body, cold in scenarios(user)
+            }
+        finally:
+            generators.clear()
+    return {'profile': profile_name, 'iterations': iterations, 'dataset': profile, 'results': results}
+
+
+def compare(report, baseline, tolerance=0.5, slack_ms=2.0):
+    """
+    Returns a list of regressions of ``report`` against ``baseline``: any
+    extra query, or a p50/p90 latency more than ``tolerance`` (a fraction)
+    plus ``slack_ms`` above the baseline.
+    """
+    regressions = []
+    for name, expected in baseline['results'].items():
+        actual = report['results'].get(name)
+        if actual is None:
+            regressions.append(f'{name}: missing from the report')
+            continue
+        if actual['queries'] > expected['queries']:
+            regressions.append(f"{name}: {actual['queries']} queries, baseline {expected['queries']}")
+        for metric in ('p50_ms', 'p90_ms'):
+            limit = expected[metric] * (1 + tolerance) + slack_ms
+            if actual[metric] > limit:
+                regressions.append(f'{name}: {metric} {actual[metric]:.2f}, baseline {expected[metric]:.2f}')
+    return regressions
+
+
+def load(path):
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+def save(report, path):
+    with open(path, 'w') as baseline:
+        json.dump(report, baseline, indent=2, sort_keys=True)
+        baseline.write('\n')
+
+
+def _time_authentication(authenticator, header, iterations):
+    factory = APIRequestFactory()
+    latencies, query_counts = [], []
+    for _ in range(iterations):
+        request = Request(factory.get('/api/stories/', HTTP_AUTHORIZATION=header))
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            authenticated = authenticator.authenticate(request)
+            latencies.append(time.perf_counter() - started)
+        if authenticated is None:
+            raise RuntimeError(f'{type(authenticator).__name__} did not authenticate the request')
+        query_counts.append(len(queries.captured_queries))
+    return {
+        'queries': statistics.fmean(query_counts),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.9) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+    }
+
+
+def auth_overhead(iterations=20):
+    """
+    Time and queries per request spent authenticating one user with HTTP
+    Basic (a password hash per request), a stock simplejwt access token (a
+    signature check and a user query) and the cached JWT authentication.
+    """
+    password = 'benchmark-password'
+    user = User.objects.create_user('bench-auth', password=password)
+    basic = 'Basic ' + base64.b64encode(f'{user.username}:{password}'.encode()).decode()
+    bearer = f'Bearer {AccessToken.for_user(user)}'
+    with override_settings(CACHES=LOCMEM_CACHES):
+        caches[settings.AUTH_USER_CACHE['ALIAS']].clear()
+        return {
+            'basic': _time_authentication(BasicAuthentication(), basic, iterations),
+            'jwt': _time_authentication(JWTAuthentication(), bearer, iterations),
+            'jwt-cached': _time_authentication(CachedJWTAuthentication(), bearer, iterations),
+        }
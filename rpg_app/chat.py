@@ -0,0 +1,201 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .archive import restore, thaw
+from .models import ChatLog, ChatMessage, Story
+from .response_cache import bump_story_version
+from .search import index_messages
+
+
+def _timestamp(value):
+    if value is None:
+        return timezone.now()
+    if isinstance(value, str):
+        return parse_datetime(value) or timezone.now()
+    return value
+
+
+class VersionConflict(Exception):
+    """The chat log changed since the version the client based its edit on."""
+
+    def __init__(self, version):
+        super().__init__(f'The chat log is at version {version}.')
+        self.version = version
+
+
+# Sequence numbers must fit a PositiveIntegerField on every backend
+MAX_SEQUENCE = 2 ** 31 - 1
+
+
+def _numeric_keys(entries):
+    """Legacy keys of ``entries`` that a keyless message's sequence could take."""
+    return [
+        int(key) for key in (entry.get('key') for entry in entries)
+        if key is not None and key.isdigit() and 0 < int(key) <= MAX_SEQUENCE
+    ]
+
+
+def _bump_version(chat_log_id, appended=0, expected_version=None, reserve_past=0):
+    """
+    Bumps the log's version and reserves ``appended`` sequence numbers,
+    returning ``(first reserved sequence, new version)``. With
+    ``expected_version`` the update only applies if the log is still at that
+    version, otherwise VersionConflict is raised. The reserved sequences
+    start after ``reserve_past``, so no keyless message is ever numbered
+    like a numeric legacy key.
+
+    Must run inside a transaction: the UPDATE takes the row (PostgreSQL) or
+    database (SQLite) write lock, which serializes concurrent writers to the
+    same log. An archived log gets its message rows back first.
+    """
+    queryset = ChatLog.objects.filter(pk=chat_log_id)
+    if expected_version is not None:
+        queryset = queryset.filter(version=expected_version)
+    last = Greatest(F('last_sequence'), Value(reserve_past)) if reserve_past else F('last_sequence')
+    updated = queryset.update(last_sequence=last + appended, version=F('version') + 1)
+    last_sequence, version, archived = (
+        ChatLog.objects.filter(pk=chat_log_id).values_list('last_sequence', 'version', 'archived').get()
+    )
+    if not updated:
+        raise VersionConflict(version)
+    if archived:
+        restore(chat_log_id)
+    return last_sequence - appended + 1, version
+
+
+def _create_messages(chat_log_id, first, entries):
+    numeric_keys = _numeric_keys(entries)
+    if numeric_keys and ChatMessage.objects.filter(
+        chat_log_id=chat_log_id, key=None, sequence__in=numeric_keys,
+    ).exists():
+        # Rendered under the same legacy key, one would hide the other
+        raise IntegrityError('A keyless message already has the sequence of a new numeric key.')
+    messages = [
+        ChatMessage(
+            chat_log_id=chat_log_id,
+            sequence=first + offset,
+            key=entry.get('key'),
+            sender=entry.get('sender', ''),
+            contents=entry.get('contents', ''),
+            timestamp=_timestamp(entry.get('timestamp')),
+        )
+        for offset, entry in enumerate(entries)
+    ]
+    ChatMessage.objects.bulk_create(messages)
+    return messages
+
+
+def append_messages(chat_log, entries):
+    """
+    Appends messages to a chat log without reading the existing ones.
+
+    ``entries`` are dicts with ``sender``, ``contents`` and optionally
+    ``timestamp`` and a legacy ``key``. Returns the created ChatMessages.
+    """
+    if not entries:
+        return []
+
+    with transaction.atomic():
+        first, version = _bump_version(
+            chat_log.pk, appended=len(entries), reserve_past=max(_numeric_keys(entries), default=0),
+        )
+        messages = _create_messages(chat_log.pk, first, entries)
+        index_messages(messages, chat_log.story_id)
+        Story.record_activity(chat_log.story_id)
+        bump_story_version(chat_log.story_id)
+    chat_log.last_sequence = first + len(entries) - 1
+    chat_log.archived = False
+    chat_log.version = version
+    return messages
+
+
+def apply_delta(chat_log, version, append=(), edit=()):
+    """
+    Applies a delta to a chat log if it is still at ``version``: ``append``
+    entries are added after the last message, ``edit`` entries (with a
+    ``sequence``) replace the sender and/or contents of existing messages.
+
+    Returns ``(new version, appended messages, edited messages)``. Raises
+    VersionConflict on a stale version and ChatMessage.DoesNotExist for an
+    edit of a missing message; neither leaves any change behind.
+    """
+    with transaction.atomic():
+        first, new_version = _bump_version(
+            chat_log.pk, appended=len(append), expected_version=version,
+            reserve_past=max(_numeric_keys(append), default=0),
+        )
+
+        edited = []
+        if edit:
+            messages = ChatMessage.objects.filter(chat_log=chat_log, sequence__in=[entry['sequence'] for entry in edit])
+            by_sequence = {message.sequence: message for message in messages}
+            for entry in edit:
+                message = by_sequence.get(entry['sequence'])
+                if message is None:
+                    raise ChatMessage.DoesNotExist(f"No message with sequence {entry['sequence']}.")
+                message.sender = entry.get('sender', message.sender)
+                message.contents = entry.get('contents', message.contents)
+                edited.append(message)
+            ChatMessage.objects.bulk_update(edited, ['sender', 'contents'])
+
+        appended = _create_messages(chat_log.pk, first, append)
+        index_messages(edited + appended, chat_log.story_id)
+        Story.record_activity(chat_log.story_id)
+        bump_story_version(chat_log.story_id)
+
+    chat_log.last_sequence = first + len(append) - 1
+    chat_log.version = new_version
+    chat_log.archived = False
+    return new_version, appended, edited
+
+
+def merge_message_data(chat_log, message_data):
+    """
+    Applies a legacy ``message_data`` dict: entries whose key already exists
+    replace that message, all others are appended under their key.
+    """
+    with transaction.atomic():
+        thaw(chat_log)
+        existing = {
+            message.legacy_key: message
+            for message in ChatMessage.objects.filter(chat_log=chat_log, key__in=list(message_data))
+        }
+        numeric_keys = [int(key) for key in message_data if key.isdigit()]
+        if numeric_keys:
+            existing.update(
+                (message.legacy_key, message)
+                for message in ChatMessage.objects.filter(chat_log=chat_log, key=None, sequence__in=numeric_keys)
+            )
+
+        new_entries = []
+        for key, entry in message_data.items():
+            entry = entry if isinstance(entry, dict) else {'contents': entry}
+            message = existing.get(key)
+            if message is None:
+                new_entries.append({**entry, 'key': key})
+                continue
+            message.sender = entry.get('sender', message.sender)
+            message.contents = entry.get('contents', message.contents)
+            message.timestamp = _timestamp(entry.get('timestamp', message.timestamp))
+            message.save(update_fields=['sender', 'contents', 'timestamp'])
+
+        if new_entries:
+            append_messages(chat_log, new_entries)
+        else:
+            _bump_version(chat_log.pk)
+            Story.record_activity(chat_log.story_id)
+
+
+def render_message_data(messages):
+    """Renders messages in the legacy ``{key: {timestamp, sender, contents}}`` shape."""
+    return {
+        message.legacy_key: {
+            'timestamp': message.timestamp.isoformat().replace('+00:00', 'Z'),
+            'sender': message.sender,
+            'contents': message.contents,
+        }
+        for message in sorted(messages, key=lambda message: message.sequence)
+    }
@@ -0,0 +1,219 @@
+"""
+Prompt assembly for continuing a chat within a token budget.
+
+A continuation prompt is made of the story's metadata, its rolling summary
+and as many of the chat log's most recent messages as fit. Messages that
+fall out of that window are folded into ``Story.summary`` by the model
+before they are dropped, a chunk at a time, so the prompt (and the time
+spent generating from it) stays bounded however long the campaign runs.
+"""
+import re
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .archive import thaw
+from .chat import append_messages
+from .models import Story
+from .stories import describe
+from .utils import generators, run_generator
+
+SUMMARY_MARKER = "Summary:"
+REPLY_MARKER = "Narrator:"
+
+_WORDS = re.compile(r"\w+|[^\w\s]")
+
+
+def _config():
+    return settings.TEXT_GENERATION['CONTEXT']
+
+
+class TokenCounter:
+    """
+    Counts and trims tokens with the generator's tokenizer. Generators
+    without one (test stubs) get an estimate of one token per word or
+    punctuation mark, which is close for GPT-2 style tokenizers.
+    """
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def for_generator(cls, generator):
+        return cls(getattr(generator, 'tokenizer', None))
+
+    def count(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return len(_WORDS.findall(text))
+
+    def truncate(self, text, budget):
+        """Keeps the start of ``text`` up to ``budget`` tokens."""
+        if budget <= 0:
+            return ''
+        if self.tokenizer is not None:
+            ids = self.tokenizer.encode(text, add_special_tokens=False)
+            return text if len(ids) <= budget else self.tokenizer.decode(ids[:budget])
+        matches = list(_WORDS.finditer(text))
+        return text if len(matches) <= budget else text[:matches[budget - 1].end()]
+
+    def prompt_budget(self):
+        config = _config()
+        budget = config['MAX_PROMPT_TOKENS']
+        model_max = getattr(self.tokenizer, 'model_max_length', None)
+        if model_max and model_max < 10 ** 6:
+            budget = min(budget, model_max - config['MAX_NEW_TOKENS'])
+        return budget
+
+
+def render_turn(message):
+    speaker = 'Narrator' if message.sender == 'ai' else 'Player'
+    return f"{speaker}: {message.contents.strip()}"
+
+
+def story_header(story, counter, budget):
+    """Story metadata, each field trimmed to its share of ``budget``."""
+    fields = [
+        ('Title', story.title),
+        ('Plot', describe(plot.summary for plot in story.plots.all())),
+        ('Characters', describe(character.description for character in story.characters.all())),
+        ('Setting', describe(setting.description for setting in story.settings.all())),
+    ]
+    share = budget // len(fields)
+    lines = [f"- {name}: {counter.truncate(value, share)}" for name, value in fields if value]
+    return "You are the narrator of a role-playing story.\n" + "\n".join(lines) + "\n"
+
+
+@dataclass
+class ContextWindow:
+    prompt: str
+    prompt_tokens: int
+    # Sequence of the oldest message in the prompt; older ones are only in the summary
+    first_sequence: int
+    # Messages older than the window that the summary does not cover yet
+    unsummarized: int
+
+
+def _summary_start(story, chat_log):
+    """Sequence after which the chat log's messages are not summarized yet."""
+    return story.summary_sequence if story.summary_chat_log_id == chat_log.pk else 0
+
+
+def build_context(story, chat_log, counter=None):
+    """
+    Assembles the continuation prompt for ``chat_log``: header, summary and
+    the newest messages that fit, oldest first, ending with the narrator cue.
+    """
+    counter = counter or TokenCounter.for_generator(generators.get())
+    config = _config()
+    budget = counter.prompt_budget()
+
+    header = story_header(story, counter, config['METADATA_TOKENS'])
+    summary = counter.truncate(story.summary, config['SUMMARY_TOKENS'])
+    if summary:
+        header += f"\nThe story so far: {summary}\n"
+    header += "\n"
+    remaining = budget - counter.count(header) - counter.count(REPLY_MARKER)
+
+    turns = []
+    first_sequence = chat_log.last_sequence + 1
+    recent = chat_log.messages.order_by('-sequence').only('chat_log', 'sequence', 'sender', 'contents')
+    for message in recent[:config['MAX_RECENT_MESSAGES']]:
+        turn = render_turn(message) + "\n"
+        cost = counter.count(turn)
+        if cost > remaining:
+            break
+        turns.append(turn)
+        remaining -= cost
+        first_sequence = message.sequence
+
+    prompt = header + "".join(reversed(turns)) + REPLY_MARKER
+    unsummarized = chat_log.messages.filter(
+        sequence__gt=_summary_start(story, chat_log), sequence__lt=first_sequence,
+    ).count()
+    return ContextWindow(prompt, budget - remaining, first_sequence, unsummarized)
+
+
+def _generated_text(prompt, result):
+    text = result[0]['generated_text']
+    return text[len(prompt):] if text.startswith(prompt) else text
+
+
+def summarize(story, chat_log, before_sequence, counter=None):
+    """
+    Folds the chat log's unsummarized messages older than ``before_sequence``
+    into ``story.summary``, at most SUMMARY_CHUNKS chunks per call so a long
+    backlog is caught up over several turns. Returns whether it changed.
+    """
+    counter = counter or TokenCounter.for_generator(generators.get())
+    config = _config()
+    start = _summary_start(story, chat_log)
+    summary = story.summary
+    through = start
+
+    for _ in range(config['SUMMARY_CHUNKS']):
+        pending = chat_log.messages.filter(sequence__gt=through, sequence__lt=before_sequence).order_by('sequence')
+        prefix = f"Summarize the story so far.\nPrevious summary: {summary or 'none'}\nNew events:\n"
+        remaining = counter.prompt_budget() - counter.count(prefix) - counter.count(SUMMARY_MARKER)
+        turns, last = [], None
+        for message in pending[:config['MAX_RECENT_MESSAGES']]:
+            turn = render_turn(message) + "\n"
+            cost = counter.count(turn)
+            if cost > remaining:
+                if turns:
+                    break
+                # A single message longer than the whole budget is summarized from its start
+                turn = counter.truncate(turn, remaining) + "\n"
+                cost = remaining
+            turns.append(turn)
+            remaining -= cost
+            last = message.sequence
+        if last is None:
+            break
+        prompt = prefix + "".join(turns) + SUMMARY_MARKER
+        result = run_generator(prompt, **summary_options())
+        summary = counter.truncate(_generated_text(prompt, result).strip(), config['SUMMARY_TOKENS'])
+        through = last
+
+    if through == start:
+        return False
+    # Another request may have summarized concurrently; keep whichever landed first
+    updated = Story.objects.filter(
+        pk=story.pk, summary_chat_log=story.summary_chat_log_id, summary_sequence=story.summary_sequence,
+    ).update(summary=summary, summary_chat_log=chat_log.pk, summary_sequence=through)
+    if updated:
+        story.summary, story.summary_chat_log_id, story.summary_sequence = summary, chat_log.pk, through
+    return bool(updated)
+
+
+def summary_options():
+    return {'max_new_tokens': _config()['SUMMARY_TOKENS'], 'num_return_sequences': 1, 'truncation': True}
+
+
+def continuation_options():
+    return {'max_new_tokens': _config()['MAX_NEW_TOKENS'], 'num_return_sequences': 1, 'truncation': True}
+
+
+def continue_chat(chat_log):
+    """
+    Generates the narrator's next message in ``chat_log`` and appends it.
+
+    Returns ``(message, window)``; ``window`` describes the prompt used.
+    """
+    thaw(chat_log)
+    story = Story.objects.prefetch_related('plots', 'characters', 'settings').get(pk=chat_log.story_id)
+    counter = TokenCounter.for_generator(generators.get())
+
+    window = build_context(story, chat_log, counter)
+    if window.unsummarized:
+        summarize(story, chat_log, window.first_sequence, counter)
+        window = build_context(story, chat_log, counter)
+
+    result = run_generator(window.prompt, **continuation_options())
+    reply = _generated_text(window.prompt, result).strip()
+    # Stop where the model starts writing the player's next turn
+    reply = reply.split("\nPlayer:")[0].strip()
+
+    message, = append_messages(chat_log, [{'sender': 'ai', 'contents': reply}])
+    return message, window
+
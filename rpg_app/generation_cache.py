@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+def normalize_prompt(prompt):
+    """Canonical form of a prompt: NFC unicode with runs of whitespace collapsed."""
+    return " ".join(unicodedata.normalize('NFC', prompt).split())
+
+
+def cache_key(model, prompt, options):
+    material = json.dumps(
+        {'model': model, 'prompt': normalize_prompt(prompt), 'options': options},
+        sort_keys=True, separators=(',', ':'),
+    )
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class GenerationCache:
+    """
+    Two-tier cache of generated text keyed by a hash of the normalized prompt
+    and generation parameters.
+
+    The first tier is a per-process LRU dict with a TTL; the second is a
+    Django cache alias (file or database backed) shared between processes and
+    restarts. Hits in the second tier are promoted into the first.
+    """
+
+    def __init__(self, max_entries=512, ttl=24 * 60 * 60, alias=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.alias = alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _persistent(self):
+        return caches[self.alias] if self.alias else None
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return value
+                del self._entries[key]
+
+        persistent = self._persistent()
+        value = persistent.get(key) if persistent is not None else None
+        if value is None:
+            self._count('misses')
+            return None
+
+        self._count('persistent_hits')
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        persistent = self._persistent()
+        if persistent is not None:
+            persistent.set(key, value, self.ttl)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for counter in self._counters:
+                self._counters[counter] = 0
+        persistent = self._persistent()
+        if persistent is not None:
+            persistent.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, entries=len(self._entries))
+        lookups = stats['memory_hits'] + stats['persistent_hits'] + stats['misses']
+        stats['hit_ratio'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+        return stats
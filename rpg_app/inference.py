@@ -0,0 +1,129 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from servercheck.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Request:
+    __slots__ = ('prompt', 'options', 'future', 'enqueued_at')
+
+    def __init__(self, prompt, options):
+        self.prompt = prompt
+        self.options = options
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchingInferenceService:
+    """
+    Collects concurrent generation requests into micro-batches and runs a
+    single generator call per batch on a dedicated worker thread.
+
+    A batch is closed when it reaches ``max_batch_size`` or when the oldest
+    request has waited ``max_wait`` seconds. Only requests with identical
+    generation options are batched together.
+    """
+
+    def __init__(self, registry, max_batch_size=8, max_wait=0.02):
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.batch_latency = Histogram(LATENCY_BUCKETS)
+        self.request_latency = Histogram(LATENCY_BUCKETS)
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+                self._worker.start()
+
+    def submit(self, prompt, **options):
+        """Queues a prompt and returns a future resolving to its generated sequences."""
+        request = _Request(prompt, options)
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, timeout=None, **options):
+        return self.submit(prompt, **options).result(timeout=timeout)
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _group_key(options):
+        # Option values may be unhashable, e.g. a list of stop sequences
+        return json.dumps(options, sort_keys=True, default=repr)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                groups = {}
+                for request in batch:
+                    groups.setdefault(self._group_key(request.options), []).append(request)
+                for requests in groups.values():
+                    self._run_batch(requests)
+            except Exception as exc:
+                # The thread must outlive any error, or every later request
+                # would wait on a future nobody resolves
+                logger.exception("Inference batch of %d requests failed", len(batch))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(exc)
+
+    def _run_batch(self, requests):
+        options = requests[0].options
+        prompts = [request.prompt for request in requests]
+        started = time.perf_counter()
+        try:
+            generator = self.registry.get()
+            results = generator(prompts, batch_size=len(prompts), **options)
+        except Exception as exc:
+            logger.exception("Inference batch of %d prompts failed", len(prompts))
+            for request in requests:
+                request.future.set_exception(exc)
+            return
+
+        finished = time.perf_counter()
+        self.batch_sizes.observe(len(prompts))
+        self.batch_latency.observe(finished - started)
+        for request, result in zip(requests, results):
+            self.request_latency.observe(finished - request.enqueued_at)
+            request.future.set_result(result)
+
+    def stats(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait': self.max_wait,
+            'queue_depth': self._queue.qsize(),
+            'batch_size': self.batch_sizes.snapshot(),
+            'batch_latency': self.batch_latency.snapshot(),
+            'request_latency': self.request_latency.snapshot(),
+        }
@@ -0,0 +1,201 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import GenerationJob
+from .utils import create_opening_chat_log, generate_initial_prompt
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_opening(story, title, plot, characters, setting, use_cache=True):
+    """Queues generation of a story's opening; the first ChatLog is created when it completes."""
+    return enqueue_openings([(story, title, plot, characters, setting)], use_cache=use_cache)[0]
+
+
+def enqueue_openings(openings, use_cache=True):
+    """Queues several openings, given as (story, title, plot, characters, setting) tuples, in one INSERT."""
+    jobs = GenerationJob.objects.bulk_create([
+        GenerationJob(
+            story=story,
+            payload={
+                'title': title, 'plot': plot, 'characters': characters, 'setting': setting, 'use_cache': use_cache,
+            },
+            max_attempts=settings.GENERATION_JOBS['MAX_ATTEMPTS'],
+        )
+        for story, title, plot, characters, setting in openings
+    ])
+    if settings.GENERATION_JOBS['IN_PROCESS_WORKERS']:
+        transaction.on_commit(in_process_worker.wake)
+    return jobs
+
+
+def claim_next_job():
+    """
+    Atomically moves the oldest due job to ``running`` and returns it.
+
+    Jobs left ``running`` longer than STALE_AFTER seconds (e.g. by a worker
+    that died) become claimable again, until they have used up their
+    attempts; then they fail. The conditional UPDATE makes the claim safe
+    across threads and processes without row locks, which SQLite lacks.
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.GENERATION_JOBS['STALE_AFTER'])
+    stale = GenerationJob.objects.filter(status=GenerationJob.RUNNING, started_at__lt=stale_before)
+    # A job that keeps taking its worker down must not be retried forever
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status=GenerationJob.FAILED, error='The job did not finish within its attempts.', updated_at=now,
+    )
+    candidates = GenerationJob.objects.filter(
+        Q(status=GenerationJob.PENDING, available_at__lte=now)
+        | Q(status=GenerationJob.RUNNING, started_at__lt=stale_before, attempts__lt=F('max_attempts'))
+    )
+
+    for job in candidates.order_by('available_at', 'pk')[:10]:
+        claimed = GenerationJob.objects.filter(pk=job.pk, status=job.status, started_at=job.started_at).update(
+            status=GenerationJob.RUNNING, started_at=now, attempts=job.attempts + 1, updated_at=now,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def _finish(job, **fields):
+    """
+    Records the outcome of a claim, unless the job was reclaimed since (it
+    ran past STALE_AFTER) and now belongs to another worker. Returns whether
+    it was recorded.
+    """
+    now = timezone.now()
+    recorded = GenerationJob.objects.filter(
+        pk=job.pk, status=GenerationJob.RUNNING, started_at=job.started_at,
+    ).update(updated_at=now, **fields)
+    if recorded:
+        for name, value in {**fields, 'updated_at': now}.items():
+            setattr(job, name, value)
+    return bool(recorded)
+
+
+def run_job(job):
+    payload = job.payload
+    try:
+        text = generate_initial_prompt(
+            payload['title'], payload['plot'], payload['characters'], payload['setting'],
+            use_cache=payload.get('use_cache', True),
+        )
+    except Exception as exc:
+        logger.exception("Generation job %s failed (attempt %d/%d)", job.pk, job.attempts, job.max_attempts)
+        if job.attempts < job.max_attempts:
+            backoff = settings.GENERATION_JOBS['RETRY_BACKOFF'] * 2 ** (job.attempts - 1)
+            _finish(
+                job, status=GenerationJob.PENDING, error=str(exc),
+                available_at=timezone.now() + timedelta(seconds=backoff),
+            )
+        else:
+            _finish(job, status=GenerationJob.FAILED, error=str(exc))
+        return job
+
+    with transaction.atomic():
+        # Marking the job first takes the write lock, so of two workers
+        # holding the same job only the current claim creates the opening
+        if not _finish(job, status=GenerationJob.SUCCEEDED, result=text, error=''):
+            logger.warning("Generation job %s was reclaimed by another worker; dropping its result", job.pk)
+            return job
+        if not job.story.chat_logs.exists():
+            job.chat_log = create_opening_chat_log(job.story, payload['title'], text)
+            GenerationJob.objects.filter(pk=job.pk).update(chat_log=job.chat_log)
+    return job
+
+
+def run_pending_jobs(limit=None):
+    """Runs due jobs one after another until the queue is empty; returns how many ran."""
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        processed += 1
+    return processed
+
+
+class JobWorkerPool:
+    """
+    Runs generation jobs on ``concurrency`` threads. Threads sleep for
+    ``poll_interval`` seconds when the queue is empty unless woken up.
+    """
+
+    def __init__(self, concurrency=1, poll_interval=1.0):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._wake = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.concurrency:
+                thread = threading.Thread(target=self._run, name=f'generation-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self.start()
+        with self._wake:
+            self._wake.notify()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                job = claim_next_job()
+                if job is not None:
+                    run_job(job)
+                    continue
+            except Exception:
+                logger.exception("Generation worker crashed while processing the queue")
+            with self._wake:
+                self._wake.wait(self.poll_interval)
+        close_old_connections()
+
+
+in_process_worker = JobWorkerPool(
+    concurrency=settings.GENERATION_JOBS['IN_PROCESS_WORKERS'] or 1,
+    poll_interval=settings.GENERATION_JOBS['POLL_INTERVAL'],
+)
+
+
+_START_UID = 'rpg_app.jobs.start_workers'
+
+
+def _start_in_process_workers(**kwargs):
+    request_started.disconnect(dispatch_uid=_START_UID)
+    if settings.GENERATION_JOBS['IN_PROCESS_WORKERS']:
+        # Picks up jobs left pending or running by a previous process
+        in_process_worker.wake()
+
+
+def start_workers_on_first_request():
+    """
+    Starts the in-process workers with the first request a process serves,
+    rather than the first job it enqueues. Waiting for a request keeps
+    threads out of management commands and out of a preforking server's
+    master process.
+    """
+    request_started.connect(_start_in_process_workers, dispatch_uid=_START_UID)
@@ -0,0 +1,59 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rpg_app import benchmark
+
+BASELINE_DIR = Path(benchmark.__file__).resolve().parent / 'benchmarks'
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the rpg_app API against a seeded dataset in a throwaway "
+        "test database and compares the results with a saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=sorted(benchmark.PROFILES), default='smoke', help="Dataset size.")
+        parser.add_argument('--iterations', type=int, help="Requests per scenario (default: the profile's).")
+        parser.add_argument(
+            '--baseline', type=Path,
+            help="Baseline JSON file (default: rpg_app/benchmarks/<profile>.json).",
+        )
+        parser.add_argument('--save', action='store_true', help="Write the results as the new baseline.")
+        parser.add_argument(
+            '--tolerance', type=float, default=0.5,
+            help="Allowed latency increase over the baseline, as a fraction.",
+        )
+
+    def handle(self, *args, **options):
+        baseline_path = options['baseline'] or BASELINE_DIR / f"{options['profile']}.json"
+
+        with benchmark.test_database():
+            report = benchmark.run(options['profile'], options['iterations'])
+
+        self.write_report(report)
+
+        if options['save']:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            benchmark.save(report, baseline_path)
+            self.stdout.write(f"Saved baseline to {baseline_path}")
+            return
+
+        if not baseline_path.exists():
+            self.stdout.write(f"No baseline at {baseline_path}; run with --save to create one.")
+            return
+        regressions = benchmark.compare(report, benchmark.load(baseline_path), tolerance=options['tolerance'])
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
+
+    def write_report(self, report):
+        dataset = ', '.join(f'{name}={value}' for name, value in report['dataset'].items())
+        self.stdout.write(f"Profile {report['profile']} ({dataset}), {report['iterations']} iterations per scenario")
+        self.stdout.write(f"{'scenario':<24} {'queries':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+        for name, result in report['results'].items():
+            self.stdout.write(
+                f"{name:<24} {result['queries']:>7} {result['p50_ms']:>9.2f} {result['p90_ms']:>9.2f} "
+                f"{result['p99_ms']:>9.2f} {result['mean_ms']:>9.2f}"
+            )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from rpg_app import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the time and queries each authentication scheme adds to a "
+        "request (HTTP Basic, JWT, JWT with the user cache) in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help="Requests per scheme.")
+
+    def handle(self, *args, **options):
+        with benchmark.test_database():
+            results = benchmark.auth_overhead(options['iterations'])
+
+        self.stdout.write(f"{'scheme':<12} {'queries':>7} {'p50 ms':>9} {'p90 ms':>9} {'mean ms':>9}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<12} {result['queries']:>7.2f} {result['p50_ms']:>9.3f} {result['p90_ms']:>9.3f} "
+                f"{result['mean_ms']:>9.3f}"
+            )
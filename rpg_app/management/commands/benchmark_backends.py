@@ -0,0 +1,109 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rpg_app.backends import LOADERS, load_backend
+from rpg_app.utils import build_opening_prompt, generators
+
+
+def _prompts(count):
+    return [
+        build_opening_prompt(
+            f'Campaign {index}', 'A heist in a floating city', 'A thief and a disgraced knight', 'Skyport at dusk',
+        )
+        for index in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    help = "Measures generation throughput (tokens/sec) and latency of one or more backends on this machine."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backend', action='append', dest='backends', choices=sorted(LOADERS),
+            help="Backend to measure; repeat to compare several (default: the configured one).",
+        )
+        parser.add_argument('--model', default=None, help="Model to load (default: TEXT_GENERATION['MODEL']).")
+        parser.add_argument('--prompts', type=int, default=16, help="Prompts per backend.")
+        parser.add_argument('--batch-size', type=int, default=1, help="Prompts per generator call.")
+        parser.add_argument('--max-new-tokens', type=int, default=64, help="Tokens to generate per prompt.")
+        parser.add_argument(
+            '--prefill', action='store_true',
+            help="Instead, compare single-token generations with and without the template prefix cache.",
+        )
+
+    def handle(self, *args, **options):
+        model = options['model'] or generators.default_model()
+        backends = options['backends'] or [None]
+        prompts = _prompts(options['prompts'])
+        batch_size = options['batch_size']
+        generation_options = {'max_new_tokens': options['max_new_tokens'], 'num_return_sequences': 1}
+        if options['prefill']:
+            return self.compare_prefill(model, backends, prompts)
+
+        self.stdout.write(
+            f"{'backend':<18} {'load s':>8} {'tokens/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'tokens':>8}"
+        )
+        for name in backends:
+            started = time.perf_counter()
+            try:
+                backend = load_backend(model, name)
+            except ImportError as exc:
+                raise CommandError(f"Backend {name or 'default'} is unavailable: {exc}")
+            load_time = time.perf_counter() - started
+
+            # The first call pays for lazy initialisation; keep it out of the numbers
+            backend(prompts[:1], **generation_options)
+            warm = backend.stats()
+
+            latencies = []
+            for offset in range(0, len(prompts), batch_size):
+                batch = prompts[offset:offset + batch_size]
+                call_started = time.perf_counter()
+                backend(batch, batch_size=len(batch), **generation_options)
+                latencies.append(time.perf_counter() - call_started)
+
+            stats = backend.stats()
+            tokens = stats['generated_tokens'] - warm['generated_tokens']
+            seconds = stats['generation_seconds'] - warm['generation_seconds']
+            self.stdout.write(
+                f"{stats['backend']:<18} {load_time:>8.2f} {tokens / seconds if seconds else 0:>10.1f} "
+                f"{statistics.median(latencies) * 1000:>9.1f} "
+                f"{sorted(latencies)[int(0.9 * (len(latencies) - 1))] * 1000:>9.1f} {tokens:>8}"
+            )
+
+    def compare_prefill(self, model, backends, prompts):
+        """
+        Generating a single token is almost all prefill, so the difference
+        between the two runs is the prefill time the prefix cache saves.
+        """
+        self.stdout.write(
+            f"{'backend':<18} {'prefix cache':>12} {'prompt tokens':>13} {'prefilled':>9} {'p50 ms':>9} {'p90 ms':>9}"
+        )
+        for name in backends:
+            try:
+                backend = load_backend(model, name)
+            except ImportError as exc:
+                raise CommandError(f"Backend {name or 'default'} is unavailable: {exc}")
+            if not hasattr(backend, 'enable_prefix_cache'):
+                raise CommandError(f"Backend {backend.name} has no prefix cache.")
+            prompt_tokens = statistics.fmean(len(backend.fragments.encode(prompt)) for prompt in prompts)
+            prefix_tokens = len(backend.fragments.fragment(prompts[0].prefix))
+
+            for enabled in (False, True):
+                backend.prefix_cache = None
+                if enabled:
+                    backend.enable_prefix_cache()
+                backend(prompts[:1], max_new_tokens=1)
+                latencies = []
+                for prompt in prompts:
+                    call_started = time.perf_counter()
+                    backend([prompt], max_new_tokens=1)
+                    latencies.append(time.perf_counter() - call_started)
+                prefilled = prompt_tokens - prefix_tokens if enabled else prompt_tokens
+                self.stdout.write(
+                    f"{backend.name:<18} {'on' if enabled else 'off':>12} {prompt_tokens:>13.1f} {prefilled:>9.1f} "
+                    f"{statistics.median(latencies) * 1000:>9.1f} "
+                    f"{sorted(latencies)[int(0.9 * (len(latencies) - 1))] * 1000:>9.1f}"
+                )
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from rpg_app.archive import compact_idle, storage_report
+
+ROWS = (
+    ('database', "Database in use"),
+    ('messages', "Chat message rows and indexes"),
+    ('archives', "Chat log archives"),
+)
+
+
+def _size(size):
+    if size is None:
+        return 'n/a'
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the messages of chat logs in idle stories into compressed "
+        "archives, and reports storage before and after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle-days', type=int, default=settings.CHAT_ARCHIVE['IDLE_DAYS'],
+            help="Archive chat logs of stories without activity for this many days.",
+        )
+        parser.add_argument('--batch-size', type=int, default=100, help="Chat logs archived between pauses.")
+        parser.add_argument(
+            '--pause', type=float, default=0.05,
+            help="Seconds to sleep between batches, letting other writers in.",
+        )
+        parser.add_argument('--vacuum', action='store_true', help="Return the freed space to the OS (SQLite).")
+
+    def handle(self, *args, **options):
+        before = storage_report()
+        totals = compact_idle(options['idle_days'], options['batch_size'], options['pause'])
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+        after = storage_report()
+
+        ratio = totals['stored_bytes'] / totals['raw_bytes'] if totals['raw_bytes'] else 0
+        self.stdout.write(
+            f"Archived {totals['chat_logs']} chat log(s) holding {totals['messages']} message(s): "
+            f"{_size(totals['raw_bytes'])} of messages stored in {_size(totals['stored_bytes'])} ({ratio:.0%})."
+        )
+        self.stdout.write(f"{'':32}{'before':>14}{'after':>14}")
+        for key, label in ROWS:
+            self.stdout.write(f"{label:32}{_size(before[key]):>14}{_size(after[key]):>14}")
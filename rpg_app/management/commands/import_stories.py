@@ -0,0 +1,36 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from rpg_app.backup import BATCH_SIZE, ImportFormatError, import_stories, read_lines
+
+
+class Command(BaseCommand):
+    help = (
+        "Adds the stories of an NDJSON export (as written by export_stories, "
+        "gzipped or not) to a user's account, in batches of bulk inserts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path', help="Export file, or - for standard input.")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Records inserted per batch.")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['username']!r}.")
+
+        stream = sys.stdin.buffer if options['path'] == '-' else open(options['path'], 'rb')
+        try:
+            counts = import_stories(user, read_lines(stream), batch_size=options['batch_size'])
+        except ImportFormatError as exc:
+            raise CommandError(str(exc))
+        finally:
+            stream.close()
+        self.stdout.write(
+            f"Imported {counts['story']} story(ies), {counts['chat_log']} chat log(s) and "
+            f"{counts['message']} message(s)."
+        )
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rpg_app.models import SearchDocument
+from rpg_app.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Recreates the full-text search index and refills it from every story, "
+        "plot, character, setting and chat message."
+    )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rebuild_index()
+        self.stdout.write(
+            f"Indexed {SearchDocument.objects.count()} document(s) in {time.perf_counter() - started:.2f}s."
+        )
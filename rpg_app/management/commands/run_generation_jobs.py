@@ -0,0 +1,36 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rpg_app.jobs import JobWorkerPool, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Runs queued story-opening generation jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help="Number of worker threads.")
+        parser.add_argument(
+            '--poll-interval', type=float, default=settings.GENERATION_JOBS['POLL_INTERVAL'],
+            help="Seconds to wait between polls of an empty queue.",
+        )
+        parser.add_argument('--once', action='store_true', help="Drain the queue and exit.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            processed = run_pending_jobs()
+            self.stdout.write(f"Processed {processed} job(s).")
+            return
+
+        pool = JobWorkerPool(concurrency=options['concurrency'], poll_interval=options['poll_interval'])
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopped.set())
+
+        pool.start()
+        self.stdout.write(f"Running generation jobs on {options['concurrency']} thread(s).")
+        stopped.wait()
+        self.stdout.write("Stopping, waiting for running jobs to finish...")
+        pool.stop()
@@ -0,0 +1,181 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.urls import get_resolver
+
+from rpg_app.jobs import start_workers_on_first_request
+from rpg_app.utils import generators
+
+
+def _memory_breakdown():
+    """RSS of this process split into pages shared with other processes and private ones, in bytes."""
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                name, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    fields[name] = int(value.split()[0]) * 1024
+    except OSError:
+        return {}
+    return {
+        'rss': fields.get('Rss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def _mib(value):
+    return f"{value / 2 ** 20:.1f} MiB"
+
+
+def _load_application(interface):
+    # Worker threads started in the master would not survive the fork
+    start_workers_on_first_request()
+    if interface == 'asgi':
+        from django.core.asgi import get_asgi_application
+        return get_asgi_application()
+    from django.core.wsgi import get_wsgi_application
+    return get_wsgi_application()
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the site with gunicorn. The application and the generation "
+        "model are loaded once in the master so forked workers share them."
+    )
+
+    def add_arguments(self, parser):
+        config = settings.APP_SERVER
+        parser.add_argument('--bind', default=config['BIND'], help="Address to listen on.")
+        parser.add_argument(
+            '--interface', choices=('wsgi', 'asgi'), default=config['INTERFACE'],
+            help="wsgi runs threaded sync workers, asgi runs uvicorn workers.",
+        )
+        parser.add_argument('--workers', type=int, default=config['WORKERS'], help="Number of worker processes.")
+        parser.add_argument('--threads', type=int, default=config['THREADS'], help="Threads per wsgi worker.")
+        parser.add_argument(
+            '--max-requests', type=int, default=config['MAX_REQUESTS'],
+            help="Gracefully replace a worker after this many requests (0 disables).",
+        )
+        parser.add_argument(
+            '--max-requests-jitter', type=int, default=config['MAX_REQUESTS_JITTER'],
+            help="Random extra requests per worker so they are not all recycled at once.",
+        )
+        parser.add_argument('--timeout', type=int, default=config['TIMEOUT'], help="Seconds before a silent worker is killed.")
+        parser.add_argument(
+            '--graceful-timeout', type=int, default=config['GRACEFUL_TIMEOUT'],
+            help="Seconds a worker gets to finish its requests when recycled or stopped.",
+        )
+        parser.add_argument(
+            '--no-preload-model', dest='preload_model', action='store_false', default=config['PRELOAD_MODEL'],
+            help="Let each worker load the generation model on first use instead.",
+        )
+        parser.add_argument(
+            '--benchmark', action='store_true',
+            help="Report startup time and per-worker memory once every worker has booted, then exit.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise CommandError("gunicorn is not installed.")
+        if options['interface'] == 'asgi':
+            try:
+                import uvicorn.workers  # noqa: F401
+            except ImportError:
+                raise CommandError("uvicorn is required for --interface asgi.")
+
+        started = time.perf_counter()
+        application = _load_application(options['interface'])
+        # Import every view, serializer and model module now rather than on
+        # the first request of each worker.
+        get_resolver().url_patterns
+        app_time = time.perf_counter() - started
+
+        model_time = None
+        if options['preload_model']:
+            model_started = time.perf_counter()
+            generators.warm_up(background=False)
+            model_time = time.perf_counter() - model_started
+
+        # Workers must open their own database connections.
+        connections.close_all()
+
+        master_memory = _memory_breakdown()
+        self.stdout.write(
+            f"Preloaded {options['interface']} app in {app_time:.2f}s"
+            + (f", model {generators.default_model()} in {model_time:.2f}s" if model_time is not None else "")
+            + (f" (master RSS {_mib(master_memory['rss'])})" if master_memory else "")
+        )
+
+        reports = multiprocessing.SimpleQueue() if options['benchmark'] else None
+        gunicorn_options = self.gunicorn_options(options, started, reports)
+
+        class Server(BaseApplication):
+            def load_config(self):
+                for name, value in gunicorn_options.items():
+                    self.cfg.set(name, value)
+
+            def load(self):
+                return application
+
+        Server().run()
+
+    def gunicorn_options(self, options, started, reports):
+        gunicorn_options = {
+            'bind': options['bind'],
+            'workers': options['workers'],
+            'preload_app': True,
+            'max_requests': options['max_requests'],
+            'max_requests_jitter': options['max_requests_jitter'],
+            'timeout': options['timeout'],
+            'graceful_timeout': options['graceful_timeout'],
+            'accesslog': '-',
+        }
+        if options['interface'] == 'asgi':
+            gunicorn_options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+        else:
+            gunicorn_options['worker_class'] = 'gthread'
+            gunicorn_options['threads'] = options['threads']
+
+        if reports is not None:
+            def post_worker_init(worker):
+                reports.put({
+                    'pid': os.getpid(),
+                    'ready': time.perf_counter() - started,
+                    **_memory_breakdown(),
+                })
+
+            def when_ready(server):
+                threading.Thread(
+                    target=self.report_startup, args=(reports, options['workers']), daemon=True,
+                ).start()
+
+            gunicorn_options['post_worker_init'] = post_worker_init
+            gunicorn_options['when_ready'] = when_ready
+        return gunicorn_options
+
+    def report_startup(self, reports, workers):
+        """Collects one report per worker, prints them and stops the server."""
+        rows = sorted((reports.get() for _ in range(workers)), key=lambda row: row['ready'])
+        self.stdout.write(f"{'pid':>8} {'ready':>8} {'rss':>12} {'shared':>12} {'private':>12}")
+        for row in rows:
+            self.stdout.write(
+                f"{row['pid']:>8} {row['ready']:>7.2f}s {_mib(row.get('rss', 0)):>12} "
+                f"{_mib(row.get('shared', 0)):>12} {_mib(row.get('private', 0)):>12}"
+            )
+        private = sum(row.get('private', 0) for row in rows)
+        rss = sum(row.get('rss', 0) for row in rows)
+        self.stdout.write(
+            f"All {workers} worker(s) ready in {rows[-1]['ready']:.2f}s; "
+            f"{_mib(private)} private of {_mib(rss)} total worker RSS."
+        )
+        os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,56 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:24
+#
+# Migrations 0002-0008 were applied to existing databases but never committed.
+# This squashed migration reproduces their end state so fresh databases (and
+# the test database) match the models; databases that already recorded the
+# original migrations treat it as applied.
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    replaces = [
+        ('rpg_app', '0002_chatlog'),
+        ('rpg_app', '0003_chatlog_title'),
+        ('rpg_app', '0004_chatlog_slug_story_slug'),
+        ('rpg_app', '0005_remove_chatlog_content_remove_chatlog_slug_and_more'),
+        ('rpg_app', '0006_alter_chatlog_message_data'),
+        ('rpg_app', '0007_alter_chatlog_message_data'),
+        ('rpg_app', '0008_remove_character_name_remove_plot_title_and_more'),
+    ]
+
+    dependencies = [
+        ('rpg_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='character',
+            name='name',
+        ),
+        migrations.RemoveField(
+            model_name='plot',
+            name='title',
+        ),
+        migrations.RemoveField(
+            model_name='setting',
+            name='name',
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='slug',
+            field=models.SlugField(blank=True, editable=False, max_length=200, unique=True),
+        ),
+        migrations.CreateModel(
+            name='ChatLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('message_data', models.JSONField(blank=True, default=dict, null=True)),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_logs', to='rpg_app.story')),
+            ],
+        ),
+    ]
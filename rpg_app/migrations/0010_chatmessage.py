@@ -0,0 +1,40 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:28
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0009_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatlog',
+            name='last_sequence',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('key', models.CharField(blank=True, max_length=64, null=True)),
+                ('sender', models.CharField(max_length=32)),
+                ('contents', models.TextField(blank=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat_log', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='rpg_app.chatlog')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('chat_log', 'sequence'), name='rpg_app_chatmessage_log_seq_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('chat_log', 'key'), name='rpg_app_chatmessage_log_key_uniq'),
+        ),
+    ]
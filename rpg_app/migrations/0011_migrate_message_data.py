@@ -0,0 +1,75 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:28
+
+from django.db import migrations
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+# Sequence numbers must fit a PositiveIntegerField on every backend
+MAX_SEQUENCE = 2 ** 31 - 1
+
+
+def _ordered_items(message_data):
+    items = list(message_data.items())
+    if all(key.isdigit() for key, _ in items):
+        items.sort(key=lambda item: int(item[0]))
+    return items
+
+
+def _timestamp(value):
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    return parsed or timezone.now()
+
+
+def forwards(apps, schema_editor):
+    ChatLog = apps.get_model('rpg_app', 'ChatLog')
+    ChatMessage = apps.get_model('rpg_app', 'ChatMessage')
+
+    for chat_log in ChatLog.objects.exclude(message_data=None).iterator(chunk_size=200):
+        if not isinstance(chat_log.message_data, dict):
+            continue
+
+        messages = []
+        for sequence, (key, entry) in enumerate(_ordered_items(chat_log.message_data), start=1):
+            entry = entry if isinstance(entry, dict) else {'contents': entry}
+            messages.append(ChatMessage(
+                chat_log_id=chat_log.pk,
+                sequence=sequence,
+                key=key,
+                sender=str(entry.get('sender', ''))[:32],
+                contents=str(entry.get('contents', '')),
+                timestamp=_timestamp(entry.get('timestamp')),
+            ))
+        ChatMessage.objects.bulk_create(messages, batch_size=500)
+
+        # New messages are keyed by their sequence number, so start numbering
+        # after any small numeric legacy key ("0", "1", ...) to keep keys unique.
+        numeric_keys = [int(message.key) for message in messages if message.key.isdigit()]
+        last_sequence = max([len(messages)] + [key for key in numeric_keys if key < MAX_SEQUENCE])
+        ChatLog.objects.filter(pk=chat_log.pk).update(last_sequence=last_sequence)
+
+
+def backwards(apps, schema_editor):
+    ChatLog = apps.get_model('rpg_app', 'ChatLog')
+    ChatMessage = apps.get_model('rpg_app', 'ChatMessage')
+
+    for chat_log in ChatLog.objects.iterator(chunk_size=200):
+        message_data = {}
+        for message in ChatMessage.objects.filter(chat_log_id=chat_log.pk).order_by('sequence'):
+            key = message.key if message.key is not None else str(message.sequence)
+            message_data[key] = {
+                'timestamp': message.timestamp.isoformat().replace('+00:00', 'Z'),
+                'sender': message.sender,
+                'contents': message.contents,
+            }
+        ChatLog.objects.filter(pk=chat_log.pk).update(message_data=message_data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0010_chatmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
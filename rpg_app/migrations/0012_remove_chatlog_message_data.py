@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:28
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0011_migrate_message_data'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatlog',
+            name='message_data',
+        ),
+    ]
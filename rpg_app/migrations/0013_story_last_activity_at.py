@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:31
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0012_remove_chatlog_message_data'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatlog',
+            index=models.Index(fields=['story', 'timestamp'], name='rpg_app_chatlog_story_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['user', '-last_activity_at', '-id'], name='rpg_app_story_user_act_idx'),
+        ),
+    ]
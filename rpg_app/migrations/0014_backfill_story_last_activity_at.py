@@ -0,0 +1,46 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:31
+
+from datetime import datetime, timezone
+
+from django.db import migrations
+from django.db.models import Max, OuterRef, Subquery
+
+# Stories that never had a chat log sort after every active story, as they
+# did when the list was ordered by the latest chat log timestamp.
+NO_ACTIVITY = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def forwards(apps, schema_editor):
+    Story = apps.get_model('rpg_app', 'Story')
+    ChatLog = apps.get_model('rpg_app', 'ChatLog')
+    ChatMessage = apps.get_model('rpg_app', 'ChatMessage')
+
+    latest_log = ChatLog.objects.filter(story=OuterRef('pk')).values('story').annotate(latest=Max('timestamp'))
+    latest_message = ChatMessage.objects.filter(chat_log__story=OuterRef('pk')).values(
+        'chat_log__story'
+    ).annotate(latest=Max('timestamp'))
+    stories = Story.objects.annotate(
+        latest_log=Subquery(latest_log.values('latest')[:1]),
+        latest_message=Subquery(latest_message.values('latest')[:1]),
+    )
+
+    updated = []
+    for story in stories.iterator(chunk_size=500):
+        candidates = [value for value in (story.latest_log, story.latest_message) if value is not None]
+        story.last_activity_at = max(candidates) if candidates else NO_ACTIVITY
+        updated.append(story)
+        if len(updated) >= 500:
+            Story.objects.bulk_update(updated, ['last_activity_at'])
+            updated = []
+    Story.objects.bulk_update(updated, ['last_activity_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0013_story_last_activity_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
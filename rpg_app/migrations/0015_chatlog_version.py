@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0014_backfill_story_last_activity_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatlog',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0015_chatlog_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='summary',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='summary_chat_log',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rpg_app.chatlog'),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='summary_sequence',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0016_story_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('story', 'Story'), ('plot', 'Plot'), ('character', 'Character'), ('setting', 'Setting'), ('message', 'Message')], max_length=16)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('sequence', models.PositiveIntegerField(blank=True, null=True)),
+                ('body', models.TextField()),
+                ('scope', models.CharField(max_length=64)),
+                ('chat_log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rpg_app.chatlog')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rpg_app.chatmessage')),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rpg_app.story')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'kind'], name='rpg_app_searchdoc_user_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='rpg_app_searchdoc_kind_obj_uniq'),
+        ),
+    ]
@@ -0,0 +1,119 @@
+from django.db import migrations
+
+# The index and backfill as of this migration, frozen here rather than
+# imported from rpg_app.search, which follows the current models.
+
+SQLITE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS rpg_app_searchindex USING fts5(
+        body, scope, content='rpg_app_searchdocument', content_rowid='id',
+        tokenize='porter unicode61', prefix='2 3'
+    )
+    """,
+    "INSERT INTO rpg_app_searchindex(rpg_app_searchindex, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    """
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_ai AFTER INSERT ON rpg_app_searchdocument BEGIN
+        INSERT INTO rpg_app_searchindex(rowid, body, scope) VALUES (new.id, new.body, new.scope);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_ad AFTER DELETE ON rpg_app_searchdocument BEGIN
+        INSERT INTO rpg_app_searchindex(rpg_app_searchindex, rowid, body, scope)
+        VALUES ('delete', old.id, old.body, old.scope);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_au AFTER UPDATE OF body, scope ON rpg_app_searchdocument
+    BEGIN
+        INSERT INTO rpg_app_searchindex(rpg_app_searchindex, rowid, body, scope)
+        VALUES ('delete', old.id, old.body, old.scope);
+        INSERT INTO rpg_app_searchindex(rowid, body, scope) VALUES (new.id, new.body, new.scope);
+    END
+    """,
+    # Building the FTS index once is faster than a trigger per row
+    "INSERT INTO rpg_app_searchindex(rpg_app_searchindex) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    'DROP TRIGGER IF EXISTS rpg_app_searchdocument_ai',
+    'DROP TRIGGER IF EXISTS rpg_app_searchdocument_ad',
+    'DROP TRIGGER IF EXISTS rpg_app_searchdocument_au',
+    'DROP TABLE IF EXISTS rpg_app_searchindex',
+]
+
+POSTGRESQL_INDEX = [
+    "CREATE INDEX IF NOT EXISTS rpg_app_searchdoc_body_gin ON rpg_app_searchdocument "
+    "USING GIN (to_tsvector('english', body))",
+]
+
+POSTGRESQL_UNINSTALL = ['DROP INDEX IF EXISTS rpg_app_searchdoc_body_gin']
+
+COLUMNS = 'kind, object_id, user_id, story_id, chat_log_id, message_id, sequence, body, scope'
+
+
+def _scope(kind):
+    return f"'u' || CAST(s.user_id AS TEXT) || ' s' || CAST(s.id AS TEXT) || ' k{kind}'"
+
+
+BACKFILL = [
+    (
+        f"""
+        INSERT INTO rpg_app_searchdocument ({COLUMNS})
+        SELECT 'story', s.id, s.user_id, s.id, NULL, NULL, NULL, TRIM(s.title || %s || s.description), {_scope('story')}
+        FROM rpg_app_story s
+        """,
+        ['\n'],
+    ),
+    *(
+        (
+            f"""
+            INSERT INTO rpg_app_searchdocument ({COLUMNS})
+            SELECT '{kind}', p.id, s.user_id, s.id, NULL, NULL, NULL, p.{field}, {_scope(kind)}
+            FROM {table} p JOIN rpg_app_story s ON s.id = p.story_id
+            """,
+            [],
+        )
+        for kind, table, field in (
+            ('plot', 'rpg_app_plot', 'summary'),
+            ('character', 'rpg_app_character', 'description'),
+            ('setting', 'rpg_app_setting', 'description'),
+        )
+    ),
+    (
+        f"""
+        INSERT INTO rpg_app_searchdocument ({COLUMNS})
+        SELECT 'message', m.id, s.user_id, s.id, m.chat_log_id, m.id, m.sequence, m.contents, {_scope('message')}
+        FROM rpg_app_chatmessage m JOIN rpg_app_chatlog c ON c.id = m.chat_log_id
+        JOIN rpg_app_story s ON s.id = c.story_id
+        """,
+        [],
+    ),
+]
+
+
+def forwards(apps, schema_editor):
+    # Indexes the existing stories and messages, then creates the FTS5 table
+    # and triggers (SQLite) or the GIN index (PostgreSQL)
+    vendor = schema_editor.connection.vendor
+    schema_editor.execute('DELETE FROM rpg_app_searchdocument')
+    for statement, params in BACKFILL:
+        schema_editor.execute(statement, params)
+    for statement in {'sqlite': SQLITE_INDEX, 'postgresql': POSTGRESQL_INDEX}.get(vendor, []):
+        schema_editor.execute(statement)
+
+
+def backwards(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for statement in {'sqlite': SQLITE_UNINSTALL, 'postgresql': POSTGRESQL_UNINSTALL}.get(vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0017_searchdocument'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:39
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rpg_app', '0018_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatLogArchive',
+            fields=[
+                ('chat_log', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='rpg_app.chatlog')),
+                ('message_count', models.PositiveIntegerField()),
+                ('raw_size', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatlog',
+            name='archived',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
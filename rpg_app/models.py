@@ -1,20 +1,53 @@
+import json
+import uuid
+import zlib
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
 
 
+def unique_slug(title):
+    """
+    Slugifies a title with a random suffix, so stories sharing a title never
+    collide on the unique slug and no lookup or retry is needed before insert.
+    """
+    base = slugify(title)[:180] or 'story'
+    return f"{base}-{uuid.uuid4().hex[:12]}"
+
+
 # Create your models here.
 class Story(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     slug = models.SlugField(max_length=200, unique=True, blank=True, editable=False)
+    # Time of the latest chat log or message write, maintained by record_activity
+    last_activity_at = models.DateTimeField(default=timezone.now, editable=False)
+    # Rolling summary of the turns that no longer fit in a continuation
+    # prompt: it covers summary_chat_log up to summary_sequence (see context.py)
+    summary = models.TextField(blank=True, default='', editable=False)
+    summary_chat_log = models.ForeignKey(
+        'ChatLog', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False,
+    )
+    summary_sequence = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at', '-id'], name='rpg_app_story_user_act_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            self.slug = slugify(self.title)
+            self.slug = unique_slug(self.title)
         super().save(*args, **kwargs)
 
+    @classmethod
+    def record_activity(cls, story_id, when=None):
+        cls.objects.filter(pk=story_id).update(last_activity_at=when or timezone.now())
+
     def __str__(self):
         return self.title
 
@@ -47,10 +80,166 @@ class ChatLog(models.Model):
     title = models.CharField(max_length=100)
     story = models.ForeignKey('Story', related_name='chat_logs', on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True)
-    message_data = models.JSONField(default=dict, blank=True, null=True)
+    # Sequence number of the newest ChatMessage, bumped on every append
+    last_sequence = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped once per change to the messages, for optimistic concurrency
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # The messages are compacted into a ChatLogArchive instead of ChatMessage rows
+    archived = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['story', 'timestamp'], name='rpg_app_chatlog_story_ts_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        Story.record_activity(self.story_id)
+
+    def stored_messages(self):
+        """The log's messages, decompressed from its archive if it is compacted (see rpg_app.archive)."""
+        return self.archive.messages() if self.archived else self.messages.all()
 
     def __str__(self):
         return f"ChatLog for {self.story.title} at {self.timestamp}"
+
+
+class ChatMessage(models.Model):
+    chat_log = models.ForeignKey(ChatLog, on_delete=models.CASCADE, related_name='messages')
+    sequence = models.PositiveIntegerField()
+    # Key of the message in the legacy message_data dict; None means str(sequence)
+    key = models.CharField(max_length=64, null=True, blank=True)
+    sender = models.CharField(max_length=32)
+    contents = models.TextField(blank=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat_log', 'sequence'], name='rpg_app_chatmessage_log_seq_uniq'),
+            models.UniqueConstraint(fields=['chat_log', 'key'], name='rpg_app_chatmessage_log_key_uniq'),
+        ]
+
+    @property
+    def legacy_key(self):
+        return self.key if self.key is not None else str(self.sequence)
+
+    def __str__(self):
+        return f"{self.sender} #{self.sequence} in ChatLog {self.chat_log_id}"
+
+
+class ChatLogArchive(models.Model):
+    """
+    Cold storage of an idle chat log's messages: their fields as one
+    zlib-compressed JSON list, in place of ChatMessage rows. Kept out of the
+    ChatLog row so listings never read the blob.
+    """
+    # ChatMessage fields kept for each message, in order
+    FIELDS = ('id', 'sequence', 'key', 'sender', 'contents', 'timestamp')
+
+    chat_log = models.OneToOneField(ChatLog, on_delete=models.CASCADE, primary_key=True, related_name='archive')
+    message_count = models.PositiveIntegerField()
+    # Size of the uncompressed JSON, in bytes
+    raw_size = models.PositiveIntegerField()
+    archived_at = models.DateTimeField(default=timezone.now)
+    data = models.BinaryField()
+
+    @classmethod
+    def pack(cls, rows, level=6):
+        """Compresses ``rows`` of FIELDS values; returns ``(data, raw_size)``."""
+        raw = json.dumps(
+            [[*row[:-1], row[-1].isoformat()] for row in rows], ensure_ascii=False, separators=(',', ':'),
+        ).encode()
+        return zlib.compress(raw, level), len(raw)
+
+    def messages(self):
+        """Unsaved ChatMessages with their original ids, in sequence order; decompressed once per instance."""
+        if not hasattr(self, '_messages'):
+            self._messages = [
+                ChatMessage(
+                    chat_log_id=self.chat_log_id, **dict(zip(self.FIELDS, row)), timestamp=parse_datetime(stamp),
+                )
+                for *row, stamp in json.loads(zlib.decompress(self.data))
+            ]
+        return self._messages
+
+    def __str__(self):
+        return f"Archive of ChatLog {self.chat_log_id} ({self.message_count} messages)"
+
+
+class GenerationJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='generation_jobs')
+    chat_log = models.ForeignKey(ChatLog, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    payload = models.JSONField(default=dict)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    available_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='rpg_app_job_status_avail_idx'),
+        ]
+
+    def __str__(self):
+        return f"GenerationJob {self.pk} for {self.story_id} ({self.status})"
+
+
+class SearchDocument(models.Model):
+    """
+    One searchable text: a story's title and description, a plot, character
+    or setting, or a chat message. Kept in step with its source by
+    rpg_app.search, which also owns the database specific full-text index
+    over ``body`` (FTS5 on SQLite, a tsvector GIN index on PostgreSQL).
+    """
+    STORY = 'story'
+    PLOT = 'plot'
+    CHARACTER = 'character'
+    SETTING = 'setting'
+    MESSAGE = 'message'
+    KIND_CHOICES = [
+        (STORY, 'Story'),
+        (PLOT, 'Plot'),
+        (CHARACTER, 'Character'),
+        (SETTING, 'Setting'),
+        (MESSAGE, 'Message'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='+')
+    chat_log = models.ForeignKey(ChatLog, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    # Set for messages, so deleting one (or its chat log) drops its document
+    message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    sequence = models.PositiveIntegerField(null=True, blank=True)
+    body = models.TextField()
+    # "u<user> s<story> k<kind>" tokens, indexed along with the body so that
+    # FTS5 applies the user, story and kind filters inside the match
+    scope = models.CharField(max_length=64)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='rpg_app_searchdoc_kind_obj_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'kind'], name='rpg_app_searchdoc_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}"
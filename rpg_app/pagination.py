@@ -0,0 +1,122 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class ChatLogCursorPagination(CursorPagination):
+    """Keyset pagination over chat logs, newest first."""
+    ordering = ('-timestamp', '-id')
+    page_size = 50
+    page_size_query_param = 'limit'
+    max_page_size = 200
+
+
+class StoryChatLogCursorPagination(ChatLogCursorPagination):
+    """Keyset pagination over a story's chat logs, oldest first, in the ``chat_logs`` envelope."""
+    ordering = ('timestamp', 'id')
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'chat_logs': data,
+        })
+
+
+def _non_negative_int(query_params, name, default=None, maximum=None):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: 'A non-negative integer is required.'})
+    if value < 0:
+        raise ValidationError({name: 'A non-negative integer is required.'})
+    return min(value, maximum) if maximum is not None else value
+
+
+def _page_size(query_params, default, maximum):
+    # An empty page would point a client following it back at the same place
+    limit = _non_negative_int(query_params, 'limit', default, maximum)
+    if limit == 0:
+        raise ValidationError({'limit': 'A positive integer is required.'})
+    return limit
+
+
+class MessageRangePagination:
+    """
+    Range fetching of a chat log's messages by sequence number.
+
+    ``?after=N`` returns messages with a sequence greater than N in ascending
+    order, ``?before=N`` the ones right before N (newest first in the query,
+    returned in ascending order) so a client can page backwards through
+    history. ``?limit=K`` caps the page size.
+    """
+    default_limit = 100
+    max_limit = 500
+
+    def _bounds(self, request):
+        self.limit = _page_size(request.query_params, self.default_limit, self.max_limit)
+        return _non_negative_int(request.query_params, 'after'), _non_negative_int(request.query_params, 'before')
+
+    def _finish(self, page, before):
+        self.has_more = len(page) > self.limit
+        page = page[:self.limit]
+        if before is not None:
+            page.reverse()
+        self.page = page
+        return page
+
+    def paginate_queryset(self, queryset, request):
+        after, before = self._bounds(request)
+
+        if before is not None:
+            queryset = queryset.filter(sequence__lt=before).order_by('-sequence')
+        else:
+            queryset = queryset.filter(sequence__gt=after or 0).order_by('sequence')
+        if after is not None and before is not None:
+            queryset = queryset.filter(sequence__gt=after)
+
+        # Fetch one extra row to learn whether another page exists
+        return self._finish(list(queryset[:self.limit + 1]), before)
+
+    def paginate_list(self, messages, request):
+        """The same page out of ``messages`` in sequence order, e.g. those of an archived chat log."""
+        after, before = self._bounds(request)
+        page = [
+            message for message in messages
+            if message.sequence > (after or 0) and (before is None or message.sequence < before)
+        ]
+        if before is not None:
+            page.reverse()
+        return self._finish(page[:self.limit + 1], before)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'messages': data,
+            'has_more': self.has_more,
+            'first_sequence': self.page[0].sequence if self.page else None,
+            'last_sequence': self.page[-1].sequence if self.page else None,
+        })
+
+
+class SearchPagination:
+    """Offset paging over ranked search results, ``?limit=K&offset=N``."""
+    default_limit = 20
+    max_limit = 100
+
+    def paginate(self, request, fetch):
+        """Calls ``fetch(limit=..., offset=...)`` for one extra row to learn whether another page exists."""
+        self.limit = _page_size(request.query_params, self.default_limit, self.max_limit)
+        self.offset = _non_negative_int(request.query_params, 'offset', 0)
+        rows = fetch(limit=self.limit + 1, offset=self.offset)
+        self.has_more = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'has_more': self.has_more,
+            'next_offset': self.offset + self.limit if self.has_more else None,
+        })
@@ -0,0 +1,189 @@
+"""
+Prompt templates whose constant parts are encoded, and prefilled, once.
+
+Opening prompts all start with the same instruction preamble. A
+``PromptTemplate`` renders prompts as ``TemplatedPrompt`` strings that
+remember which of their parts are constant, so a backend with a local model
+can:
+
+* reuse the token ids of the constant parts (``FragmentTokenizer``), and
+* run the model over the leading constant part once and start every
+  generation from a copy of its past key values (``PrefixKVCache``), so the
+  per-request prefill only covers the variable suffix.
+
+A ``TemplatedPrompt`` is an ordinary ``str`` everywhere else: cache keys,
+the batching queue and remote backends see the same text as before.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Field:
+    """A variable part of a template, rendered as ``format`` with the field's value."""
+
+    def __init__(self, name, format='{}'):
+        self.name = name
+        self.format = format
+
+
+class TemplatedPrompt(str):
+    """A prompt string that also carries its ``(text, constant)`` parts."""
+
+    def __new__(cls, parts, template=None):
+        prompt = super().__new__(cls, ''.join(text for text, _ in parts))
+        prompt.parts = tuple(parts)
+        prompt.template = template
+        return prompt
+
+    @property
+    def prefix(self):
+        """The leading constant part, the one whose past key values can be shared."""
+        text, constant = self.parts[0] if self.parts else ('', False)
+        return text if constant else ''
+
+
+class PromptTemplate:
+    """
+    A sequence of constant strings and ``Field`` values. Variable parts
+    should start at a word boundary (e.g. ``' {}'`` after a colon) so that
+    encoding the parts separately gives the same ids as encoding the whole
+    prompt; ``FragmentTokenizer`` checks this once per tokenizer.
+    """
+
+    def __init__(self, name, *pieces):
+        self.name = name
+        self.pieces = pieces
+
+    def render(self, **values):
+        parts = []
+        for piece in self.pieces:
+            if isinstance(piece, Field):
+                parts.append((piece.format.format(values[piece.name]), False))
+            elif parts and parts[-1][1]:
+                parts[-1] = (parts[-1][0] + piece, True)
+            else:
+                parts.append((piece, True))
+        return TemplatedPrompt(parts, self)
+
+
+class FragmentTokenizer:
+    """
+    Encodes prompts with ``tokenizer``, reusing the ids of constant template
+    parts. Up to ``max_fragments`` distinct fragments are kept (LRU).
+    """
+
+    def __init__(self, tokenizer, max_fragments=1024):
+        self.tokenizer = tokenizer
+        self.max_fragments = max_fragments
+        self._fragments = OrderedDict()
+        # template name -> whether per-part encoding matches whole-prompt encoding
+        self._verified = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def fragment(self, text):
+        with self._lock:
+            ids = self._fragments.get(text)
+            if ids is not None:
+                self._fragments.move_to_end(text)
+                self.hits += 1
+                return ids
+        ids = tuple(self._encode(text))
+        with self._lock:
+            self.misses += 1
+            self._fragments[text] = ids
+            while len(self._fragments) > self.max_fragments:
+                self._fragments.popitem(last=False)
+        return ids
+
+    def _splittable(self, prompt):
+        name = prompt.template.name if prompt.template is not None else None
+        verified = self._verified.get(name)
+        if verified is None:
+            verified = self._verified[name] = self._encode_parts(prompt) == self._encode(prompt)
+            if not verified:
+                logger.warning("Template %s does not split on token boundaries; encoding it whole", name)
+        return verified
+
+    def _encode_parts(self, prompt):
+        ids = []
+        for text, constant in prompt.parts:
+            ids.extend(self.fragment(text) if constant else self._encode(text))
+        return ids
+
+    def encode(self, prompt):
+        if isinstance(prompt, TemplatedPrompt) and self._splittable(prompt):
+            return self._encode_parts(prompt)
+        return self._encode(prompt)
+
+    def stats(self):
+        with self._lock:
+            return {'fragments': len(self._fragments), 'fragment_hits': self.hits, 'fragment_misses': self.misses}
+
+
+class PrefixKVCache:
+    """
+    Past key values of template prefixes for one causal LM, computed on
+    first use. ``max_prefixes`` distinct prefixes are kept (LRU).
+
+    Entries are stored in the legacy tuple format and wrapped in a fresh
+    ``DynamicCache`` per request: generation appends to the cache object,
+    never to the stored tensors, so concurrent requests can share them.
+    """
+
+    def __init__(self, model, fragments, max_prefixes=8):
+        self.model = model
+        self.fragments = fragments
+        self.max_prefixes = max_prefixes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def _prefill(self, ids):
+        import torch
+
+        with torch.no_grad():
+            output = self.model(torch.tensor([ids]), use_cache=True)
+        past = output.past_key_values
+        return past.to_legacy_cache() if hasattr(past, 'to_legacy_cache') else past
+
+    def get(self, prefix):
+        """Returns ``(prefix_ids, past_key_values)`` for ``prefix``."""
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                self.saved_tokens += len(entry[0])
+                return entry
+        ids = self.fragments.fragment(prefix)
+        entry = (ids, self._prefill(list(ids)))
+        with self._lock:
+            self.misses += 1
+            self._entries[prefix] = entry
+            while len(self._entries) > self.max_prefixes:
+                self._entries.popitem(last=False)
+        return entry
+
+    def session(self, prefix):
+        """A cache object for one generation starting after ``prefix``."""
+        from transformers import DynamicCache
+
+        ids, past = self.get(prefix)
+        return ids, DynamicCache.from_legacy_cache(past)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'prefixes': len(self._entries), 'prefix_hits': self.hits, 'prefix_misses': self.misses,
+                'prefill_tokens_saved': self.saved_tokens,
+            }
@@ -0,0 +1,138 @@
+import functools
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from backend.routers import using_replica
+
+from .models import Story
+
+
+def _cache():
+    return caches[settings.RESPONSE_CACHE['ALIAS']]
+
+
+def _version_key(user_id):
+    return f'rpg:user-version:{user_id}'
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def user_version(user_id):
+    """
+    Returns the current data version of a user. Versions are random rather
+    than counters, so a version lost to eviction can never be reissued and
+    match an ETag handed out earlier.
+    """
+    cache = _cache()
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(user_id):
+    # A fresh version rather than incr(): the file cache increments with an
+    # unlocked read-modify-write, so two workers bumping at once could both
+    # write the same value and one bump would be lost
+    _cache().set(_version_key(user_id), _new_version(), None)
+
+
+def bump_user_version(user_id):
+    """
+    Invalidates a user's cached responses once the current transaction
+    commits. Bumping earlier would let a concurrent GET read the new version
+    with the old data and cache that body under the new ETag.
+    """
+    transaction.on_commit(functools.partial(_bump, user_id))
+
+
+def story_owner(story_id):
+    """Owner of a story; cached forever since stories never change hands."""
+    cache = _cache()
+    key = f'rpg:story-owner:{story_id}'
+    user_id = cache.get(key)
+    if user_id is None:
+        user_id = Story.objects.filter(pk=story_id).values_list('user_id', flat=True).first()
+        if user_id is not None:
+            cache.set(key, user_id, None)
+    return user_id
+
+
+def bump_story_version(story_id):
+    user_id = story_owner(story_id)
+    if user_id is not None:
+        bump_user_version(user_id)
+
+
+def _etag(request, version):
+    view = request.parser_context['view']
+    material = '|'.join((
+        str(request.user.pk), str(version), request.get_full_path(),
+        request.accepted_media_type or '', type(view).__name__,
+    ))
+    return quote_etag(hashlib.sha256(material.encode()).hexdigest())
+
+
+def _render(request, response):
+    view = request.parser_context['view']
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = view.get_renderer_context()
+    return response.render()
+
+
+def cache_per_user(view):
+    """
+    Caches the rendered response of a GET view per user and URL.
+
+    The ETag is derived from the user's data version, which is bumped when
+    a write to their stories commits, so a conditional request is answered
+    with 304 before any query or serializer runs. Works for viewset methods and
+    ``@api_view`` functions.
+
+    Under ``@read_from_replica`` (placed outside this decorator) responses
+    read from a replica get no ETag and are not cached: the replica may lag
+    behind the version.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        if request.method != 'GET' or not request.user.is_authenticated:
+            return view(*args, **kwargs)
+
+        etag = _etag(request, user_version(request.user.pk))
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return HttpResponse(status=304, headers=headers)
+
+        cache = _cache()
+        cached = cache.get(f'rpg:response:{etag}')
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type, headers=headers)
+
+        response = view(*args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200 and not using_replica():
+            _render(request, response)
+            cache.set(
+                f'rpg:response:{etag}', (response.content, response['Content-Type']),
+                settings.RESPONSE_CACHE['TIMEOUT'],
+            )
+            for name, value in headers.items():
+                response[name] = value
+        return response
+
+    return wrapper
@@ -0,0 +1,429 @@
+"""
+Full-text search over a user's stories and chat messages.
+
+Every story (title and description), plot, character, setting and chat
+message has a SearchDocument row, written as its source is saved: by the
+signal receivers for single saves, and by ``create_stories`` and the chat
+helpers for their bulk writes, which send no signals. Documents of deleted
+messages, chat logs and stories go with them through their foreign keys.
+
+The index over ``SearchDocument.body`` depends on the database:
+
+- SQLite: an external-content FTS5 table, ``rpg_app_searchindex``, kept in
+  sync by triggers on rpg_app_searchdocument and ranked with BM25. The
+  user/story/kind filters are tokens of the indexed ``scope`` column, so
+  they narrow the match itself.
+- PostgreSQL: a GIN index on ``to_tsvector('english', body)``, ranked with
+  ts_rank_cd and highlighted with ts_headline.
+- Anything else: a plain substring scan, unranked.
+
+Ranking covers the MAX_CANDIDATES newest matches, so results are the best
+of the recent ones when a query matches more of a history than that.
+
+``install_index`` creates the SQLite triggers and virtual table (or the
+PostgreSQL index); ``manage.py rebuild_search_index`` reinstalls them and
+refills every document, e.g. after a migration that rebuilt the table.
+"""
+import html
+import re
+
+from django.db import connections, router, transaction
+
+from .models import Character, ChatLog, ChatLogArchive, ChatMessage, Plot, SearchDocument, Setting, Story
+from .response_cache import story_owner
+
+FTS_TABLE = 'rpg_app_searchindex'
+MAX_TERMS = 8
+# Only the newest matches are ranked, so a query matching most of a long
+# history costs the same as one matching a thousand messages
+MAX_CANDIDATES = 1000
+SNIPPET_WORDS = 24
+
+# Private-use characters mark the matches in snippets until the text is
+# HTML-escaped, then become <mark> tags
+_MARK_START, _MARK_END = '\ue000', '\ue001'
+_TERMS = re.compile(r'\w+')
+
+PARTS = {
+    Plot: (SearchDocument.PLOT, 'summary'),
+    Character: (SearchDocument.CHARACTER, 'description'),
+    Setting: (SearchDocument.SETTING, 'description'),
+}
+
+
+def scope(user_id, story_id, kind):
+    return f'u{user_id} s{story_id} k{kind}'
+
+
+def _document(kind, object_id, user_id, story_id, body, **extra):
+    return SearchDocument(
+        kind=kind, object_id=object_id, user_id=user_id, story_id=story_id, body=body,
+        scope=scope(user_id, story_id, kind), **extra,
+    )
+
+
+def _upsert(documents):
+    if documents:
+        SearchDocument.objects.bulk_create(
+            documents, update_conflicts=True, unique_fields=['kind', 'object_id'], update_fields=['body'],
+        )
+
+
+def _part_documents(parts, owners):
+    documents = []
+    for part in parts:
+        kind, field = PARTS[type(part)]
+        documents.append(_document(kind, part.pk, owners[part.story_id], part.story_id, getattr(part, field)))
+    return documents
+
+
+def index_stories(stories, parts=()):
+    """Indexes stories and, in the same statement, plots, characters and settings of these or other stories."""
+    owners = {story.pk: story.user_id for story in stories}
+    owners.update({story_id: story_owner(story_id) for story_id in {part.story_id for part in parts} - owners.keys()})
+    _upsert([
+        _document(
+            SearchDocument.STORY, story.pk, story.user_id, story.pk, f"{story.title}\n{story.description}".strip(),
+        )
+        for story in stories
+    ] + _part_documents(parts, owners))
+
+
+def index_story_parts(parts):
+    """Indexes plots, characters and settings (in any mix)."""
+    owners = {story_id: story_owner(story_id) for story_id in {part.story_id for part in parts}}
+    _upsert(_part_documents(parts, owners))
+
+
+def index_messages(messages, story_id=None):
+    """Indexes chat messages; ``story_id`` saves a lookup when they all belong to one story."""
+    if not messages:
+        return
+    if story_id is None:
+        chat_log_ids = {message.chat_log_id for message in messages}
+        story_ids = dict(ChatLog.objects.filter(pk__in=chat_log_ids).values_list('pk', 'story_id'))
+    else:
+        story_ids = {message.chat_log_id: story_id for message in messages}
+    owners = {story_id: story_owner(story_id) for story_id in set(story_ids.values())}
+    _upsert([
+        _document(
+            SearchDocument.MESSAGE, message.pk, owners[story_ids[message.chat_log_id]],
+            story_ids[message.chat_log_id], message.contents,
+            chat_log_id=message.chat_log_id, message_id=message.pk, sequence=message.sequence,
+        )
+        for message in messages
+    ])
+
+
+def unindex(kind, object_ids):
+    SearchDocument.objects.filter(kind=kind, object_id__in=object_ids).delete()
+
+
+def terms(query):
+    return [term.lower() for term in _TERMS.findall(query)][:MAX_TERMS]
+
+
+def _highlight(snippet):
+    return html.escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _stem(word):
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def _snippet(body, words):
+    """
+    The SNIPPET_WORDS words of ``body`` around its first match, with the
+    matches marked. The index's stemming is approximated by stripping
+    common suffixes, which is close enough for highlighting.
+    """
+    stems = {_stem(word) for word in words}
+    tokens = list(_TERMS.finditer(body))
+    if not tokens:
+        return body[:200]
+
+    def matches(token):
+        word = token.group().lower()
+        return word.startswith(words[-1]) or _stem(word) in stems
+
+    hits = [index for index, token in enumerate(tokens) if matches(token)]
+    start = max(0, min((hits[0] if hits else 0) - SNIPPET_WORDS // 4, len(tokens) - SNIPPET_WORDS))
+    end = min(len(tokens), start + SNIPPET_WORDS)
+    pieces = ['…'] if start else []
+    position = tokens[start].start()
+    for index in hits:
+        if start <= index < end:
+            token = tokens[index]
+            pieces += [body[position:token.start()], _MARK_START, token.group(), _MARK_END]
+            position = token.end()
+    pieces.append(body[position:tokens[end - 1].end()])
+    if end < len(tokens):
+        pieces.append('…')
+    return ''.join(pieces)
+
+
+def _fts5_query(words, user_id, story_id=None, kind=None):
+    # Terms are quoted so user input can never be read as FTS5 syntax; the
+    # last one also matches as a prefix, for search-as-you-type
+    body = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+    filters = [f'"u{user_id}"']
+    if story_id is not None:
+        filters.append(f'"s{story_id}"')
+    if kind is not None:
+        filters.append(f'"k{kind}"')
+    return f"scope : ({' AND '.join(filters)}) AND body : ({body.strip()})"
+
+
+def _search_sqlite(cursor, words, user_id, story_id, kind, limit, offset):
+    # FTS5 walks the matches newest first for the candidates and computes
+    # BM25 for those only. Snippets are cut from the page's bodies in
+    # Python: snippet() would re-read the doclist of every matched term.
+    cursor.execute(
+        f"""
+        SELECT d.kind, d.object_id, d.story_id, s.title, d.chat_log_id, d.sequence, d.body, page.rank
+        FROM (
+            SELECT rowid, rank FROM (
+                SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s
+            )
+            ORDER BY rank, rowid DESC
+            LIMIT %s OFFSET %s
+        ) page
+        JOIN {SearchDocument._meta.db_table} d ON d.id = page.rowid
+        JOIN {Story._meta.db_table} s ON s.id = d.story_id
+        ORDER BY page.rank, page.rowid DESC
+        """,
+        [_fts5_query(words, user_id, story_id, kind), MAX_CANDIDATES, limit, offset],
+    )
+    # BM25 scores are negative, lower is better
+    return [(*row[:6], _snippet(row[6], words), -row[7]) for row in cursor.fetchall()]
+
+
+def _search_postgresql(cursor, words, user_id, story_id, kind, limit, offset):
+    tsquery = ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+    filters, params = '', [user_id, tsquery]
+    if story_id is not None:
+        filters += ' AND d.story_id = %s'
+        params.append(story_id)
+    if kind is not None:
+        filters += ' AND d.kind = %s'
+        params.append(kind)
+    # As on SQLite, only the newest candidates are ranked; headlines are
+    # built in the outer query, for the page only
+    cursor.execute(
+        f"""
+        SELECT page.kind, page.object_id, page.story_id, s.title, page.chat_log_id, page.sequence,
+               ts_headline('english', page.body, to_tsquery('english', %s), %s), page.score
+        FROM (
+            SELECT candidate.*, ts_rank_cd(to_tsvector('english', candidate.body), to_tsquery('english', %s)) AS score
+            FROM (
+                SELECT d.kind, d.object_id, d.story_id, d.chat_log_id, d.sequence, d.body, d.id
+                FROM {SearchDocument._meta.db_table} d
+                WHERE d.user_id = %s AND to_tsvector('english', d.body) @@ to_tsquery('english', %s){filters}
+                ORDER BY d.id DESC
+                LIMIT %s
+            ) candidate
+            ORDER BY score DESC, candidate.id DESC
+            LIMIT %s OFFSET %s
+        ) page
+        JOIN {Story._meta.db_table} s ON s.id = page.story_id
+        ORDER BY page.score DESC, page.id DESC
+        """,
+        [
+            tsquery, f'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords={SNIPPET_WORDS}, MinWords=8',
+            tsquery, *params, MAX_CANDIDATES, limit, offset,
+        ],
+    )
+    return cursor.fetchall()
+
+
+def _search_fallback(words, user_id, story_id, kind, limit, offset, using):
+    documents = SearchDocument.objects.using(using).filter(user_id=user_id).select_related('story')
+    for word in words:
+        documents = documents.filter(body__icontains=word)
+    if story_id is not None:
+        documents = documents.filter(story_id=story_id)
+    if kind is not None:
+        documents = documents.filter(kind=kind)
+    return [
+        (
+            document.kind, document.object_id, document.story_id, document.story.title, document.chat_log_id,
+            document.sequence, _snippet(document.body, words), 0.0,
+        )
+        for document in documents.order_by('-id')[offset:offset + limit]
+    ]
+
+
+def search(user_id, query, story_id=None, kind=None, limit=20, offset=0):
+    """
+    Returns up to ``limit`` of the user's documents matching every term of
+    ``query``, best first, as dicts with an HTML-safe ``snippet`` in which
+    matches are wrapped in <mark>.
+    """
+    words = terms(query)
+    if not words:
+        return []
+
+    using = router.db_for_read(SearchDocument)
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            rows = _search_sqlite(cursor, words, user_id, story_id, kind, limit, offset)
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            rows = _search_postgresql(cursor, words, user_id, story_id, kind, limit, offset)
+    else:
+        rows = _search_fallback(words, user_id, story_id, kind, limit, offset, using)
+
+    return [
+        {
+            'kind': kind_, 'object_id': object_id, 'story_id': story_id_, 'story_title': title,
+            'chat_log_id': chat_log_id, 'sequence': sequence, 'snippet': _highlight(snippet),
+            'score': round(float(score), 4),
+        }
+        for kind_, object_id, story_id_, title, chat_log_id, sequence, snippet, score in rows
+    ]
+
+
+_SQLITE_INDEX = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        body, scope, content='rpg_app_searchdocument', content_rowid='id',
+        tokenize='porter unicode61', prefix='2 3'
+    )
+    """,
+    # The scope tokens only filter; they do not count towards the score
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_ai AFTER INSERT ON rpg_app_searchdocument BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, body, scope) VALUES (new.id, new.body, new.scope);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_ad AFTER DELETE ON rpg_app_searchdocument BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, scope) VALUES ('delete', old.id, old.body, old.scope);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rpg_app_searchdocument_au AFTER UPDATE OF body, scope ON rpg_app_searchdocument
+    BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body, scope) VALUES ('delete', old.id, old.body, old.scope);
+        INSERT INTO {FTS_TABLE}(rowid, body, scope) VALUES (new.id, new.body, new.scope);
+    END
+    """,
+]
+
+_POSTGRESQL_INDEX = [
+    "CREATE INDEX IF NOT EXISTS rpg_app_searchdoc_body_gin ON rpg_app_searchdocument "
+    "USING GIN (to_tsvector('english', body))",
+]
+
+
+def install_index(connection):
+    statements = {'sqlite': _SQLITE_INDEX, 'postgresql': _POSTGRESQL_INDEX}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def uninstall_index(connection):
+    statements = {
+        'sqlite': [
+            'DROP TRIGGER IF EXISTS rpg_app_searchdocument_ai',
+            'DROP TRIGGER IF EXISTS rpg_app_searchdocument_ad',
+            'DROP TRIGGER IF EXISTS rpg_app_searchdocument_au',
+            f'DROP TABLE IF EXISTS {FTS_TABLE}',
+        ],
+        'postgresql': ['DROP INDEX IF EXISTS rpg_app_searchdoc_body_gin'],
+    }.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def _scope_sql(user, story, kind):
+    return f"'u' || CAST({user} AS TEXT) || ' s' || CAST({story} AS TEXT) || ' k{kind}'"
+
+
+def _fill_statements(story_filter=''):
+    """(sql, params) filling the documents of every kind; ``story_filter`` is a WHERE clause on ``s``, the story."""
+    documents = SearchDocument._meta.db_table
+    columns = 'kind, object_id, user_id, story_id, chat_log_id, message_id, sequence, body, scope'
+    story, chat_log, message = Story._meta.db_table, ChatLog._meta.db_table, ChatMessage._meta.db_table
+    statements = [(
+        f"""
+        INSERT INTO {documents} ({columns})
+        SELECT 'story', s.id, s.user_id, s.id, NULL, NULL, NULL, TRIM(s.title || %s || s.description),
+               {_scope_sql('s.user_id', 's.id', 'story')}
+        FROM {story} s{story_filter}
+        """,
+        ['\n'],
+    )]
+    for model, (kind, field) in PARTS.items():
+        statements.append((
+            f"""
+            INSERT INTO {documents} ({columns})
+            SELECT '{kind}', p.id, s.user_id, s.id, NULL, NULL, NULL, p.{field},
+                   {_scope_sql('s.user_id', 's.id', kind)}
+            FROM {model._meta.db_table} p JOIN {story} s ON s.id = p.story_id{story_filter}
+            """,
+            [],
+        ))
+    statements.append((
+        f"""
+        INSERT INTO {documents} ({columns})
+        SELECT 'message', m.id, s.user_id, s.id, m.chat_log_id, m.id, m.sequence, m.contents,
+               {_scope_sql('s.user_id', 's.id', 'message')}
+        FROM {message} m JOIN {chat_log} c ON c.id = m.chat_log_id JOIN {story} s ON s.id = c.story_id{story_filter}
+        """,
+        [],
+    ))
+    return statements
+
+
+def index_new_stories(story_ids, using='default'):
+    """
+    Indexes bulk-loaded stories and everything in them with one INSERT ...
+    SELECT per kind, instead of building a document object per row. None of
+    their rows may be indexed yet.
+    """
+    if not story_ids:
+        return
+    story_filter = f" WHERE s.id IN ({', '.join(['%s'] * len(story_ids))})"
+    with connections[using].cursor() as cursor:
+        for statement, params in _fill_statements(story_filter):
+            cursor.execute(statement, [*params, *story_ids])
+
+
+def rebuild_index(using='default'):
+    """
+    Reinstalls the index and refills every document with one INSERT ...
+    SELECT per kind, plus the messages of archived chat logs.
+    """
+    connection = connections[using]
+    statements = _fill_statements()
+
+    with transaction.atomic(using=using):
+        uninstall_index(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SearchDocument._meta.db_table}')
+            for statement, params in statements:
+                cursor.execute(statement, params)
+        # Messages of archived chat logs only exist in their blobs
+        archived = ChatLogArchive.objects.using(using).select_related('chat_log__story').order_by('pk')
+        for archive in archived.iterator(chunk_size=1):
+            story = archive.chat_log.story
+            _upsert([
+                _document(
+                    SearchDocument.MESSAGE, message.pk, story.user_id, story.pk, message.contents,
+                    chat_log_id=archive.chat_log_id, sequence=message.sequence,
+                )
+                for message in archive.messages()
+            ])
+        # Building the FTS index once is faster than a trigger per row
+        install_index(connection)
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
@@ -1,33 +1,154 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Character, Setting, Plot, Story, ChatLog
 
+from servercheck.metrics import TimedSerializerMixin
 
-class CharacterSerializer(serializers.ModelSerializer):
+from .archive import attach_archives
+from .chat import append_messages, merge_message_data, render_message_data
+from .models import Character, Setting, Plot, Story, ChatLog, ChatMessage, GenerationJob
+
+
+class CharacterSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Character
         fields = '__all__'
 
 
-class SettingSerializer(serializers.ModelSerializer):
+class SettingSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Setting
         fields = '__all__'
 
 
-class PlotSerializer(serializers.ModelSerializer):
+class PlotSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Plot
         fields = '__all__'
 
 
-class ChatLogSerializer(serializers.ModelSerializer):
+class ChatMessageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ChatMessage
+        fields = ('sequence', 'key', 'sender', 'contents', 'timestamp')
+        read_only_fields = ('sequence',)
+        # Uniqueness of keys is enforced by the database on append
+        validators = []
+
+
+class ChatMessageEditSerializer(TimedSerializerMixin, serializers.Serializer):
+    sequence = serializers.IntegerField(min_value=1)
+    sender = serializers.CharField(max_length=32, required=False)
+    contents = serializers.CharField(allow_blank=True, required=False)
+
+
+class ChatLogDeltaSerializer(TimedSerializerMixin, serializers.Serializer):
+    """
+    An incremental update of a chat log: messages to append and edits to
+    existing messages, applied only if the log is still at ``version``.
+    """
+    version = serializers.IntegerField(min_value=0)
+    append = ChatMessageSerializer(many=True, required=False, default=list)
+    edit = ChatMessageEditSerializer(many=True, required=False, default=list)
+
+    def validate(self, attrs):
+        if not attrs['append'] and not attrs['edit']:
+            raise serializers.ValidationError('Nothing to append or edit.')
+        return attrs
+
+
+class MessageDataField(serializers.Field):
+    """
+    Exposes a chat log's messages in the legacy ``message_data`` shape:
+    ``{key: {"timestamp": ..., "sender": ..., "contents": ...}}``.
+    """
+
+    def get_attribute(self, instance):
+        # The chat log itself, whose messages may be rows or an archive
+        return instance
+
+    def to_representation(self, chat_log):
+        return render_message_data(chat_log.stored_messages())
+
+    def to_internal_value(self, data):
+        if not isinstance(data, dict) or not all(isinstance(entry, dict) for entry in data.values()):
+            raise serializers.ValidationError('Expected a dictionary of messages keyed by id.')
+        return data
+
+
+class ChatLogListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        chat_logs = list(data.all() if hasattr(data, 'all') else data)
+        attach_archives(chat_logs)
+        return super().to_representation(chat_logs)
+
+
+class ChatLogSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    message_data = MessageDataField(source='messages', required=False)
+
     class Meta:
         model = ChatLog
-        fields = '__all__'
+        # Archiving is a storage detail; responses look the same either way
+        exclude = ('archived',)
+        list_serializer_class = ChatLogListSerializer
+
+    def create(self, validated_data):
+        message_data = validated_data.pop('messages', None)
+        chat_log = super().create(validated_data)
+        if message_data:
+            append_messages(chat_log, [{**entry, 'key': key} for key, entry in message_data.items()])
+        return chat_log
+
+    def update(self, instance, validated_data):
+        message_data = validated_data.pop('messages', None)
+        instance = super().update(instance, validated_data)
+        if message_data:
+            merge_message_data(instance, message_data)
+        return instance
 
 
-class StorySerializer(serializers.ModelSerializer):
+class ChatLogSummarySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """Chat log without message bodies, for incremental history loading."""
+    message_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ChatLog
+        fields = ('id', 'title', 'story', 'timestamp', 'last_sequence', 'version', 'message_count')
+
+
+class GenerationJobSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = GenerationJob
+        fields = ('id', 'story', 'chat_log', 'status', 'result', 'error', 'attempts', 'created_at', 'updated_at')
+
+
+def requested_fields(request):
+    """Returns the field names listed in ``?fields=a,b``, or None when absent."""
+    if request is None or not request.query_params.get('fields'):
+        return None
+    return {name.strip() for name in request.query_params['fields'].split(',') if name.strip()}
+
+
+class SparseFieldsetMixin:
+    """Drops every top-level field not listed in the request's ``?fields=``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+
+class StoryListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        stories = list(data.all() if hasattr(data, 'all') else data)
+        if 'chat_logs' in self.child.fields:
+            # One query for the archives of the whole page, not one per story
+            attach_archives([chat_log for story in stories for chat_log in story.chat_logs.all()])
+        return super().to_representation(stories)
+
+
+class StorySerializer(TimedSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
     characters = CharacterSerializer(many=True, read_only=True)
     settings = SettingSerializer(many=True, read_only=True)
     plots = PlotSerializer(many=True, read_only=True)
@@ -36,6 +157,30 @@ class StorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Story
         fields = '__all__'
+        list_serializer_class = StoryListSerializer
+
+
+class StringListField(serializers.ListField):
+    """A list of strings that also accepts a single string."""
+    child = serializers.CharField(allow_blank=True)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [data]
+        return super().to_internal_value(data)
+
+
+class StoryCreateSerializer(TimedSerializerMixin, serializers.Serializer):
+    title = serializers.CharField(max_length=100)
+    description = serializers.CharField(allow_blank=True, required=False, default='')
+    plot = StringListField()
+    characters = StringListField()
+    setting = StringListField()
+
+
+class StoryBatchSerializer(TimedSerializerMixin, serializers.Serializer):
+    stories = StoryCreateSerializer(many=True, allow_empty=False, max_length=500)
+    generate = serializers.BooleanField(default=False)
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -0,0 +1,62 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import forget_user
+from .models import Character, ChatLog, ChatMessage, Plot, Setting, Story
+from .response_cache import bump_story_version, bump_user_version
+from .search import PARTS, index_messages, index_stories, index_story_parts, unindex
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    bump_user_version(instance.pk)
+    forget_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Story)
+def story_changed(sender, instance, **kwargs):
+    bump_user_version(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Character)
+@receiver([post_save, post_delete], sender=Setting)
+@receiver([post_save, post_delete], sender=Plot)
+@receiver([post_save, post_delete], sender=ChatLog)
+def story_part_changed(sender, instance, **kwargs):
+    bump_story_version(instance.story_id)
+
+
+@receiver([post_save, post_delete], sender=ChatMessage)
+def chat_message_changed(sender, instance, **kwargs):
+    story_id = ChatLog.objects.filter(pk=instance.chat_log_id).values_list('story_id', flat=True).first()
+    if story_id is not None:
+        bump_story_version(story_id)
+
+
+# Bulk writes (create_stories, append_messages, apply_delta) index their rows
+# themselves; documents of deleted stories, chat logs and messages go with
+# them through their foreign keys.
+
+@receiver(post_save, sender=Story)
+def index_story(sender, instance, **kwargs):
+    index_stories([instance])
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_save, sender=Setting)
+@receiver(post_save, sender=Plot)
+def index_story_part(sender, instance, **kwargs):
+    index_story_parts([instance])
+
+
+@receiver(post_delete, sender=Character)
+@receiver(post_delete, sender=Setting)
+@receiver(post_delete, sender=Plot)
+def unindex_story_part(sender, instance, **kwargs):
+    unindex(PARTS[sender][0], [instance.pk])
+
+
+@receiver(post_save, sender=ChatMessage)
+def index_message(sender, instance, **kwargs):
+    index_messages([instance])
@@ -0,0 +1,50 @@
+from django.db import connection, transaction
+
+from .models import Character, Plot, Setting, Story, unique_slug
+from .response_cache import bump_user_version
+from .search import index_stories
+
+
+def describe(descriptions):
+    """Joins several character/setting/plot descriptions for use in a prompt."""
+    return ", ".join(description for description in descriptions if description)
+
+
+@transaction.atomic
+def create_stories(user, specs):
+    """
+    Creates stories with their plots, characters and settings in a single
+    transaction, using one INSERT per table whatever the number of stories.
+
+    ``specs`` are validated StoryCreateSerializer dicts. Returns the stories
+    in the order of ``specs``.
+    """
+    stories = [
+        Story(title=spec['title'], description=spec.get('description', ''), user=user, slug=unique_slug(spec['title']))
+        for spec in specs
+    ]
+    if connection.features.can_return_rows_from_bulk_insert:
+        Story.objects.bulk_create(stories)
+    else:
+        for story in stories:
+            story.save()
+
+    plots, characters, settings = [], [], []
+    for story, spec in zip(stories, specs):
+        plots.extend(Plot(story=story, summary=summary) for summary in spec['plot'])
+        characters.extend(Character(story=story, description=description) for description in spec['characters'])
+        settings.extend(Setting(story=story, description=description) for description in spec['setting'])
+    Plot.objects.bulk_create(plots)
+    Character.objects.bulk_create(characters)
+    Setting.objects.bulk_create(settings)
+
+    # bulk_create sends no post_save signals, so index the rows and invalidate
+    # cached responses here
+    index_stories(stories, plots + characters + settings)
+    bump_user_version(user.pk)
+    return stories
+
+
+def opening_context(spec):
+    """(title, plot, characters, setting) prompt fields for a validated spec."""
+    return spec['title'], describe(spec['plot']), describe(spec['characters']), describe(spec['setting'])
@@ -1,8 +1,10 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from .views import CharacterViewSet, SettingViewSet, PlotViewSet, StoryViewSet, login_view, logout_view, csrf, \
-    register_view, ChatLogViewSet, CreateStoryView
+    register_view, ChatLogViewSet, CreateStoryView, BatchCreateStoryView, GenerationJobViewSet, SearchView, \
+    ExportView, stream_opening
 
 router = DefaultRouter()
 router.register(r'characters', CharacterViewSet)
@@ -10,12 +12,19 @@ router.register(r'settings', SettingViewSet)
 router.register(r'plots', PlotViewSet)
 router.register(r'stories', StoryViewSet)
 router.register(r'chatlogs', ChatLogViewSet)
+router.register(r'jobs', GenerationJobViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
     path('create/', CreateStoryView.as_view(), name='create'),
+    path('create/batch/', BatchCreateStoryView.as_view(), name='create-batch'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('export/', ExportView.as_view(), name='export'),
+    path('stories/<int:pk>/opening/stream/', stream_opening, name='stream-opening'),
     path('auth/login/', login_view, name='login'),
     path('auth/logout/', logout_view, name='logout'),
     path('auth/csrf/', csrf, name='csrf'),
     path('auth/register/', register_view, name='register'),
+    path('auth/token/', TokenObtainPairView.as_view(), name='token-obtain'),
+    path('auth/token/refresh/', TokenRefreshView.as_view(), name='token-refresh'),
 ]
@@ -1,24 +1,236 @@
-from transformers import pipeline
+import logging
+import resource
+import threading
+import time
 
-generator = pipeline('text-generation', model='distilgpt2')  # Change to a specific model if needed
+from django.conf import settings
+from django.db import transaction
 
+from servercheck.metrics import timed
 
-def generate_initial_prompt(title, plot, characters, setting):
-    prompt = (
-        f"Create an engaging and intriguing opening for a story. The story should fit the following context:\n"
-        f"- Title: {title}\n"
-        f"- Plot Summary: {plot}\n"
-        f"- Main Characters: {characters}\n"
-        f"- Setting: {setting}\n\n"
-        f"Here is the opening of the story:"
-    )
+from .backends import load_backend
+from .chat import append_messages
+from .generation_cache import GenerationCache, cache_key
+from .inference import BatchingInferenceService
+from .models import ChatLog
+from .prefix_cache import Field, PromptTemplate
+
+logger = logging.getLogger(__name__)
+
+
+def _resident_memory_bytes():
+    # /proc gives the current RSS on Linux; elsewhere fall back to the peak RSS.
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class GeneratorRegistry:
+    """
+    Loads text-generation backends on first use and shares one instance per
+    model across all threads of the process.
+    """
+
+    def __init__(self, loader=load_backend):
+        self._loader = loader
+        self._generators = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_model():
+        return settings.TEXT_GENERATION['MODEL']
+
+    def get(self, model=None):
+        model = model or self.default_model()
+        generator = self._generators.get(model)
+        if generator is not None:
+            return generator
+
+        with self._lock:
+            generator = self._generators.get(model)
+            if generator is None:
+                generator = self._load(model)
+        return generator
+
+    def _load(self, model):
+        rss_before = _resident_memory_bytes()
+        started = time.perf_counter()
+        generator = self._loader(model)
+        load_time = time.perf_counter() - started
+        rss_after = _resident_memory_bytes()
+
+        self._generators[model] = generator
+        self._stats[model] = {
+            'load_time': load_time,
+            'rss_before': rss_before,
+            'rss_after': rss_after,
+        }
+        logger.info(
+            "Loaded text-generation model %s in %.2fs (RSS %.1f MiB -> %.1f MiB)",
+            model, load_time, rss_before / 2 ** 20, rss_after / 2 ** 20,
+        )
+        return generator
+
+    def set(self, model, generator):
+        """Installs an already built generator, e.g. a stub in tests."""
+        with self._lock:
+            self._generators[model] = generator
+
+    def clear(self):
+        with self._lock:
+            self._generators.clear()
+            self._stats.clear()
+
+    def is_loaded(self, model=None):
+        return (model or self.default_model()) in self._generators
+
+    def warm_up(self, model=None, background=True):
+        """Loads the model ahead of the first request, optionally off-thread."""
+        if not background:
+            return self.get(model)
+
+        thread = threading.Thread(target=self.get, args=(model,), name='generator-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def warm_up_if_configured(self):
+        if settings.TEXT_GENERATION.get('WARMUP'):
+            return self.warm_up(background=True)
+        return None
+
+    def _throughput(self, model):
+        generator = self._generators.get(model)
+        return generator.stats() if hasattr(generator, 'stats') else {}
+
+    def stats(self):
+        return {
+            'loaded_models': sorted(self._generators),
+            'models': {
+                model: {**stats, **self._throughput(model)} for model, stats in self._stats.items()
+            },
+            'rss': _resident_memory_bytes(),
+        }
+
+
+generators = GeneratorRegistry()
+
+inference = BatchingInferenceService(
+    generators,
+    max_batch_size=settings.TEXT_GENERATION['MAX_BATCH_SIZE'],
+    max_wait=settings.TEXT_GENERATION['MAX_BATCH_WAIT'],
+)
+
+generation_cache = GenerationCache(
+    max_entries=settings.TEXT_GENERATION['CACHE']['MAX_ENTRIES'],
+    ttl=settings.TEXT_GENERATION['CACHE']['TTL'],
+    alias=settings.TEXT_GENERATION['CACHE']['ALIAS'],
+)
 
-    response = generator(prompt, max_length=200, num_return_sequences=1, truncation=True)
 
-    generated_text = response[0]['generated_text']
+def run_generator(prompt, **options):
+    """Runs one prompt through the batching service, or inline when batching is off."""
+    with timed('inference'):
+        if settings.TEXT_GENERATION['BATCHING']:
+            return inference.generate(prompt, **options)
+        return generators.get()(prompt, **options)
 
-    start_index = generated_text.find("Here is the opening of the story:")
+
+OPENING_MARKER = "Here is the opening of the story:"
+OPENING_OPTIONS = {'max_length': 200, 'num_return_sequences': 1, 'truncation': True}
+
+
+# Field values start with their separating space so that every part of the
+# prompt begins on a token boundary and the constant parts can be encoded once.
+OPENING_TEMPLATE = PromptTemplate(
+    'opening',
+    "Create an engaging and intriguing opening for a story. The story should fit the following context:\n"
+    "- Title:", Field('title', ' {}'),
+    "\n- Plot Summary:", Field('plot', ' {}'),
+    "\n- Main Characters:", Field('characters', ' {}'),
+    "\n- Setting:", Field('setting', ' {}'),
+    f"\n\n{OPENING_MARKER}",
+)
+
+
+def build_opening_prompt(title, plot, characters, setting):
+    return OPENING_TEMPLATE.render(title=title, plot=plot, characters=characters, setting=setting)
+
+
+def extract_opening(generated_text):
+    start_index = generated_text.find(OPENING_MARKER)
     if start_index != -1:
-        generated_text = generated_text[start_index + len("Here is the opening of the story:"):].strip()
+        generated_text = generated_text[start_index + len(OPENING_MARKER):].strip()
+
+    return generated_text.strip()
+
+
+def opening_cache_key(prompt):
+    """Returns the generation cache key for an opening prompt, or None when caching is off."""
+    if not settings.TEXT_GENERATION['CACHE']['ENABLED']:
+        return None
+    return cache_key(generators.default_model(), prompt, OPENING_OPTIONS)
+
+
+def generate_initial_prompt(title, plot, characters, setting, use_cache=True):
+    prompt = build_opening_prompt(title, plot, characters, setting)
+
+    key = opening_cache_key(prompt) if use_cache else None
+    if key is not None:
+        cached = generation_cache.get(key)
+        if cached is not None:
+            return cached
+
+    response = run_generator(prompt, **OPENING_OPTIONS)
+    opening = extract_opening(response[0]['generated_text'])
+
+    if key is not None:
+        generation_cache.set(key, opening)
+    return opening
+
+
+def stream_generation(prompt, **options):
+    """
+    Yields generated text pieces as the model produces them.
+
+    Generation runs on a separate thread feeding a TextIteratorStreamer.
+    Generators without a tokenizer (e.g. test stubs) yield their whole
+    completion as a single piece.
+    """
+    generator = generators.get()
+    tokenizer = getattr(generator, 'tokenizer', None)
+    if tokenizer is None:
+        text = generator(prompt, **options)[0]['generated_text']
+        yield text[len(prompt):] if text.startswith(prompt) else text
+        return
+
+    from transformers import TextIteratorStreamer
+
+    streamer = TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True,
+        timeout=settings.TEXT_GENERATION['STREAM_TIMEOUT'],
+    )
+    errors = []
+
+    def run():
+        try:
+            generator(prompt, streamer=streamer, **options)
+        except Exception as exc:
+            errors.append(exc)
+            streamer.end()
+
+    threading.Thread(target=run, name='generator-stream', daemon=True).start()
+    for piece in streamer:
+        if piece:
+            yield piece
+    if errors:
+        raise errors[0]
+
 
-    return generated_text.strip()
\ No newline at end of file
+@transaction.atomic
+def create_opening_chat_log(story, title, text):
+    chat_log = ChatLog.objects.create(title=title, story=story)
+    append_messages(chat_log, [{'key': '0', 'sender': 'ai', 'contents': text}])
+    return chat_log
@@ -1,47 +1,111 @@
 import json
 import os
 
-import openai
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.db.models import OuterRef, Subquery
-from django.http import HttpResponse, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.utils.text import slugify
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt, csrf_protect
-from rest_framework import viewsets, status
+from rest_framework import serializers, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.views import APIView
 
-from .models import Character, Setting, Plot, Story, ChatLog
-from .serializers import CharacterSerializer, SettingSerializer, PlotSerializer, StorySerializer, ChatLogSerializer
-from .utils import generate_initial_prompt
+from backend.routers import read_from_replica
+
+from .admission import GenerationOverloaded, GenerationRateThrottle, admission, generation_slot
+from .authentication import CachedJWTAuthentication
+from .backup import aiter_chunks, encode, export_lines
+from .chat import VersionConflict, append_messages, apply_delta, merge_message_data
+from .context import continue_chat
+from .jobs import enqueue_opening, enqueue_openings
+from .models import Character, Setting, Plot, Story, ChatLog, ChatMessage, GenerationJob, SearchDocument
+from .pagination import ChatLogCursorPagination, MessageRangePagination, SearchPagination, \
+    StoryChatLogCursorPagination
+from .response_cache import cache_per_user
+from .search import search
+from .serializers import CharacterSerializer, SettingSerializer, PlotSerializer, StorySerializer, ChatLogSerializer, \
+    ChatLogDeltaSerializer, ChatLogSummarySerializer, ChatMessageSerializer, GenerationJobSerializer, \
+    StoryBatchSerializer, StoryCreateSerializer, requested_fields
+from .stories import create_stories, describe, opening_context
+from .utils import OPENING_OPTIONS, build_opening_prompt, create_opening_chat_log, extract_opening, \
+    generate_initial_prompt, generation_cache, opening_cache_key, stream_generation
 
 
 def index(request):
     return HttpResponse("Hello, world. You're at the polls index.")
 
 
+def include_message_bodies(request):
+    """``?messages=0`` lists chat logs without their messages."""
+    return request.query_params.get('messages', '1').lower() not in ('0', 'false', 'no')
+
+
+def chat_log_listing(queryset, request):
+    if include_message_bodies(request):
+        return queryset.prefetch_related('messages')
+    return queryset.annotate(message_count=Count('messages') + Coalesce(Max('archive__message_count'), 0))
+
+
+def chat_log_serializer_class(request):
+    return ChatLogSerializer if include_message_bodies(request) else ChatLogSummarySerializer
+
+
 class StoryViewSet(viewsets.ModelViewSet):
     queryset = Story.objects.all()
     serializer_class = StorySerializer
     permission_classes = [IsAuthenticated]
 
+    # Nested relations rendered by StorySerializer and the lookups that load them
+    nested_prefetches = {
+        'characters': ('characters',),
+        'settings': ('settings',),
+        'plots': ('plots',),
+        'chat_logs': ('chat_logs__messages',),
+    }
+
     def get_queryset(self):
-        latest_chat_log = ChatLog.objects.filter(story=OuterRef('pk')).order_by('-timestamp')
-        return self.queryset.filter(user=self.request.user).annotate(
-            latest_chat_log_timestamp=Subquery(latest_chat_log.values('timestamp')[:1])
-        ).order_by('-latest_chat_log_timestamp')
+        queryset = self.queryset.filter(user=self.request.user).order_by('-last_activity_at', '-id')
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.prefetch_related(*self.get_prefetches())
+        return queryset
+
+    @cache_per_user
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache_per_user
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def get_prefetches(self):
+        fields = requested_fields(self.request)
+        return [
+            lookup
+            for name, lookups in self.nested_prefetches.items()
+            if fields is None or name in fields
+            for lookup in lookups
+        ]
 
     @action(detail=True, methods=['get'])
+    @cache_per_user
     def chat_logs(self, request, pk=None):
         story = get_object_or_404(Story, id=pk, user=request.user)
-        chat_logs = story.chat_logs.all().order_by('timestamp')
-        serializer = ChatLogSerializer(chat_logs, many=True)
-        return Response({'chat_logs': serializer.data})
+        paginator = StoryChatLogCursorPagination()
+        page = paginator.paginate_queryset(chat_log_listing(story.chat_logs.all(), request), request, view=self)
+        serializer = chat_log_serializer_class(request)(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class CharacterViewSet(viewsets.ModelViewSet):
@@ -75,64 +139,171 @@ class ChatLogViewSet(viewsets.ModelViewSet):
     queryset = ChatLog.objects.all()
     serializer_class = ChatLogSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ChatLogCursorPagination
 
     def get_queryset(self):
         queryset = self.queryset.filter(story__user=self.request.user).order_by('-timestamp')
-        print(f"Debug: Fetched queryset with {queryset.count()} entries.")
-        return queryset
+        if self.action in ('messages', 'update', 'partial_update', 'continue_story'):
+            return queryset
+        if self.action == 'list':
+            return chat_log_listing(queryset, self.request)
+        return queryset.prefetch_related('messages')
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return chat_log_serializer_class(self.request)
+        return super().get_serializer_class()
+
+    @cache_per_user
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache_per_user
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def update(self, request, *args, **kwargs):
+        """
+        Applies a delta (see ChatLogDeltaSerializer) and responds with only
+        the appended and edited messages and the new version; 409 if the log
+        moved past the client's version. Requests with a legacy
+        ``message_data`` dict are merged and answered with the whole log.
+        """
         instance = self.get_object()
+        if 'message_data' not in request.data:
+            return self.apply_delta(request, instance)
         message_data = request.data.get('message_data')
 
-        print(f"Debug: Received PATCH request with messages={message_data}")
-
         if not message_data:
-            print("Debug: Messages are missing.")
             return JsonResponse({'error': 'Messages are required'}, status=400)
+        if not isinstance(message_data, dict):
+            return JsonResponse({'error': 'Messages must be a dictionary keyed by id'}, status=400)
 
-        if isinstance(instance.message_data, dict):
-            instance.message_data.update(message_data)
-        else:
-            instance.message_data = message_data
-
-        instance.save()
+        merge_message_data(instance, message_data)
 
+        instance = self.get_queryset().prefetch_related('messages').get(pk=instance.pk)
         serializer = self.get_serializer(instance)
-        print("Debug: Updated chat log and saved changes.")
         return Response(serializer.data)
 
+    def apply_delta(self, request, instance):
+        serializer = ChatLogDeltaSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        delta = serializer.validated_data
+        try:
+            version, appended, edited = apply_delta(instance, delta['version'], delta['append'], delta['edit'])
+        except VersionConflict as conflict:
+            return Response(
+                {'error': 'The chat log has changed', 'version': conflict.version}, status=status.HTTP_409_CONFLICT,
+            )
+        except ChatMessage.DoesNotExist as missing:
+            return Response({'error': str(missing)}, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            return Response({'error': 'A message with this key already exists'}, status=status.HTTP_409_CONFLICT)
+        return Response({
+            'version': version,
+            'last_sequence': instance.last_sequence,
+            'appended': ChatMessageSerializer(appended, many=True).data,
+            'edited': ChatMessageSerializer(edited, many=True).data,
+        })
+
+    @action(detail=True, methods=['get', 'post'])
+    @cache_per_user
+    def messages(self, request, pk=None):
+        """
+        GET pages through the log's messages by sequence (``?after=N``,
+        ``?before=N``, ``?limit=K``). POST appends one message, or a list of
+        messages, without rewriting the log.
+        """
+        chat_log = self.get_object()
+        if request.method == 'GET':
+            paginator = MessageRangePagination()
+            if chat_log.archived:
+                page = paginator.paginate_list(chat_log.stored_messages(), request)
+            else:
+                page = paginator.paginate_queryset(chat_log.messages.all(), request)
+            return paginator.get_paginated_response(ChatMessageSerializer(page, many=True).data)
+
+        many = isinstance(request.data, list)
+        serializer = ChatMessageSerializer(data=request.data, many=many)
+        serializer.is_valid(raise_exception=True)
+        entries = serializer.validated_data if many else [serializer.validated_data]
+        try:
+            messages = append_messages(chat_log, entries)
+        except IntegrityError:
+            return Response({'error': 'A message with this key already exists'}, status=status.HTTP_409_CONFLICT)
+        data = ChatMessageSerializer(messages, many=True).data
+        return Response(data if many else data[0], status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='continue', throttle_classes=[GenerationRateThrottle])
+    def continue_story(self, request, pk=None):
+        """
+        Generates the narrator's next message. An optional player message in
+        the body is appended first. The prompt is built within the configured
+        token budget; see rpg_app.context.
+        """
+        chat_log = self.get_object()
+        entries = []
+        if request.data:
+            serializer = ChatMessageSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            entries.append(serializer.validated_data)
+
+        # Admission comes before any write, so a 503 leaves no player message
+        # behind for the client's retry to append again
+        with generation_slot(request):
+            append_messages(chat_log, entries)
+            message, window = continue_chat(chat_log)
+        return Response({
+            'message': ChatMessageSerializer(message).data,
+            'version': chat_log.version,
+            'prompt_tokens': window.prompt_tokens,
+            'context_first_sequence': window.first_sequence,
+        }, status=status.HTTP_201_CREATED)
+
 
 @method_decorator(csrf_exempt, name='dispatch')
 class CreateStoryView(APIView):
+    throttle_classes = [GenerationRateThrottle]
+
     def post(self, request):
-        title = request.data.get('title')
-        plot = request.data.get('plot')
-        characters = request.data.get('characters')
-        setting = request.data.get('setting')
-        user = request.user
-
-        # Create the story, characters, and setting
-        story = Story.objects.create(title=title, user=user)
-        Plot.objects.create(summary=plot, story=story)
-        Character.objects.create(story=story, description=characters)
-        Setting.objects.create(story=story, description=setting)
-
-        # Generate the initial AI prompt
-        initial_prompt_text = generate_initial_prompt(title, plot, characters, setting)
-
-        # Create the initial chat log
-        chat_log = ChatLog.objects.create(
-            title=title,
-            story=story,
-            message_data={
-                "0": {
-                    "timestamp": "2024-01-01T00:00:00Z",  # Use a realistic timestamp
-                    "sender": "ai",
-                    "contents": initial_prompt_text
-                }
-            }
-        )
+        serializer = StoryCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        spec = serializer.validated_data
+        title, plot, characters, setting = opening_context(spec)
+
+        # Create the story, plots, characters, and settings in one transaction
+        if self.wants_async(request):
+            with transaction.atomic():
+                story, = create_stories(request.user, [spec])
+                # Let a worker fill in the opening once the rows are committed
+                job = enqueue_opening(story, title, plot, characters, setting, use_cache=self.wants_cache(request))
+            return Response({
+                'story_id': story.id,
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': reverse('generationjob-detail', args=[job.id], request=request),
+            }, status=status.HTTP_202_ACCEPTED)
+
+        if self.wants_stream(request):
+            story, = create_stories(request.user, [spec])
+            # The client opens the stream URL to receive the opening token by token
+            return Response({
+                'story_id': story.id,
+                'stream_url': reverse('stream-opening', args=[story.id], request=request),
+            }, status=status.HTTP_201_CREATED)
+
+        # Generate the initial AI prompt before writing anything: a 503 or a
+        # failed generation leaves no story without an opening behind for the
+        # client's retry to duplicate, and no write lock is held during inference
+        with generation_slot(request):
+            initial_prompt_text = generate_initial_prompt(
+                title, plot, characters, setting, use_cache=self.wants_cache(request)
+            )
+
+        # Create the story, its parts and the initial chat log in one transaction
+        with transaction.atomic():
+            story, = create_stories(request.user, [spec])
+            create_opening_chat_log(story, title, initial_prompt_text)
 
         # Return the created story and initial prompt
         return Response({
@@ -140,6 +311,235 @@ class CreateStoryView(APIView):
             'initial_prompt': initial_prompt_text
         }, status=status.HTTP_201_CREATED)
 
+    @staticmethod
+    def flag(request, name, default=False):
+        value = request.query_params.get(name, request.data.get(name, default))
+        return str(value).lower() in ('1', 'true', 'yes')
+
+    def generation_cost(self, request):
+        # A streamed opening is charged by the stream, and only if it generates
+        return 0 if self.wants_stream(request) else 1
+
+    def wants_async(self, request):
+        return self.flag(request, 'async')
+
+    def wants_stream(self, request):
+        return self.flag(request, 'stream')
+
+    def wants_cache(self, request):
+        return self.flag(request, 'cache', default=True)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchCreateStoryView(APIView):
+    """
+    Creates many stories in one request and one transaction, e.g. for content
+    seeding. With ``generate`` set, their openings are queued as jobs.
+    """
+
+    throttle_classes = [GenerationRateThrottle]
+
+    def generation_cost(self, request):
+        # Charged before validation; an invalid batch is rejected right after anyway
+        data = request.data if isinstance(request.data, dict) else {}
+        stories, generate = data.get('stories'), data.get('generate')
+        if not isinstance(stories, list) or not isinstance(generate, (bool, int, str)):
+            return 0
+        return len(stories) if generate in serializers.BooleanField.TRUE_VALUES else 0
+
+    def post(self, request):
+        serializer = StoryBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        specs = serializer.validated_data['stories']
+
+        with transaction.atomic():
+            stories = create_stories(request.user, specs)
+            jobs = []
+            if serializer.validated_data['generate']:
+                jobs = enqueue_openings([
+                    (story, *opening_context(spec)) for story, spec in zip(stories, specs)
+                ])
+
+        return Response({
+            'story_ids': [story.id for story in stories],
+            'job_ids': [job.id for job in jobs],
+        }, status=status.HTTP_201_CREATED)
+
+
+class SearchView(APIView):
+    """
+    Finds the user's stories, plots, characters, settings and chat messages
+    containing every word of ``?q=`` (the last one also as a prefix), best
+    match first, with highlighted snippets. ``?kind=`` and ``?story=`` narrow
+    the search; see rpg_app.search for the index behind it.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @read_from_replica
+    @cache_per_user
+    def get(self, request):
+        params = request.query_params
+        kind = params.get('kind') or None
+        if kind is not None and kind not in dict(SearchDocument.KIND_CHOICES):
+            raise ValidationError({'kind': f"Choose one of {', '.join(dict(SearchDocument.KIND_CHOICES))}."})
+        story = params.get('story') or None
+        if story is not None and not story.isdigit():
+            raise ValidationError({'story': 'A story id is required.'})
+
+        paginator = SearchPagination()
+        results = paginator.paginate(request, lambda limit, offset: search(
+            request.user.pk, params.get('q', ''), story_id=story and int(story), kind=kind, limit=limit, offset=offset,
+        ))
+        return paginator.get_paginated_response(results)
+
+
+class ExportView(APIView):
+    """
+    Downloads the user's stories with their chat logs and messages as NDJSON,
+    streamed from the database in chunks (see rpg_app.backup), under WSGI
+    and ASGI alike. ``?gzip=1`` compresses the download; ``manage.py
+    import_stories`` reads it back.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        compress = request.query_params.get('gzip', '0').lower() in ('1', 'true', 'yes')
+        filename = f"stories-{slugify(request.user.get_username())}.ndjson{'.gz' if compress else ''}"
+        chunks = encode(export_lines(request.user), compress)
+        if isinstance(request._request, ASGIRequest):
+            chunks = aiter_chunks(chunks)
+        response = StreamingHttpResponse(
+            chunks, content_type='application/gzip' if compress else 'application/x-ndjson',
+        )
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+class GenerationJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = GenerationJob.objects.all()
+    serializer_class = GenerationJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(story__user=self.request.user)
+
+    @read_from_replica
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _opening_context(story):
+    return (
+        story.title,
+        describe(plot.summary for plot in story.plots.all()),
+        describe(character.description for character in story.characters.all()),
+        describe(setting.description for setting in story.settings.all()),
+    )
+
+
+async def _stream_opening_events(request, story, prompt, key, cached):
+    if cached is not None:
+        yield _sse('token', {'text': cached})
+        chat_log = await sync_to_async(create_opening_chat_log)(story, story.title, cached)
+        yield _sse('done', {'chat_log_id': chat_log.id, 'text': cached})
+        return
+
+    # The slot is taken once the client reads the stream, so a response that
+    # is never sent never holds one. By then the 200 is out and an overload
+    # can only be reported as an event.
+    try:
+        admitted_at = await admission.aacquire()
+    except GenerationOverloaded as overloaded:
+        await sync_to_async(GenerationRateThrottle.refund)(request)
+        yield _sse('error', {'error': str(overloaded.detail), 'retry_after': overloaded.wait})
+        return
+
+    try:
+        pieces = stream_generation(prompt, **OPENING_OPTIONS)
+        next_piece = sync_to_async(next, thread_sensitive=False)
+        generated = []
+        try:
+            while True:
+                piece = await next_piece(pieces, None)
+                if piece is None:
+                    break
+                generated.append(piece)
+                yield _sse('token', {'text': piece})
+        except Exception as exc:
+            yield _sse('error', {'error': str(exc)})
+            return
+
+        text = extract_opening("".join(generated))
+        if key is not None:
+            generation_cache.set(key, text)
+        chat_log = await sync_to_async(create_opening_chat_log)(story, story.title, text)
+        yield _sse('done', {'chat_log_id': chat_log.id, 'text': text})
+    finally:
+        # Also runs when the client goes away mid-stream: the disconnect
+        # cancels the pending read, or the abandoned generator is closed
+        admission.release(admitted_at)
+
+
+def _token_user(request):
+    """The user of a valid ``Authorization: Bearer`` access token, else None."""
+    try:
+        authenticated = CachedJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return authenticated[0] if authenticated else None
+
+
+def _retry_later(detail, status_code, wait):
+    response = JsonResponse({'detail': detail}, status=status_code)
+    response['Retry-After'] = str(wait)
+    return response
+
+
+async def stream_opening(request, pk):
+    """
+    Streams a story's AI opening as server-sent events (one ``token`` event
+    per generated piece) and stores it as the story's first ChatLog once
+    generation finishes. Requires an ASGI server to stream incrementally.
+    Generating counts against the user's quota like a non-streamed create;
+    when generation is at capacity the stream is a single ``error`` event
+    with ``retry_after`` seconds.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        user = await sync_to_async(_token_user)(request)
+    if user is None or not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+
+    story = await Story.objects.filter(pk=pk, user=user).prefetch_related('plots', 'characters', 'settings').afirst()
+    if story is None:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    if await story.chat_logs.aexists():
+        return JsonResponse({'detail': 'This story already has an opening.'}, status=409)
+
+    prompt = build_opening_prompt(*_opening_context(story))
+    use_cache = request.GET.get('cache', '1').lower() in ('1', 'true', 'yes')
+    key = opening_cache_key(prompt) if use_cache else None
+    cached = generation_cache.get(key) if key is not None else None
+
+    if cached is None:
+        # The quota is charged before the stream starts, while a 429 can still be sent
+        request.user = user
+        throttle = GenerationRateThrottle()
+        if not await sync_to_async(throttle.allow_request)(request, None):
+            return _retry_later('Generation quota exceeded, please retry later.', 429, throttle.wait())
+
+    response = StreamingHttpResponse(
+        _stream_opening_events(request, story, prompt, key, cached), content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 
 @ensure_csrf_cookie
 def csrf(request):
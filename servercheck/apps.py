@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ServercheckConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'servercheck'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .metrics import install_query_timer
+
+        connection_created.connect(install_query_timer)
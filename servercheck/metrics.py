@@ -0,0 +1,252 @@
+"""
+Per-request performance metrics.
+
+RequestMetricsMiddleware opens a RequestTimings for every request. Code
+further down records into it through ``timed()`` (serializers, inference)
+and a database execute wrapper installed on every connection. When the
+response is ready the timings are added to the process-wide ``registry``,
+sent back as a Server-Timing header and, for slow requests, logged.
+
+Metrics are kept per process: with several app server workers each one
+exposes its own counters, and the scraper aggregates them.
+"""
+import bisect
+import contextlib
+import contextvars
+import heapq
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'count': running, 'sum': total}
+
+
+class RequestTimings:
+    """Time spent per component during one request, in seconds."""
+
+    def __init__(self, slow_queries=0):
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.query_count = 0
+        self.query_time = 0.0
+        self._active = set()
+        self._slow_queries = slow_queries
+        self._queries = []
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def add_query(self, sql, seconds):
+        self.query_count += 1
+        self.query_time += seconds
+        if self._slow_queries:
+            # Keep only the slowest statements for the slow request log
+            entry = (seconds, self.query_count, sql)
+            if len(self._queries) < self._slow_queries:
+                heapq.heappush(self._queries, entry)
+            else:
+                heapq.heappushpop(self._queries, entry)
+
+    def slowest_queries(self):
+        return [(seconds, sql) for seconds, _, sql in sorted(self._queries, reverse=True)]
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def current_timings():
+    return _current.get()
+
+
+def start_request(slow_queries=0):
+    timings = RequestTimings(slow_queries)
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Adds the time spent in the block to the current request's ``name``
+    component. Nested blocks of the same name are counted once.
+    """
+    timings = _current.get()
+    if timings is None or name in timings._active:
+        yield
+        return
+    timings._active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings._active.discard(name)
+        timings.add(name, time.perf_counter() - started)
+
+
+def query_timer(execute, sql, params, many, context):
+    """Database execute wrapper counting queries and their time for the current request."""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(sql, time.perf_counter() - started)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver; wrappers persist across reconnects, so add it once."""
+    if query_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_timer)
+
+
+class TimedSerializerMixin:
+    """Counts validation and representation time as the request's ``serializer`` time."""
+
+    def run_validation(self, *args, **kwargs):
+        with timed('serializer'):
+            return super().run_validation(*args, **kwargs)
+
+    def to_representation(self, *args, **kwargs):
+        with timed('serializer'):
+            return super().to_representation(*args, **kwargs)
+
+
+class MetricsRegistry:
+    """Aggregated request metrics per (endpoint, method)."""
+
+    components = ('db', 'serializer', 'inference')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.durations = {}
+        self.requests = {}
+        self.queries = {}
+        self.component_seconds = {}
+        self.slow_requests = {}
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def record(self, endpoint, method, status, timings, total, slow):
+        key = (endpoint, method)
+        with self._lock:
+            histogram = self.durations.get(key)
+            if histogram is None:
+                histogram = self.durations[key] = Histogram(LATENCY_BUCKETS)
+            status_key = key + (str(status),)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.queries[key] = self.queries.get(key, 0) + timings.query_count
+            seconds = dict(timings.durations, db=timings.query_time)
+            for component in self.components:
+                component_key = key + (component,)
+                self.component_seconds[component_key] = (
+                    self.component_seconds.get(component_key, 0.0) + seconds.get(component, 0.0)
+                )
+            if slow:
+                self.slow_requests[key] = self.slow_requests.get(key, 0) + 1
+        histogram.observe(total)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            durations = {key: histogram.snapshot() for key, histogram in self.durations.items()}
+            requests = dict(self.requests)
+            queries = dict(self.queries)
+            component_seconds = dict(self.component_seconds)
+            slow_requests = dict(self.slow_requests)
+
+        lines = []
+        lines += render_histogram(
+            'rpg_request_duration_seconds', "Wall time of requests.",
+            ((labels('endpoint', 'method', values=key), snapshot) for key, snapshot in sorted(durations.items())),
+        )
+        lines += render_counter(
+            'rpg_requests_total', "Requests served.",
+            ((labels('endpoint', 'method', 'status', values=key), count) for key, count in sorted(requests.items())),
+        )
+        lines += render_counter(
+            'rpg_request_db_queries_total', "Database queries run by requests.",
+            ((labels('endpoint', 'method', values=key), count) for key, count in sorted(queries.items())),
+        )
+        lines += render_counter(
+            'rpg_request_component_seconds_total', "Time spent per component (db, serializer, inference).",
+            (
+                (labels('endpoint', 'method', 'component', values=key), seconds)
+                for key, seconds in sorted(component_seconds.items())
+            ),
+        )
+        lines += render_counter(
+            'rpg_slow_requests_total', "Requests over a slow request threshold.",
+            ((labels('endpoint', 'method', values=key), count) for key, count in sorted(slow_requests.items())),
+        )
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(*names, values=()):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _with_label(label_string, extra):
+    return f'{label_string},{extra}' if label_string else extra
+
+
+def render_counter(name, help_text, samples, kind='counter'):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for label_string, value in samples:
+        lines.append(f'{name}{{{label_string}}} {value}' if label_string else f'{name} {value}')
+    return lines
+
+
+def render_histogram(name, help_text, samples):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for label_string, snapshot in samples:
+        for bound, count in snapshot['buckets']:
+            bucket_labels = _with_label(label_string, labels('le', values=(bound,)))
+            lines.append(f'{name}_bucket{{{bucket_labels}}} {count}')
+        suffix = f'{{{label_string}}}' if label_string else ''
+        lines.append(f'{name}_sum{suffix} {snapshot["sum"]}')
+        lines.append(f'{name}_count{suffix} {snapshot["count"]}')
+    return lines
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,94 @@
+import logging
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import end_request, registry, start_request
+
+logger = logging.getLogger('servercheck.slow_requests')
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and breaks the time down into database, serializer
+    and inference components.
+
+    The breakdown is returned in a Server-Timing header, aggregated per
+    endpoint for ``/servercheck/metrics/``, and requests over the
+    REQUEST_METRICS thresholds are sampled into the slow request log together
+    with their slowest SQL statements.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    @property
+    def config(self):
+        return settings.REQUEST_METRICS
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings, token = start_request(self.config['SLOW_REQUEST_QUERIES_LOGGED'])
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings, token = start_request(self.config['SLOW_REQUEST_QUERIES_LOGGED'])
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = timings.elapsed()
+        endpoint = self.endpoint(request)
+        slow = self.is_slow(total, timings)
+        registry.record(endpoint, request.method, response.status_code, timings, total, slow)
+
+        if self.config['SERVER_TIMING']:
+            response['Server-Timing'] = self.server_timing(total, timings)
+        if slow and random.random() < self.config['SLOW_REQUEST_SAMPLE_RATE']:
+            self.log_slow_request(request, response, endpoint, total, timings)
+        return response
+
+    @staticmethod
+    def endpoint(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unmatched'
+        return match.view_name or match._func_path
+
+    def is_slow(self, total, timings):
+        return (
+            total >= self.config['SLOW_REQUEST_SECONDS']
+            or timings.query_count >= self.config['SLOW_REQUEST_QUERIES']
+        )
+
+    @staticmethod
+    def server_timing(total, timings):
+        metrics = [f'total;dur={total * 1000:.1f}']
+        if timings.query_count:
+            metrics.append(f'db;dur={timings.query_time * 1000:.1f};desc="{timings.query_count} queries"')
+        for name, seconds in sorted(timings.durations.items()):
+            metrics.append(f'{name};dur={seconds * 1000:.1f}')
+        return ', '.join(metrics)
+
+    @staticmethod
+    def log_slow_request(request, response, endpoint, total, timings):
+        components = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in sorted(timings.durations.items()))
+        queries = ''.join(f'\n  {seconds:.3f}s {sql}' for seconds, sql in timings.slowest_queries())
+        logger.warning(
+            "Slow request %s %s (%s) -> %s in %.3fs: %d queries in %.3fs%s%s",
+            request.method, request.get_full_path(), endpoint, response.status_code, total,
+            timings.query_count, timings.query_time, f', {components}' if components else '', queries,
+        )
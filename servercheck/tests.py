@@ -1,3 +1,71 @@
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from rpg_app.models import Story
+from rpg_app.tests import LOCMEM_CACHES, stub_generator
+from rpg_app.utils import generation_cache, generators
+
+from .metrics import registry
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        registry.clear()
+        self.user = User.objects.create_user('metrics', 'metrics@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        Story.objects.create(title='Timed', slug='timed', user=self.user)
+
+    def server_timing(self, response):
+        return dict(
+            (entry.split(';')[0], entry) for entry in response['Server-Timing'].split(', ')
+        )
+
+    def test_server_timing_breaks_down_database_and_serializer_time(self):
+        response = self.client.get('/api/stories/')
+
+        self.assertEqual(response.status_code, 200)
+        timing = self.server_timing(response)
+        self.assertIn('total', timing)
+        self.assertIn('serializer', timing)
+        self.assertRegex(timing['db'], r'db;dur=[\d.]+;desc="\d+ queries"')
+
+    def test_inference_time_is_reported(self):
+        generators.set(generators.default_model(), stub_generator)
+        self.addCleanup(generators.clear)
+        with self.settings(TEXT_GENERATION={**settings.TEXT_GENERATION, 'BATCHING': False}):
+            generation_cache.clear()
+            response = self.client.post('/api/create/?cache=0', {
+                'title': 'Inference', 'plot': 'p', 'characters': 'c', 'setting': 's',
+            }, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('inference', self.server_timing(response))
+
+    def test_metrics_endpoint_aggregates_per_endpoint(self):
+        self.client.get('/api/stories/')
+        self.client.get('/api/stories/')
+
+        response = self.client.get('/servercheck/metrics/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('rpg_request_duration_seconds_count{endpoint="story-list",method="GET"} 2', body)
+        self.assertIn('rpg_requests_total{endpoint="story-list",method="GET",status="200"} 2', body)
+        self.assertIn('rpg_request_component_seconds_total{endpoint="story-list",method="GET",component="db"}', body)
+        self.assertIn('# TYPE rpg_inference_batch_size histogram', body)
+
+    def test_slow_requests_are_logged_with_their_queries(self):
+        config = {**settings.REQUEST_METRICS, 'SLOW_REQUEST_SECONDS': 0, 'SLOW_REQUEST_SAMPLE_RATE': 1.0}
+        with self.settings(REQUEST_METRICS=config), self.assertLogs('servercheck.slow_requests', 'WARNING') as logs:
+            self.client.get('/api/stories/')
+
+        self.assertIn('Slow request GET /api/stories/ (story-list) -> 200', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
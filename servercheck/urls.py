@@ -4,4 +4,9 @@ from . import views
 urlpatterns = [
     path('hello-world/', views.hello_world, name='hello_world'),
     path('username/', views.username, name='username'),
+    path('generator/', views.generator_status, name='generator_status'),
+    path('inference/', views.inference_status, name='inference_status'),
+    path('generation-cache/', views.generation_cache_status, name='generation_cache_status'),
+    path('admission/', views.admission_status, name='admission_status'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
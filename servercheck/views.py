@@ -1,6 +1,13 @@
+from django.http import HttpResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from rpg_app.admission import admission
+from rpg_app.response_cache import cache_per_user
+from rpg_app.utils import generation_cache, generators, inference
+
+from .metrics import labels, registry, render_counter, render_histogram
+
 
 # Create your views here.
 @api_view(['GET'])
@@ -9,9 +16,94 @@ def hello_world(request):
 
 
 @api_view(['GET'])
+@cache_per_user
 def username(request):
     if request.user.is_authenticated:
         user = request.user.username
     else:
         user = "Anonymous"
     return Response({"user": user})
+
+
+@api_view(['GET'])
+def generator_status(request):
+    return Response(generators.stats())
+
+
+@api_view(['GET'])
+def inference_status(request):
+    return Response(inference.stats())
+
+
+@api_view(['GET'])
+def generation_cache_status(request):
+    return Response(generation_cache.stats())
+
+
+@api_view(['GET'])
+def admission_status(request):
+    return Response(admission.stats())
+
+
+def metrics(request):
+    """Request, inference and generation cache metrics of this process in the Prometheus text format."""
+    lines = registry.render()
+
+    stats = inference.stats()
+    for name, help_text in (
+        ('batch_size', "Prompts per inference batch."),
+        ('batch_latency', "Seconds per inference batch."),
+        ('request_latency', "Seconds from submitting a prompt to its result, queueing included."),
+    ):
+        lines += render_histogram(f'rpg_inference_{name}', help_text, [('', stats[name])])
+    lines += render_counter(
+        'rpg_inference_queue_depth', "Prompts waiting for a batch.", [('', stats['queue_depth'])], kind='gauge',
+    )
+
+    admission_stats = admission.stats()
+    lines += render_histogram(
+        'rpg_generation_queue_wait_seconds', "Time requests waited for a generation slot.",
+        [('', admission_stats['queue_wait'])],
+    )
+    lines += render_counter(
+        'rpg_generation_admitted_total', "Requests admitted to generate.", [('', admission_stats['admitted'])],
+    )
+    lines += render_counter(
+        'rpg_generation_rejected_total', "Generation requests turned away, by reason.",
+        [(labels('reason', values=(reason,)), count) for reason, count in sorted(admission_stats['rejected'].items())],
+    )
+    for name in ('running', 'waiting'):
+        lines += render_counter(
+            f'rpg_generation_{name}', f"Requests {name} for generation.", [('', admission_stats[name])], kind='gauge',
+        )
+
+    cache_stats = generation_cache.stats()
+    for name in ('memory_hits', 'persistent_hits', 'misses', 'evictions'):
+        lines += render_counter(f'rpg_generation_cache_{name}_total', f"Generation cache {name.replace('_', ' ')}.", [
+            ('', cache_stats[name]),
+        ])
+    generator_stats = generators.stats()
+    throughput = [
+        (labels('model', 'backend', values=(model, stats['backend'])), stats)
+        for model, stats in sorted(generator_stats['models'].items()) if 'backend' in stats
+    ]
+    lines += render_counter(
+        'rpg_generation_tokens_total', "Tokens generated per model and backend.",
+        [(label_string, stats['generated_tokens']) for label_string, stats in throughput],
+    )
+    lines += render_counter(
+        'rpg_generation_seconds_total', "Seconds spent generating per model and backend.",
+        [(label_string, stats['generation_seconds']) for label_string, stats in throughput],
+    )
+    lines += render_counter(
+        'rpg_generation_prefill_tokens_saved_total', "Prompt tokens served from cached template prefixes.",
+        [
+            (label_string, stats['prefill_tokens_saved'])
+            for label_string, stats in throughput if 'prefill_tokens_saved' in stats
+        ],
+    )
+    lines += render_counter(
+        'rpg_process_resident_memory_bytes', "Resident memory of this process.",
+        [('', generator_stats['rss'])], kind='gauge',
+    )
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')